@@ -3,7 +3,10 @@ import asyncio
 from shared_folder_opu.client import SharedFolderClient
 from shared_folder_opu.general_utils import get_directory_path
 from shared_folder_opu.logger_singleton import SingletonLogger
-from configuration import SERVER_PORT, SERVER_HOST
+from shared_folder_opu.subscription import Subscription
+from configuration import SERVER_PORT, SERVER_HOST, COMPRESSION_CODECS, COMPRESSION_LEVELS, EDIT_QUIET_WINDOW, \
+    DIGEST_ALGORITHMS, FETCH_WINDOW, RECONNECT_DELAY, MAX_RECONNECT_DELAY, SUBSCRIPTION_ROOTS, SUBSCRIPTION_INCLUDE, \
+    SUBSCRIPTION_EXCLUDE, HASH_USE_MMAP, HASH_DROP_CACHE
 
 logger = SingletonLogger.get_logger()
 
@@ -11,4 +14,11 @@ logger = SingletonLogger.get_logger()
 shared_dir_path = get_directory_path()
 logger.info(f"The path that we will sync with the shared folder is {shared_dir_path}")
 
-asyncio.run(SharedFolderClient(shared_dir_path, SERVER_HOST, SERVER_PORT).client(), debug=True)
+shared_folder_client = SharedFolderClient(shared_dir_path, SERVER_HOST, SERVER_PORT, COMPRESSION_CODECS,
+                                          COMPRESSION_LEVELS, EDIT_QUIET_WINDOW, DIGEST_ALGORITHMS,
+                                          FETCH_WINDOW, RECONNECT_DELAY, MAX_RECONNECT_DELAY,
+                                          Subscription.from_json({"roots": SUBSCRIPTION_ROOTS,
+                                                                  "include": SUBSCRIPTION_INCLUDE,
+                                                                  "exclude": SUBSCRIPTION_EXCLUDE}),
+                                          {"use_mmap": HASH_USE_MMAP, "drop_cache": HASH_DROP_CACHE})
+asyncio.run(shared_folder_client.client(), debug=True)
@@ -1,2 +1,36 @@
 SERVER_HOST = "localhost"
 SERVER_PORT = 8080
+COMPRESSION_CODECS = ["zlib", "lzma"]
+COMPRESSION_LEVELS = {"zlib": 6, "lzma": 1}
+# a client that falls this many messages behind is disconnected
+MAX_CLIENT_BACKLOG = 1000
+# a client that is this many messages behind gets the whole manifest instead of another delta
+COALESCE_BACKLOG = 16
+# local changes are sent together once the folder was quiet for this many seconds
+EDIT_QUIET_WINDOW = 0.2
+# the server hashes the shared folder with this algorithm, the clients offer the ones they support.
+# use "md5" on the server to serve old clients
+DIGEST_ALGORITHM = "blake2b"
+DIGEST_ALGORITHMS = ["blake2b", "sha256", "md5"]
+# the index reads the files it hashes through a memory map instead of a buffer, and releases their pages from
+# the page cache when it is done, so hashing a big folder does not push out the files that are in use
+HASH_USE_MMAP = False
+HASH_DROP_CACHE = False
+# the number of files a client requested and did not receive yet
+FETCH_WINDOW = 256
+# the server keeps the deltas it published in a journal of at most this many bytes, a client that reconnects
+# gets only the deltas it missed while they are still in it
+MAX_JOURNAL_SIZE = 16 * 1024 * 1024
+# a client that lost the connection connects again after a delay that doubles up to the maximal delay
+RECONNECT_DELAY = 0.5
+MAX_RECONNECT_DELAY = 30.0
+# the server publishes a burst of edits as one delta, once no edit arrived for the latency or at the latest
+# after the maximal delay
+BROADCAST_LATENCY = 0.05
+MAX_BROADCAST_DELAY = 0.5
+# a client syncs only the subtrees under these roots, relative to the shared folder, and in them only the files
+# that match an include pattern and no exclude pattern. a pattern without a separator matches the name, like
+# "*.log". empty lists sync the whole folder
+SUBSCRIPTION_ROOTS = []
+SUBSCRIPTION_INCLUDE = []
+SUBSCRIPTION_EXCLUDE = []
@@ -3,7 +3,9 @@ import asyncio
 from shared_folder_opu.general_utils import exception_handler, get_directory_path
 from shared_folder_opu.logger_singleton import SingletonLogger
 from shared_folder_opu.server import SharedFolderServer
-from configuration import SERVER_PORT, SERVER_HOST
+from configuration import SERVER_PORT, SERVER_HOST, COMPRESSION_CODECS, COMPRESSION_LEVELS, \
+    MAX_CLIENT_BACKLOG, COALESCE_BACKLOG, DIGEST_ALGORITHM, MAX_JOURNAL_SIZE, BROADCAST_LATENCY, MAX_BROADCAST_DELAY, \
+    HASH_USE_MMAP, HASH_DROP_CACHE
 
 logger = SingletonLogger.get_logger()
 
@@ -15,7 +17,12 @@ async def main():
     shared_dir_path = get_directory_path()
     logger.info(f"will share the path {shared_dir_path}")
 
-    shared_folder_server = SharedFolderServer(SERVER_HOST, SERVER_PORT, shared_dir_path)
+    shared_folder_server = SharedFolderServer(SERVER_HOST, SERVER_PORT, shared_dir_path, COMPRESSION_CODECS,
+                                              COMPRESSION_LEVELS, MAX_CLIENT_BACKLOG, COALESCE_BACKLOG,
+                                              digest_algorithm=DIGEST_ALGORITHM, max_journal_size=MAX_JOURNAL_SIZE,
+                                              broadcast_latency=BROADCAST_LATENCY,
+                                              max_broadcast_delay=MAX_BROADCAST_DELAY,
+                                              hash_options={"use_mmap": HASH_USE_MMAP, "drop_cache": HASH_DROP_CACHE})
     await shared_folder_server.run_server()
 
 
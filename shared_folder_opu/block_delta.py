@@ -0,0 +1,242 @@
+import hashlib
+import math
+import os
+import struct
+import zlib
+from typing import BinaryIO
+
+from shared_folder_opu.hashing import DEFAULT_DIGEST, new_hasher, read_chunks
+from shared_folder_opu.logger_singleton import SingletonLogger
+
+logger = SingletonLogger.get_logger()
+
+# smaller files are sent whole, a delta would not save enough to be worth the round trip
+DELTA_MIN_SIZE = 256 * 1024
+MIN_BLOCK_SIZE = 2 * 1024
+MAX_BLOCK_SIZE = 1024 * 1024
+READ_SIZE = 1024 * 1024
+ADLER_MODULO = 65521
+# after a block without a match the data changed there, so the next blocks are copied as literals and only
+# their boundaries are looked up, up to this many blocks before the search goes byte by byte again
+MAX_SKIPPED_BLOCKS = 16
+
+SIGNATURE_HEADER_FORMAT = ">I"
+SIGNATURE_ENTRY_FORMAT = ">I16s"
+
+# the instructions of a delta
+COPY_INSTRUCTION = 0
+LITERAL_INSTRUCTION = 1
+END_INSTRUCTION = 2
+
+
+def choose_block_size(file_size: int) -> int:
+    """
+    like rsync, use blocks of about the square root of the file size
+    """
+    block_size = 1 << max(0, int(math.sqrt(file_size)).bit_length() - 1)
+    return max(MIN_BLOCK_SIZE, min(MAX_BLOCK_SIZE, block_size))
+
+
+def weak_checksum(data: bytes) -> int:
+    return zlib.adler32(data)
+
+
+def roll_checksum(checksum: int, out_byte: int, in_byte: int, window_length: int) -> int:
+    """
+    move the adler32 checksum of a window one byte forward
+    """
+    a = checksum & 0xffff
+    b = checksum >> 16
+    a = (a - out_byte + in_byte) % ADLER_MODULO
+    b = (b - window_length * out_byte + a - 1) % ADLER_MODULO
+    return (b << 16) | a
+
+
+def strong_hash(data: bytes) -> bytes:
+    # the strong hash of a block is only compared to the one of a block of the same file, md5 is enough.
+    # the whole file is verified with the negotiated digest
+    return hashlib.md5(data).digest()
+
+
+def sign_file(file_path: str | bytes, block_size: int = None, algorithm: str = None,
+              **options) -> tuple[str | None, int, list[tuple[int, bytes]]]:
+    """
+    return the digest of the file with the algorithm, the block size and the signatures, calculated in one
+    pass over the file. the file is read in chunks of whole blocks, the options are passed to read_chunks.
+    without an algorithm the digest is None
+    """
+    if block_size is None:
+        block_size = choose_block_size(os.path.getsize(file_path))
+    hasher = new_hasher(algorithm) if algorithm is not None else None
+
+    signatures = []
+    for chunk in read_chunks(file_path, max(block_size, READ_SIZE - READ_SIZE % block_size), **options):
+        if hasher is not None:
+            hasher.update(chunk)
+        for offset in range(0, len(chunk), block_size):
+            with chunk[offset:offset + block_size] as block:
+                signatures.append((weak_checksum(block), strong_hash(block)))
+
+    return hasher.hexdigest() if hasher is not None else None, block_size, signatures
+
+
+def compute_signatures(file_path: str | bytes, block_size: int = None) -> tuple[int, list[tuple[int, bytes]]]:
+    """
+    return the block size and the (weak checksum, strong hash) of every block of the file. the side that
+    has the old copy of a file sends these signatures to the side that has the new copy.
+    """
+    _, block_size, signatures = sign_file(file_path, block_size)
+    return block_size, signatures
+
+
+def pack_signatures(block_size: int, signatures: list[tuple[int, bytes]]) -> bytes:
+    return struct.pack(SIGNATURE_HEADER_FORMAT, block_size) + b"".join(
+        struct.pack(SIGNATURE_ENTRY_FORMAT, weak, strong) for weak, strong in signatures)
+
+
+def unpack_signatures(data: bytes) -> tuple[int, list[tuple[int, bytes]]]:
+    header_length = struct.calcsize(SIGNATURE_HEADER_FORMAT)
+    block_size = struct.unpack_from(SIGNATURE_HEADER_FORMAT, data)[0]
+    signatures = list(struct.iter_unpack(SIGNATURE_ENTRY_FORMAT, data[header_length:]))
+    return block_size, signatures
+
+
+def _write_literal(out_file: BinaryIO, literal: bytearray):
+    if literal:
+        out_file.write(struct.pack(">BI", LITERAL_INSTRUCTION, len(literal)))
+        out_file.write(literal)
+        literal.clear()
+
+
+def generate_delta(source_path: str | bytes, block_size: int, signatures: list[tuple[int, bytes]],
+                   out_file: BinaryIO, algorithm: str = DEFAULT_DIGEST) -> str:
+    """
+    write to out_file the instructions that build the source file from the blocks of the old copy, like
+    rsync does: blocks that did not change are copied, and only the new data is sent as literals.
+    the source is read in chunks, so the memory does not depend on the file size. the search byte by byte
+    runs in python, so where it finds nothing for a whole block, the blocks that follow are skipped and
+    only their boundaries are looked up, twice as many blocks every time nothing is found. a changed file
+    costs a fraction of a byte by byte search, and a shifted block is still found after at most
+    MAX_SKIPPED_BLOCKS blocks. return the digest of the source file.
+    """
+    blocks = {}
+    for index, (weak, strong) in enumerate(signatures):
+        blocks.setdefault(weak, {}).setdefault(strong, index)
+
+    source_hasher = new_hasher(algorithm)
+    buffer = bytearray()
+    offset = 0
+    literal = bytearray()
+    checksum = None
+    eof = False
+    copied_blocks = 0
+    missed = 0  # bytes searched one by one since the last match
+    skipped = 0  # blocks skipped since the last search byte by byte
+    skip_blocks = 1
+
+    with open(source_path, "rb") as source:
+        while True:
+            if not eof and len(buffer) - offset <= block_size:
+                # keep at least a block and one more byte after the window, so we can roll the checksum
+                del buffer[:offset]
+                offset = 0
+                chunk = source.read(READ_SIZE)
+                source_hasher.update(chunk)
+                eof = not chunk
+                buffer += chunk
+                continue
+
+            window_end = min(offset + block_size, len(buffer))
+            if window_end == offset:
+                break
+
+            if checksum is None:
+                checksum = weak_checksum(buffer[offset:window_end])
+
+            index = None
+            candidates = blocks.get(checksum)
+            if candidates:
+                index = candidates.get(strong_hash(buffer[offset:window_end]))
+
+            if index is not None:
+                _write_literal(out_file, literal)
+                out_file.write(struct.pack(">BQ", COPY_INSTRUCTION, index))
+                copied_blocks += 1
+                offset = window_end
+                checksum = None
+                missed = skipped = 0
+                skip_blocks = 1
+                continue
+
+            if missed >= block_size and window_end - offset == block_size:
+                literal += buffer[offset:window_end]
+                _write_literal(out_file, literal)
+                offset = window_end
+                checksum = None
+                skipped += 1
+                if skipped == skip_blocks:
+                    missed = skipped = 0
+                    skip_blocks = min(2 * skip_blocks, MAX_SKIPPED_BLOCKS)
+                continue
+
+            missed += 1
+            literal.append(buffer[offset])
+            if len(literal) >= block_size:
+                _write_literal(out_file, literal)
+
+            if window_end - offset == block_size and window_end < len(buffer):
+                checksum = roll_checksum(checksum, buffer[offset], buffer[window_end], block_size)
+            else:
+                checksum = None
+            offset += 1
+
+    _write_literal(out_file, literal)
+    out_file.write(struct.pack(">B", END_INSTRUCTION))
+    logger.debug(f"delta of {source_path} copies {copied_blocks} out of {len(signatures)} blocks")
+    return source_hasher.hexdigest()
+
+
+def write_delta(source_path: str | bytes, block_size: int, signatures: list[tuple[int, bytes]], delta_path: str,
+                algorithm: str = DEFAULT_DIGEST) -> str:
+    """
+    generate_delta into the file at delta_path. it is run on a worker thread, return the digest of the source
+    """
+    with open(delta_path, "wb") as delta_file:
+        return generate_delta(source_path, block_size, signatures, delta_file, algorithm)
+
+
+def patch_into(base_path: str | bytes, block_size: int, delta_path: str, out_path: str,
+               algorithm: str = DEFAULT_DIGEST) -> str:
+    """
+    apply_delta from the file at delta_path into the file at out_path. it is run on a worker thread, return
+    the digest of the new file
+    """
+    with open(delta_path, "rb") as delta_file, open(out_path, "wb") as out_file:
+        return apply_delta(base_path, block_size, delta_file, out_file, algorithm)
+
+
+def apply_delta(base_path: str | bytes, block_size: int, delta_file: BinaryIO, out_file: BinaryIO,
+                algorithm: str = DEFAULT_DIGEST) -> str:
+    """
+    build the new file from the old copy and the delta instructions. return the digest of the new file
+    """
+    hasher = new_hasher(algorithm)
+    with open(base_path, "rb") as base:
+        while True:
+            instruction = struct.unpack(">B", delta_file.read(1))[0]
+            if instruction == COPY_INSTRUCTION:
+                index = struct.unpack(">Q", delta_file.read(8))[0]
+                base.seek(index * block_size)
+                data = base.read(block_size)
+            elif instruction == LITERAL_INSTRUCTION:
+                length = struct.unpack(">I", delta_file.read(4))[0]
+                data = delta_file.read(length)
+            elif instruction == END_INSTRUCTION:
+                break
+            else:
+                raise RuntimeError(f"invalid delta instruction {instruction}")
+
+            hasher.update(data)
+            out_file.write(data)
+
+    return hasher.hexdigest()
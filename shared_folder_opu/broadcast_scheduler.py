@@ -0,0 +1,70 @@
+import asyncio
+from typing import Awaitable, Callable
+
+from shared_folder_opu.logger_singleton import SingletonLogger
+
+logger = SingletonLogger.get_logger()
+
+# the changes are broadcast once no edit was applied for this long, that is when the burst ended
+BROADCAST_LATENCY = 0.05
+# a folder that keeps changing is still broadcast at least this often
+MAX_BROADCAST_DELAY = 0.5
+
+
+class BroadcastScheduler:
+    """
+    the server applies the edits as they arrive, and the scheduler publishes their changes as one delta
+    instead of one delta per edit. the manifest is marked dirty by every edit, and the delta is published
+    once no edit arrived for latency seconds, or max_delay seconds after the first unpublished edit. it runs
+    on the event loop. the counters show how many edits the broadcasts covered
+    """
+
+    def __init__(self, publish: Callable[[], Awaitable[None]], latency: float = BROADCAST_LATENCY,
+                 max_delay: float = MAX_BROADCAST_DELAY):
+        self.publish = publish
+        self.latency = latency
+        self.max_delay = max_delay
+        self.timer = None
+        self.first_edit_time = None
+        self.task = None
+        self.pending_edits = 0  # edits that were applied and not published yet
+        self.broadcasts = 0
+        self.published_edits = 0
+        self.max_edits_per_broadcast = 0
+
+    def mark_dirty(self, edits: int = 1):
+        """
+        the manifest changed, publish the change soon
+        """
+        loop = asyncio.get_running_loop()
+        self.pending_edits += edits
+        if self.timer is not None:
+            if loop.time() - self.first_edit_time >= self.max_delay:
+                return
+            self.timer.cancel()
+        else:
+            self.first_edit_time = loop.time()
+        self.timer = loop.call_later(self.latency, self._flush_later)
+
+    def _flush_later(self):
+        self.timer = None
+        self.task = asyncio.create_task(self.flush())
+
+    async def flush(self):
+        """
+        publish the pending changes now. the server calls it before it sends the whole manifest, so the
+        deltas that follow start where the manifest ends
+        """
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if not self.pending_edits:
+            return
+
+        edits, self.pending_edits = self.pending_edits, 0
+        self.broadcasts += 1
+        self.published_edits += edits
+        self.max_edits_per_broadcast = max(self.max_edits_per_broadcast, edits)
+        logger.debug(f"broadcast {edits} edits, {self.published_edits} edits in {self.broadcasts} broadcasts "
+                     f"so far, at most {self.max_edits_per_broadcast} in one")
+        await self.publish()
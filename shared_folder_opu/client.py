@@ -1,147 +1,753 @@
 import asyncio
-import contextlib
+import itertools
 import json
 import os
+import random
 import struct
-from pathlib import Path
+import tempfile
+import time
 from shutil import rmtree
 
 from watchdog.observers import Observer
 
-from shared_folder_opu.directory_utils import calculate_file_md5
+from shared_folder_opu.block_delta import DELTA_MIN_SIZE, compute_signatures, pack_signatures, unpack_signatures, \
+    write_delta, patch_into
+from shared_folder_opu.compression import Codec, Compressor, DEFAULT_CODECS, DEFAULT_LEVELS, decompress_payload
+from shared_folder_opu.connection import Connection
+from shared_folder_opu.directory_utils import get_temp_dir, place_file, METADATA_DIR_NAME
+from shared_folder_opu.edit_batcher import EditBatcher, EDIT_QUIET_WINDOW, moved_path
+from shared_folder_opu.expected_changes import ExpectedChanges, ABSENT, DIRECTORY
+from shared_folder_opu.file_transfer import receive_file_content, clone_file
 from shared_folder_opu.folder_monitor import MyHandler
-from shared_folder_opu.general_utils import get_string, get_local_file_path, calculate_md5sum
+from shared_folder_opu.general_utils import get_local_file_path, get_string, get_long_string
+from shared_folder_opu.hashing import DEFAULT_DIGESTS, LEGACY_DIGEST, digest_length
 from shared_folder_opu.logger_singleton import SingletonLogger
-from shared_folder_opu.protocol import MESSAGE_TYPE_LENGTH, MESSAGE_LENGTH_FIELD_LENGTH, MessageType, UserRequestMessage
+from shared_folder_opu.manifest import ManifestDelta, ManifestIndex
+from shared_folder_opu.manifest_codec import EncodedManifest
+from shared_folder_opu.merkle import ROOT, join_path, decode_nodes
+from shared_folder_opu.protocol import MESSAGE_TYPE_LENGTH, MESSAGE_LENGTH_FIELD_LENGTH, VERSION_FIELD_LENGTH, \
+    MessageType, UserBulkRequestMessage, UserSyncRequestMessage, UserDeltaRequestMessage, UserEditMessage, \
+    UserEditTypes, UserHelloMessage, UserTreeRequestMessage
+from shared_folder_opu.subscription import Subscription
+from shared_folder_opu.sync_ignore import SyncIgnore
+from shared_folder_opu.sync_planner import SyncPlan, plan_sync
 
 logger = SingletonLogger.get_logger()
 
+# the digests of our copy of the folder, so a reconnect hashes only the files that changed since
+CLIENT_INDEX_NAME = "client_index.json"
+# the journal of the server and the last version we applied from it, so a reconnect gets only what we missed
+RESUME_STATE_NAME = "resume.json"
+# the number of requested files that were not received yet. the server streams them back to back,
+# so a sync of many small files is not limited by round trips
+FETCH_WINDOW = 256
+BULK_REQUEST_SIZE = 64
+TREE_REQUEST_SIZE = 256
+# a path that is not in our merkle tree. None in the tree is a directory
+ABSENT_CHILD = object()
+# the delay before connecting again doubles after every failed attempt, up to the maximal delay
+RECONNECT_DELAY = 0.5
+MAX_RECONNECT_DELAY = 30.0
+# a file is received into the partial file of its digest, a transfer that was interrupted continues from
+# its end. partial files that were not continued for a day are removed
+PARTIAL_PREFIX = "partial-"
+PARTIAL_TTL = 24 * 60 * 60
+# a removed file whose content is added under another path is kept in the temp directory until it is placed
+HELD_PREFIX = "held-"
+
+
+def rename_files(moves: list[tuple[str, str]]) -> list[bool]:
+    """
+    rename the files, return for every move if it was made. a source that no longer exists is not moved
+    """
+    moved = []
+    for source, destination in moves:
+        try:
+            os.rename(source, destination)
+        except FileNotFoundError:
+            moved.append(False)
+        else:
+            moved.append(True)
+    return moved
+
+
+def remove_files(paths: list[str]):
+    for path in paths:
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+
+def make_plan_changes(folder_path: str, plan: SyncPlan):
+    """
+    remove the redundant paths of the plan and create its missing directories
+    """
+    for relative_path in plan.deletes:
+        logger.info(f"File exists locally but not in remote: {relative_path}")
+    remove_files([os.path.join(folder_path, relative_path) for relative_path in plan.deletes])
+
+    for relative_path in plan.rmtrees:
+        logger.info(f"Directory exists locally but not in remote: {relative_path}")
+        rmtree(os.path.join(folder_path, relative_path), ignore_errors=True)
+
+    for relative_path in plan.mkdirs:
+        os.makedirs(os.path.join(folder_path, relative_path), exist_ok=True)
+
 
 class SharedFolderClient:
 
-    def __init__(self, folder_path: str, host: str, port: int):
+    def __init__(self, folder_path: str, host: str, port: int, compression_codecs: list[str] = None,
+                 compression_levels: dict[str, int] = None, edit_quiet_window: float = EDIT_QUIET_WINDOW,
+                 digest_algorithms: list[str] = None, fetch_window: int = FETCH_WINDOW,
+                 reconnect_delay: float = RECONNECT_DELAY, max_reconnect_delay: float = MAX_RECONNECT_DELAY,
+                 subscription: Subscription = None, hash_options: dict = None):
         self.port = port
         self.host = host
         self.shared_dir_path = folder_path
-        self.lock = asyncio.Lock()
         self.observer = None
         self.event_handler = None
         self.reader = None
         self.writer = None
+        self.connection = None
+        # the part of the folder we sync, the rest of our folder is left as it is
+        self.subscription = subscription or Subscription()
+        # the paths that are never synced, the watcher and the index read the rules again when they change
+        self.sync_ignore = SyncIgnore(folder_path)
+        # it outlives the connections, the changes made while we are not connected are sent when we reconnect
+        self.edit_batcher = EditBatcher(None, folder_path, edit_quiet_window, subscription=self.subscription,
+                                        ignore=self.sync_ignore)
+        self.reconnect_delay = reconnect_delay
+        self.max_reconnect_delay = max_reconnect_delay
+        self.compression_codecs = compression_codecs if compression_codecs is not None else DEFAULT_CODECS
+        self.compression_levels = compression_levels or DEFAULT_LEVELS
+        self.digest_algorithms = digest_algorithms or DEFAULT_DIGESTS
+        # the algorithm of the digests in the manifest of the server, it is set in the handshake
+        self.digest_algorithm = LEGACY_DIGEST
+        self.hash_options = hash_options
         self.file_requests = {}
-        self.last_sync_hash = None
+        self.fetch_window = fetch_window
+        self.queued_fetches: dict[str, None] = {}  # relative paths that were not requested yet, in order
+        self.fetches_in_flight = 0
+        # content that appears under many paths is requested once. digest -> the path it was requested for,
+        # and digest -> the other paths that wait for it
+        self.fetching: dict[str, str] = {}
+        self.duplicate_fetches: dict[str, list[str]] = {}
+        self.partials: dict[str, int] = {}  # digest -> the size of its partial file
+        # relative path -> digest of the files that were requested and not received before the connection was lost
+        self.interrupted_requests: dict[str, str] = {}
+        self.held: dict[str, str] = {}  # digest -> the temp path of a removed file we kept for another path
+        self.tree_requests = 0  # merkle tree requests that were not answered yet
+        self.manifest_version = None
+        self.sync_requested = False
+        self.journal_id = None  # the journal of the server, it is sent in the handshake
+        self.resuming = False  # we asked the server to replay the journal from manifest_version
+        self.expected_changes = ExpectedChanges(folder_path)
+        # it is loaded in the handshake, once we know the digest algorithm of the server
+        self.index = None
+
+    def relative_path(self, path: str | bytes) -> str:
+        return os.path.relpath(os.fsdecode(path), self.shared_dir_path)
+
+    @property
+    def resume_state_path(self) -> str:
+        return os.path.join(self.shared_dir_path, METADATA_DIR_NAME, RESUME_STATE_NAME)
 
-    @contextlib.contextmanager
-    def disable_observer(self):
+    def partial_path(self, digest: str) -> str:
+        return os.path.join(get_temp_dir(self.shared_dir_path), PARTIAL_PREFIX + digest)
+
+    def scan_partials(self) -> dict[str, int]:
         """
-        we use this method when we are going to edit the directory, so we don't
-        want the observer to react to changes
+        the partial files of interrupted transfers, digest -> size. the ones that were not continued for
+        PARTIAL_TTL seconds are removed
         """
-        if self.observer:
-            self.observer.stop()
-            self.observer.join()
+        partials = {}
+        now = time.time()
+        with os.scandir(get_temp_dir(self.shared_dir_path)) as entries:
+            for entry in entries:
+                if not entry.name.startswith(PARTIAL_PREFIX):
+                    continue
+                stat = entry.stat()
+                if now - stat.st_mtime > PARTIAL_TTL:
+                    logger.debug(f"remove the old partial file {entry.name}")
+                    os.unlink(entry.path)
+                    continue
+                partials[entry.name[len(PARTIAL_PREFIX):]] = stat.st_size
+        return partials
 
-        yield
+    def resume_point(self) -> dict | None:
+        """
+        the version to continue from after a reconnect. the files we requested and did not receive are
+        requested again, so the version we reached is good as long as no sync or merkle walk was cut short.
+        otherwise the last saved state is used, if it was saved with the same subscription
+        """
+        if self.journal_id is not None and self.manifest_version is not None and not (
+                self.resuming or self.sync_requested or self.tree_requests):
+            return {"journal": self.journal_id, "version": self.manifest_version}
+        state = self.load_resume_state()
+        if state is not None and Subscription.from_json(state.pop("subscription", None)) != self.subscription:
+            logger.info("the subscription changed, sync the whole subscribed part of the folder")
+            return None
+        return state
+
+    def reset_session(self):
+        """
+        forget the state of the previous connection. what was requested and not received is kept in
+        interrupted_requests, until a sync or a replay of the journal requests it again
+        """
+        self.interrupted_requests.update({self.relative_path(path): digest.decode()
+                                          for path, digest in self.file_requests.items()})
+        self.file_requests = {}
+        self.queued_fetches = {}
+        self.fetches_in_flight = 0
+        self.fetching = {}
+        self.duplicate_fetches = {}
+        self.tree_requests = 0
+        self.sync_requested = False
 
-        if self.observer:
-            my_loop = asyncio.get_running_loop()
-            self.start_new_observer(my_loop)
+    def load_resume_state(self) -> dict | None:
+        try:
+            with open(self.resume_state_path, "r") as state_file:
+                return json.load(state_file)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as error:
+            logger.warning(f"failed to load {self.resume_state_path}: {error}")
+            return None
 
-    async def handle_missing_file(self, missing_file_path: str, missing_hash: str):
+    def save_resume_state(self):
+        """
+        keep the version we reached, but only if everything up to it was applied. otherwise the previous
+        state is kept, replaying more deltas than needed is harmless
+        """
+        if self.journal_id is None or self.manifest_version is None or self.resuming or self.sync_requested or \
+                self.file_requests or self.tree_requests:
+            return
+
+        os.makedirs(os.path.dirname(self.resume_state_path), exist_ok=True)
+        temp_path = f"{self.resume_state_path}.tmp"
+        with open(temp_path, "w") as state_file:
+            json.dump({"journal": self.journal_id, "version": self.manifest_version,
+                       "subscription": self.subscription.to_json()}, state_file)
+        os.replace(temp_path, self.resume_state_path)
+
+    def make_directories(self, path: str | bytes):
+        """
+        create the directory and its missing parents, the observer ignores their creation
+        """
+        missing = []
+        while path and not os.path.isdir(path):
+            missing.append(path)
+            path = os.path.dirname(path)
+        for directory in reversed(missing):
+            self.expected_changes.expect_directory(directory)
+            os.makedirs(directory, exist_ok=True)
+            self.index.add_directory(self.relative_path(directory))
+
+    async def remove_file(self, path: str | bytes):
+        self.expected_changes.expect_removed(path)
+        await asyncio.get_running_loop().run_in_executor(None, os.unlink, path)
+        self.index.remove(self.relative_path(path))
+
+    async def remove_directory(self, path: str | bytes):
+        self.expected_changes.expect_removed(path)
+        await asyncio.get_running_loop().run_in_executor(None, rmtree, path)
+        self.index.remove(self.relative_path(path))
+
+    async def move_local_path(self, source: str, destination: str, is_dir: bool) -> bool:
+        """
+        rename our copy of a path the server renamed, instead of removing it and fetching it again. the move is
+        made only if the destination is free and the source is what the server moved. the delta lists the move
+        as a removal and additions too, so whatever does not match after the rename is fixed by them
+        """
+        source_path = os.path.join(self.shared_dir_path, source)
+        destination_path = os.path.join(self.shared_dir_path, destination)
+        if not os.path.lexists(source_path) or os.path.lexists(destination_path) or \
+                os.path.isdir(source_path) != is_dir:
+            logger.debug(f"can not move {source} to {destination}, it is removed and fetched instead")
+            return False
+
+        logger.info(f"{source} was moved to {destination} in the remote folder")
+        self.make_directories(os.path.dirname(destination_path))
+        # the observer reports a move into a directory it does not watch yet as a removal and creations
+        files, directories = self.indexed_under(source)
+        self.expected_changes.expect_all(
+            [(source_path, ABSENT)] +
+            [(os.path.join(self.shared_dir_path, moved_path(path, source, destination)), DIRECTORY)
+             for path in directories] +
+            [(os.path.join(self.shared_dir_path, moved_path(path, source, destination)), self.index.files[path].digest)
+             for path in files])
+        self.expected_changes.expect_moved(source_path, destination_path)
+        await asyncio.get_running_loop().run_in_executor(None, os.rename, source_path, destination_path)
+        self.index.move(source, destination)
+        return True
+
+    def indexed_under(self, relative_path: str) -> tuple[list[str], list[str]]:
+        """
+        the indexed files and directories at or under the path
+        """
+        if relative_path in self.index.files:
+            return [relative_path], []
+
+        files = []
+        directories = []
+        unvisited = [relative_path] if relative_path in self.index.tree.children else []
+        while unvisited:
+            directory = unvisited.pop()
+            directories.append(directory)
+            for name, digest in self.index.tree.children[directory].items():
+                if digest is None:
+                    unvisited.append(join_path(directory, name))
+                else:
+                    files.append(join_path(directory, name))
+        return files, directories
+
+    async def hold_files(self, relative_paths: list[str], digests: set[str]):
+        """
+        move the files we are about to remove and whose digests are needed elsewhere to the temp directory,
+        request_files puts them in place instead of fetching them. this catches the moves that were reported
+        as a removal and a creation. the index entries of the files must be up to date
+        """
+        holds = {}  # digest -> the file that is kept for it
+        for relative_path in relative_paths:
+            entry = self.index.files.get(relative_path)
+            if entry is not None and entry.digest in digests and entry.digest not in self.held:
+                holds.setdefault(entry.digest, relative_path)
+        if not holds:
+            return
+
+        temp_dir = get_temp_dir(self.shared_dir_path)
+        moves = [(os.path.join(self.shared_dir_path, relative_path), os.path.join(temp_dir, HELD_PREFIX + digest))
+                 for digest, relative_path in holds.items()]
+        moved = await asyncio.get_running_loop().run_in_executor(None, rename_files, moves)
+        for (digest, relative_path), (_, held_path), was_moved in zip(holds.items(), moves, moved):
+            if not was_moved:
+                continue
+            logger.debug(f"keep {relative_path} for another path with the same content")
+            self.held[digest] = held_path
+            self.index.remove(relative_path)
+
+    def place_held(self, relative_path: str, digest: str) -> bool:
+        """
+        put a file we kept in place of the one we would request. return False if we do not have its content
+        """
+        held_path = self.held.pop(digest, None)
+        if held_path is None:
+            return False
+
+        logger.info(f"{relative_path} has the content of a removed file, it is not fetched")
+        full_path = os.path.join(self.shared_dir_path, relative_path)
+        self.make_directories(os.path.dirname(full_path))
+        self.replace_file(held_path, full_path, digest)
+        return True
+
+    async def release_held(self):
         """
-        this method will write a request to the server to send the missing file
+        remove the kept files that no path needed
+        """
+        held_paths, self.held = list(self.held.values()), {}
+        if held_paths:
+            await asyncio.get_running_loop().run_in_executor(None, remove_files, held_paths)
+
+    def replace_file(self, temp_path: str, path: str | bytes, digest: str | bytes):
+        """
+        move a file we received to its place, the observer ignores the change
+        """
+        self.expected_changes.expect_file(path, digest)
+        place_file(temp_path, path)
+        # we know the digest of what we wrote, so it is not hashed again
+        self.index.update_file(self.relative_path(path), digest.decode() if isinstance(digest, bytes) else digest)
+
+    def queue_fetch(self, missing_file_path: str, missing_hash: str):
+        """
+        add the file to the file requests. it is requested by request_queued_files
         """
         logger.info(f"add {missing_file_path.encode()}: {missing_hash.encode()} to file requests")
         self.file_requests[os.path.join(self.shared_dir_path, missing_file_path).encode()] = missing_hash.encode()
-        self.writer.write(UserRequestMessage(missing_file_path, missing_hash).pack())
-        await self.writer.drain()
+        self.queued_fetches[missing_file_path] = None
+
+    def request_queued_files(self):
+        """
+        request the queued files in bulk requests, as long as the window of files in flight is not full
+        """
+        while self.queued_fetches and self.fetches_in_flight < self.fetch_window:
+            count = min(BULK_REQUEST_SIZE, self.fetch_window - self.fetches_in_flight, len(self.queued_fetches))
+            paths = list(itertools.islice(self.queued_fetches, count))
+            requests = []
+            for relative_path in paths:
+                del self.queued_fetches[relative_path]
+                digest = self.file_requests.get(os.path.join(self.shared_dir_path, relative_path).encode())
+                if digest is None:
+                    continue
+                digest = digest.decode()
+                if self.fetching.get(digest, relative_path) != relative_path:
+                    # the same content is on its way for another path, it is copied from there
+                    self.duplicate_fetches.setdefault(digest, []).append(relative_path)
+                    continue
+                self.fetching[digest] = relative_path
+                # continue an interrupted transfer of the same content from where it stopped
+                requests.append((relative_path, digest, self.partials.pop(digest, 0)))
+            self.fetches_in_flight += len(requests)
+            if requests:
+                self.connection.post(UserBulkRequestMessage(requests))
+
+    def fetch_finished(self, digest: bytes | None) -> list[str]:
+        """
+        the request for the content is answered. return the paths that waited for the same content
+        """
+        if digest is None:
+            return []
+        self.fetching.pop(digest.decode(), None)
+        return self.duplicate_fetches.pop(digest.decode(), [])
+
+    async def clone_local(self, source: str, relative_path: str, digest: str) -> bool:
+        """
+        make the file from a local file with the same content. return False if the source no longer has it
+        """
+        try:
+            temp_path, copied_digest = await asyncio.get_running_loop().run_in_executor(
+                None, clone_file, os.path.join(self.shared_dir_path, source), get_temp_dir(self.shared_dir_path),
+                self.digest_algorithm)
+        except (FileNotFoundError, IsADirectoryError):
+            return False
+        if copied_digest != digest:
+            logger.debug(f"{source} changed since it was indexed, it can not be copied to {relative_path}")
+            os.unlink(temp_path)
+            return False
+
+        logger.info(f"{relative_path} was copied from {source} that has the same content")
+        full_path = os.path.join(self.shared_dir_path, relative_path)
+        self.make_directories(os.path.dirname(full_path))
+        self.replace_file(temp_path, full_path, digest)
+        return True
+
+    async def copy_local(self, relative_path: str, digest: str) -> bool:
+        """
+        a file we already have under another path is copied instead of fetched
+        """
+        source = self.index.path_with_digest(digest)
+        if source is None or source == relative_path:
+            return False
+        return await self.clone_local(source, relative_path, digest)
+
+    async def place_duplicates(self, relative_path: str, digest: str, duplicates: list[str]):
+        """
+        copy the content we received to the other paths that requested it
+        """
+        for duplicate in duplicates:
+            full_path = os.path.join(self.shared_dir_path, duplicate).encode()
+            if self.file_requests.get(full_path) != digest.encode():
+                continue
+            if await self.clone_local(relative_path, duplicate, digest):
+                self.file_requests.pop(full_path)
+            else:
+                self.queued_fetches[duplicate] = None
+        self.request_queued_files()
+
+    def fetch_answered(self):
+        """
+        the server answered one of the requested files, there is room for another one in the window
+        """
+        self.fetches_in_flight = max(0, self.fetches_in_flight - 1)
+        self.request_queued_files()
+
+    async def handle_missing_file(self, missing_file_path: str, missing_hash: str):
+        """
+        request the missing file from the server
+        """
+        self.queue_fetch(missing_file_path, missing_hash)
+        self.request_queued_files()
 
     async def handle_server_file(self):
         """
-        handle the file the server sent on out request
+        handle the file the server sent on our request. it is received into the partial file of its digest,
+        so if the connection is lost in the middle, the transfer continues from there when we reconnect
         """
         missing_file_path = await get_local_file_path(self.reader, self.shared_dir_path.encode())
-        content = await get_string(self.reader)
+        offset = struct.unpack(">Q", await self.reader.readexactly(8))[0]
+        expected_digest = self.file_requests.get(missing_file_path)
+        partial_path = self.partial_path(expected_digest.decode()) if expected_digest is not None else None
+        temp_path, digest = await receive_file_content(self.reader, get_temp_dir(self.shared_dir_path),
+                                                       self.digest_algorithm, partial_path, offset)
+        self.fetch_answered()
+        duplicates = self.fetch_finished(expected_digest)
 
         if missing_file_path not in self.file_requests.keys():
             logger.warning(f"{missing_file_path} not in file requests {self.file_requests.keys()}")
+            os.unlink(temp_path)
             return
 
-        if calculate_md5sum(content).encode() != self.file_requests[missing_file_path]:
+        if digest.encode() != self.file_requests[missing_file_path]:
+            os.unlink(temp_path)
+            # the other paths are requested on their own
+            for duplicate in duplicates:
+                self.queued_fetches[duplicate] = None
+            if offset:
+                logger.info(f"{missing_file_path} does not match after continuing from {offset}, request all of it")
+                await self.handle_missing_file(self.relative_path(missing_file_path), expected_digest.decode())
+                return
             logger.info("received outdated version, wait for another message")
             return
 
         self.file_requests.pop(missing_file_path)
         logger.info(f"got the content of {missing_file_path}")
-        with self.disable_observer():
-            os.makedirs(os.path.dirname(missing_file_path), exist_ok=True)
-            with open(os.path.join(self.shared_dir_path.encode(), missing_file_path), "wb") as f:
-                f.write(content)
+        self.make_directories(os.path.dirname(missing_file_path))
+        self.replace_file(temp_path, missing_file_path, digest)
+        if duplicates:
+            await self.place_duplicates(self.relative_path(missing_file_path), digest, duplicates)
 
-    async def handle_modified_file(self, actual_file_path: str, expected_md5: str):
+    async def handle_server_file_delta(self):
         """
-        delete the current file and request the new file from server
+        handle a block delta the server sent on our request. it is applied to our current copy of the file,
+        off the event loop
         """
-        logger.info(f"MD5 mismatch for {actual_file_path}: Expected {expected_md5}")
-        with self.disable_observer():
-            os.unlink(os.path.join(self.shared_dir_path, actual_file_path))
+        file_path = await get_local_file_path(self.reader, self.shared_dir_path.encode())
+        block_size = struct.unpack(">I", await self.reader.readexactly(4))[0]
+        temp_dir = get_temp_dir(self.shared_dir_path)
+        delta_path, _ = await receive_file_content(self.reader, temp_dir)
 
-        await self.handle_missing_file(actual_file_path, expected_md5)
+        try:
+            if file_path not in self.file_requests.keys():
+                logger.warning(f"{file_path} not in file requests {self.file_requests.keys()}")
+                return
+
+            expected_digest = self.file_requests[file_path]
+            relative_path = os.path.relpath(file_path.decode(), self.shared_dir_path)
+            if not os.path.isfile(file_path):
+                logger.info(f"{file_path} was removed, request the whole file")
+                await self.handle_missing_file(relative_path, expected_digest.decode())
+                return
+
+            fd, temp_path = tempfile.mkstemp(dir=temp_dir)
+            os.close(fd)
+            digest = await asyncio.get_running_loop().run_in_executor(None, patch_into, file_path, block_size,
+                                                                      delta_path, temp_path, self.digest_algorithm)
+
+            if digest.encode() != expected_digest:
+                logger.info(f"the delta of {file_path} does not match our copy, request the whole file")
+                os.unlink(temp_path)
+                await self.handle_missing_file(relative_path, expected_digest.decode())
+                return
+
+            self.file_requests.pop(file_path)
+            logger.info(f"patched {file_path}")
+            self.replace_file(temp_path, file_path, digest)
+        finally:
+            os.unlink(delta_path)
+
+    async def handle_signatures(self):
+        """
+        the server sent the signatures of its copy of a file we modified. send only a block delta,
+        or the whole file if the server has no copy. the delta is generated off the event loop
+        """
+        file_path = await get_local_file_path(self.reader, self.shared_dir_path.encode())
+        base_digest = (await get_string(self.reader)).decode()
+        block_size, signatures = unpack_signatures(await get_long_string(self.reader))
+        relative_path = os.path.relpath(file_path, self.shared_dir_path.encode())
+
+        if not os.path.isfile(file_path):
+            logger.info(f"{file_path} was removed, no need to send it")
+            self.edit_batcher.signatures_answered(relative_path.decode())
+            return
+
+        if not base_digest or not signatures:
+            await self.connection.send(UserEditMessage(UserEditTypes.MODIFY, relative_path, file_path))
+            self.edit_batcher.signatures_answered(relative_path.decode())
+            return
+
+        fd, delta_path = tempfile.mkstemp(dir=get_temp_dir(self.shared_dir_path))
+        os.close(fd)
+        try:
+            target_digest = await asyncio.get_running_loop().run_in_executor(
+                None, write_delta, file_path, block_size, signatures, delta_path, self.digest_algorithm)
+
+            if target_digest == base_digest:
+                logger.debug(f"{file_path} is the same as the copy of the server")
+            else:
+                await self.connection.send(UserEditMessage(UserEditTypes.PATCH, relative_path, delta_path,
+                                                           base_digest=base_digest, target_digest=target_digest,
+                                                           block_size=block_size))
+            self.edit_batcher.signatures_answered(relative_path.decode())
+        finally:
+            os.unlink(delta_path)
+
+    async def handle_modified_file(self, actual_file_path: str, expected_digest: str):
+        """
+        request the new file from server. a big file is kept and only a block delta is requested,
+        a small one is deleted and requested again
+        """
+        logger.info(f"digest mismatch for {actual_file_path}: Expected {expected_digest}")
+        full_path = os.path.join(self.shared_dir_path, actual_file_path)
+        if os.path.getsize(full_path) >= DELTA_MIN_SIZE:
+            block_size, signatures = await asyncio.get_running_loop().run_in_executor(None, compute_signatures,
+                                                                                      full_path)
+            self.file_requests[full_path.encode()] = expected_digest.encode()
+            await self.connection.send(
+                UserDeltaRequestMessage(actual_file_path, expected_digest, pack_signatures(block_size, signatures))
+            )
+            return
+
+        await self.remove_file(full_path)
+
+        self.queue_fetch(actual_file_path, expected_digest)
+
+    async def request_files(self, fetches: dict[str, str], updates: dict[str, str]):
+        """
+        request the files that are missing locally, and the new content of the files that differ.
+        the whole files are queued and requested in bulk
+        """
+        for relative_path, expected_digest in fetches.items():
+            if not self.place_held(relative_path, expected_digest) and \
+                    not await self.copy_local(relative_path, expected_digest):
+                self.queue_fetch(relative_path, expected_digest)
+        for relative_path, expected_digest in updates.items():
+            if not self.place_held(relative_path, expected_digest) and \
+                    not await self.copy_local(relative_path, expected_digest):
+                await self.handle_modified_file(relative_path, expected_digest)
+        self.request_queued_files()
 
     async def verify_remote_files(self, directory_dict: dict[str: str]):
         """
         make sure that all the remote files are equal to the local files. if a file is missing or changed,
-        handle it.
+        handle it. the local digests come from the index, only files whose stat changed are hashed again
         """
         logger.debug("verifying that all remote files are equal to local")
-        for file_path, expected_md5 in directory_dict.items():
-            actual_file_path = os.path.join(self.shared_dir_path, file_path)
-            logger.info(f"verifying {actual_file_path}")
+        await asyncio.get_running_loop().run_in_executor(None, self.index.update_files, list(directory_dict))
+        fetches = {}
+        updates = {}
+        for relative_path, expected_digest in directory_dict.items():
+            entry = self.index.files.get(relative_path)
+            if entry is None:
+                fetches[relative_path] = expected_digest
+            elif entry.digest != expected_digest:
+                updates[relative_path] = expected_digest
+        await self.request_files(fetches, updates)
 
-            if not os.path.exists(actual_file_path):
-                await self.handle_missing_file(os.path.relpath(actual_file_path, self.shared_dir_path), expected_md5)
-                continue
+    async def execute_plan(self, plan: SyncPlan):
+        """
+        remove the redundant paths and create the missing directories, off the event loop. all these changes
+        are registered with the observer handler at once, before the first one is made. the removed files
+        whose content is fetched for another path are kept for it
+        """
+        removed_files = plan.deletes + [path for directory in plan.rmtrees for path in self.indexed_under(directory)[0]]
+        await self.hold_files(removed_files, set(plan.fetches.values()) | set(plan.updates.values()))
+        self.expected_changes.expect_all(
+            [(os.path.join(self.shared_dir_path, path), ABSENT) for path in plan.deletes + plan.rmtrees] +
+            [(os.path.join(self.shared_dir_path, path), DIRECTORY) for path in plan.mkdirs])
+        await asyncio.get_running_loop().run_in_executor(None, make_plan_changes, self.shared_dir_path, plan)
 
-            actual_md5 = calculate_file_md5(actual_file_path)
-            if actual_md5 != expected_md5:
-                await self.handle_modified_file(os.path.relpath(actual_file_path, self.shared_dir_path), expected_md5)
-                continue
+        for relative_path in plan.deletes + plan.rmtrees:
+            self.index.remove(relative_path)
+        for relative_path in plan.mkdirs:
+            self.index.add_directory(relative_path)
 
-            logger.info(f"file verified: {actual_file_path}")
+    async def reconcile(self, file_to_hash: dict[str, str], directories: list[str]):
+        """
+        make the local folder match the full manifest of the server. the server sent only the part of the
+        folder we subscribed to, so our files outside of it are left as they are. the ignored paths are not
+        in our index, and the ones the server still has are neither fetched nor removed
+        """
+        # a full walk that hashes only the files that changed since the index was saved
+        await asyncio.get_running_loop().run_in_executor(None, self.index.refresh)
+        file_to_hash = {path: digest for path, digest in file_to_hash.items() if not self.sync_ignore.is_ignored(path)}
+        directories = {path for path in directories if not self.sync_ignore.is_ignored(path, is_dir=True)}
+        plan = plan_sync(self.subscription.filter_files(self.index.file_to_hash()),
+                         self.subscription.filter_directories(self.index.directories), file_to_hash, directories)
+        try:
+            await self.execute_plan(plan)
+            await self.request_files(plan.fetches, plan.updates)
+        finally:
+            await self.release_held()
 
-    async def verify_local_files(self, directory_dict: dict[str: str]):
+    def request_tree_nodes(self, directories: list[str]):
+        for start in range(0, len(directories), TREE_REQUEST_SIZE):
+            self.tree_requests += 1
+            self.connection.post(UserTreeRequestMessage(directories[start:start + TREE_REQUEST_SIZE]))
+
+    async def handle_tree_root(self):
         """
-        make sure that all the local files exist on the remote folder
+        the server sent the root hash of its merkle tree instead of the whole manifest. we walk down only
+        into the directories whose hashes differ from ours
         """
-        logger.debug("verifying no redundant local files")
-        paths = [Path(file_path) for file_path in directory_dict.keys()]
-        for root, _, files in os.walk(self.shared_dir_path):
-            for curr_file in files:
-                full_path = os.path.join(root, curr_file)
-                relative_path = os.path.relpath(full_path, self.shared_dir_path)
-                same_paths = [path for path in paths if path == Path(relative_path)]
-                if len(same_paths) == 0:
-                    logger.info(f"File exists locally but not in remote: {relative_path}")
-                    with self.disable_observer():
-                        os.unlink(full_path)
+        version = struct.unpack(">Q", await self.reader.readexactly(VERSION_FIELD_LENGTH))[0]
+        root_hash = (await self.reader.readexactly(digest_length(self.digest_algorithm) // 2)).hex()
+        # the walk finds the interrupted requests anyway
+        self.resuming = False
+        self.interrupted_requests = {}
+        if self.manifest_version == version:
+            return
 
-    async def verify_directory_contents(self, directory_dict: dict[str: str]):
-        await asyncio.gather(
-            self.verify_local_files(directory_dict),
-            self.verify_remote_files(directory_dict)
-        )
+        loop = asyncio.get_running_loop()
+        # a full walk that hashes only the files that changed since the index was saved
+        await loop.run_in_executor(None, self.index.refresh)
+        local_root_hash = await loop.run_in_executor(None, self.index.tree.hash)
+        # the deltas that follow are applied while we walk down the tree
+        self.manifest_version = version
+        self.sync_requested = False
+        if local_root_hash == root_hash:
+            logger.info("the folder is the same as the remote folder")
+            self.index.save()
+            self.save_resume_state()
+            return
+
+        self.request_tree_nodes([ROOT])
 
-    async def verify_local_directories(self, directories: list[str]):
+    def compare_tree_node(self, directory: str, children: dict[str, tuple[bool, str]], plan: SyncPlan,
+                          subdirectories: list[str]):
         """
-        make sure all local directories appear remotely
+        add to the plan what makes the children of the directory match the remote ones, and the
+        sub directories that differ to the directories that are requested next. the ignored children are
+        skipped
         """
-        for root, dirs, _ in os.walk(self.shared_dir_path):
-            for curr_dir in dirs:
-                full_path = os.path.join(root, curr_dir)
-                relative_path = os.path.relpath(full_path, self.shared_dir_path)
-                if relative_path not in directories:
-                    with self.disable_observer():
-                        rmtree(full_path)
+        local_children = self.index.tree.children.get(directory, {})
+        for name, (is_dir, digest) in children.items():
+            relative_path = join_path(directory, name)
+            if self.sync_ignore.is_ignored(relative_path, is_dir):
+                continue
+            local_digest = local_children.get(name, ABSENT_CHILD)
+            if is_dir:
+                if local_digest is not None:
+                    # the directory is missing, or we have a file in its place
+                    if local_digest is not ABSENT_CHILD:
+                        plan.deletes.append(relative_path)
+                    plan.mkdirs.append(relative_path)
+                    subdirectories.append(relative_path)
+                elif self.index.tree.hash(relative_path) != digest:
+                    subdirectories.append(relative_path)
+            elif local_digest is ABSENT_CHILD:
+                plan.fetches[relative_path] = digest
+            elif local_digest is None:
+                plan.rmtrees.append(relative_path)
+                plan.fetches[relative_path] = digest
+            elif local_digest != digest:
+                plan.updates[relative_path] = digest
+
+        for name in local_children.keys() - children.keys():
+            relative_path = join_path(directory, name)
+            if local_children[name] is None:
+                plan.rmtrees.append(relative_path)
+            else:
+                plan.deletes.append(relative_path)
+
+    async def handle_tree_nodes(self):
+        nodes = decode_nodes(await self.read_payload(), digest_length(self.digest_algorithm) // 2)
+        self.tree_requests -= 1
+
+        plan = SyncPlan()
+        subdirectories = []
+        for directory, children in nodes:
+            self.compare_tree_node(directory, children, plan, subdirectories)
+        logger.debug(f"tree nodes of {len(nodes)} directories: {plan}")
+        try:
+            await self.execute_plan(plan)
+            await self.request_files(plan.fetches, plan.updates)
+        finally:
+            await self.release_held()
+        self.request_tree_nodes(subdirectories)
+        if self.tree_requests == 0:
+            logger.info("the walk down the merkle tree is done")
+            self.index.save()
+            self.save_resume_state()
 
     async def verify_remote_directories(self, directories: list[str]):
         """
@@ -150,85 +756,302 @@ class SharedFolderClient:
         for folder in directories:
             actual_path = os.path.join(self.shared_dir_path, folder)
             if not os.path.exists(actual_path):
-                with self.disable_observer():
-                    os.mkdir(actual_path)
+                self.make_directories(actual_path)
             elif not os.path.isdir(actual_path):
-                with self.disable_observer():
-                    os.unlink(actual_path)
-                    os.mkdir(actual_path)
+                await self.remove_file(actual_path)
+                self.make_directories(actual_path)
             else:
                 logger.info(f"directory {actual_path} is verified")
 
-    async def verify_directories(self, directories: list[str]):
-        await asyncio.gather(
-            self.verify_remote_directories(directories),
-            self.verify_local_directories(directories)
-        )
+    async def read_payload(self) -> bytes:
+        """
+        read the payload of a sync or a delta message, it may be compressed
+        """
+        codec = Codec(struct.unpack(">B", await self.reader.readexactly(1))[0])
+        data = await self.reader.readexactly(MESSAGE_LENGTH_FIELD_LENGTH)
+        data = await self.reader.readexactly(struct.unpack(">Q", data)[0])
+        return await decompress_payload(codec, data)
 
     async def handle_sync(self):
         logger.info("handle server sync message")
-        data = await self.reader.readexactly(MESSAGE_LENGTH_FIELD_LENGTH)
-        data = await self.reader.readexactly(struct.unpack(">H", data)[0])
+        version = struct.unpack(">Q", await self.reader.readexactly(VERSION_FIELD_LENGTH))[0]
+        data = await self.read_payload()
+        self.resuming = False
+        self.interrupted_requests = {}
+
+        if self.manifest_version == version:
+            return
+
+        manifest = EncodedManifest(data)
+        logger.debug(f"the manifest has {manifest.file_count} files and {manifest.directory_count} directories")
+        directories = list(manifest.directories())
+        file_to_hash = await asyncio.get_running_loop().run_in_executor(None, manifest.file_to_hash)
+        await self.reconcile(file_to_hash, directories)
+        self.manifest_version = version
+        self.sync_requested = False
+        self.index.save()
+        self.save_resume_state()
+
+    async def remove_local_path(self, relative_path: str):
+        """
+        remove a file or a directory that was removed from the remote folder. the requests for the files
+        under it will not be answered with their content, they are forgotten
+        """
+        full_path = os.path.join(self.shared_dir_path, relative_path)
+        prefix = os.path.join(full_path, "").encode()
+        for requested in [path for path in self.file_requests if path == full_path.encode() or path.startswith(prefix)]:
+            del self.file_requests[requested]
+        if os.path.isdir(full_path):
+            await self.remove_directory(full_path)
+        elif os.path.lexists(full_path):
+            await self.remove_file(full_path)
+
+    async def apply_delta(self, delta: ManifestDelta):
+        """
+        apply only the changed paths. the moves come first and then the removals, so a path that was
+        replaced by a directory or by a file is handled correctly. a removed file whose content was added
+        under another path is moved there instead of being fetched
+        """
+        directories = set(delta.directories)
+        for source, destination in delta.moved:
+            await self.move_local_path(source, destination, destination in directories)
+
+        needed = set()
+        for relative_path, digest in delta.files.items():
+            entry = self.index.files.get(relative_path)
+            if entry is None or entry.digest != digest:
+                needed.add(digest)
+        removed_files = [path for relative_path in delta.removed for path in self.indexed_under(relative_path)[0]]
+        if needed and removed_files:
+            await asyncio.get_running_loop().run_in_executor(None, self.index.update_files, removed_files)
+            await self.hold_files(removed_files, needed)
+
+        try:
+            for relative_path in delta.removed:
+                logger.info(f"{relative_path} was removed from the remote folder")
+                await self.remove_local_path(relative_path)
+
+            await self.verify_remote_directories(delta.directories)
+            await self.verify_remote_files(delta.files)
+        finally:
+            await self.release_held()
+
+    def without_local_changes(self, delta: ManifestDelta) -> ManifestDelta:
+        """
+        the delta without the paths we changed ourselves and did not get acknowledged. the server replayed
+        the journal before it received these changes, they would be undone otherwise
+        """
+        changed = self.edit_batcher.changed_paths()
+        if not changed:
+            return delta
+
+        def is_changed(relative_path: str) -> bool:
+            prefix = relative_path + os.sep
+            path = relative_path
+            while path:
+                if path in changed:
+                    return True
+                path = os.path.dirname(path)
+            return any(changed_path.startswith(prefix) for changed_path in changed)
+
+        return ManifestDelta(delta.base_version, delta.version,
+                             {path: digest for path, digest in delta.files.items() if not is_changed(path)},
+                             [path for path in delta.removed if not is_changed(path)],
+                             [path for path in delta.directories if not is_changed(path)],
+                             [[source, destination] for source, destination in delta.moved
+                              if not is_changed(source) and not is_changed(destination)])
+
+    async def resume(self, delta: ManifestDelta):
+        """
+        apply the deltas the server replayed from its journal, and request again the files we did not
+        receive before the connection was lost. if our folder changed while we were not connected, we walk
+        down the merkle tree instead, to find everything that differs from the remote folder. the tree covers
+        the whole folder, so with a subscription we ask for the manifest of our part instead
+        """
+        loop = asyncio.get_running_loop()
+        index_version = self.index.version
+        await loop.run_in_executor(None, self.index.refresh)
+        changed_offline = self.index.version != index_version
+        logger.info(f"resume from version {delta.base_version} to {delta.version}")
+        await self.apply_delta(self.without_local_changes(delta))
+        self.manifest_version = delta.version
+        interrupted, self.interrupted_requests = self.interrupted_requests, {}
+        if changed_offline:
+            logger.info("the folder changed while we were not connected, compare it with the remote folder")
+            if self.subscription.is_everything():
+                self.request_tree_nodes([ROOT])
+            else:
+                # the manifest has the version we reached, it must not be skipped as one we already have
+                self.manifest_version = None
+                self.sync_requested = True
+                await self.connection.send(UserSyncRequestMessage())
+            return
+
+        await self.verify_remote_files({path: digest for path, digest in interrupted.items()
+                                        if os.path.join(self.shared_dir_path, path).encode() not in
+                                        self.file_requests})
+
+    async def handle_delta(self):
+        logger.info("handle server delta message")
+        base_version, version = struct.unpack(">QQ", await self.reader.readexactly(2 * VERSION_FIELD_LENGTH))
+        data = await self.read_payload()
 
-        curr_hash = calculate_md5sum(data)
-        if self.last_sync_hash == curr_hash:
+        if self.resuming and base_version == self.manifest_version:
+            self.resuming = False
+            await self.resume(ManifestDelta.from_json(base_version, version, data.decode()))
             return
 
-        self.last_sync_hash = curr_hash
-        file_to_hash, directories = json.loads(data.decode())
-        logger.debug(f"file to hash: {file_to_hash}")
-        logger.debug(f"directories: {directories}")
-        await self.verify_directory_contents(file_to_hash)
-        await self.verify_directories(directories)
+        if self.manifest_version is not None and version <= self.manifest_version:
+            logger.debug(f"delta to version {version} is already covered by version {self.manifest_version}")
+            return
+
+        if self.manifest_version != base_version:
+            logger.warning(f"missed the changes from version {self.manifest_version} to {base_version}")
+            if not self.sync_requested:
+                self.sync_requested = True
+                await self.connection.send(UserSyncRequestMessage())
+            return
+
+        await self.apply_delta(ManifestDelta.from_json(base_version, version, data.decode()))
+        self.manifest_version = version
 
     async def client_flow(self):
         """
-        wait for a message from the server and react accordingly
+        wait for the next message from the server and react accordingly. the writer task of the connection
+        sends our messages in the meantime
         """
-        async with self.lock:
-            try:
-                data = await asyncio.wait_for(self.reader.readexactly(MESSAGE_TYPE_LENGTH), timeout=0.3)
-            except asyncio.TimeoutError:
-                return
+        data = await self.reader.readexactly(MESSAGE_TYPE_LENGTH)
+        message_type = struct.unpack(">B", data)[0]
+        match message_type:
+            case MessageType.SERVER_SYNC.value:
+                await self.handle_sync()
+            case MessageType.SERVER_DELTA.value:
+                await self.handle_delta()
+            case MessageType.SERVER_FILE.value:
+                await self.handle_server_file()
+            case MessageType.SERVER_TREE_ROOT.value:
+                await self.handle_tree_root()
+            case MessageType.SERVER_TREE_NODES.value:
+                await self.handle_tree_nodes()
+            case MessageType.SERVER_FILE_UNAVAILABLE.value:
+                file_path = (await get_string(self.reader)).decode()
+                # the file was changed or removed, the change is on its way in a delta. the server has the
+                # content under no other path, so the paths that wait for the same content get it in a delta too
+                logger.info(f"the server no longer has the requested version of {file_path}")
+                self.fetch_finished(self.file_requests.get(os.path.join(self.shared_dir_path, file_path).encode()))
+                self.fetch_answered()
+            case MessageType.SERVER_SIGNATURES.value:
+                await self.handle_signatures()
+            case MessageType.SERVER_FILE_DELTA.value:
+                await self.handle_server_file_delta()
+            case MessageType.SERVER_BATCH_ACK.value:
+                batch_id = struct.unpack(">Q", await self.reader.readexactly(8))[0]
+                self.edit_batcher.acknowledge(batch_id)
+            case _:
+                logger.error(f"unrecognizable message code {message_type}")
 
-            message_type = struct.unpack(">B", data)[0]
-            match message_type:
-                case MessageType.SERVER_SYNC.value:
-                    await self.handle_sync()
-                case MessageType.SERVER_FILE.value:
-                    await self.handle_server_file()
-                case _:
-                    logger.error(f"unrecognizable message code {message_type}")
+    async def handshake(self):
+        """
+        send our capabilities to the server and use the compression codec and the digest algorithm it chose
+        """
+        hello = {"compression": self.compression_codecs, "digests": self.digest_algorithms, "merkle": True}
+        if not self.subscription.is_everything():
+            hello["subscription"] = self.subscription.to_json()
+        resume_state = self.resume_point()
+        self.reset_session()
+        self.partials = await asyncio.get_running_loop().run_in_executor(None, self.scan_partials)
+        if resume_state is not None:
+            hello["resume"] = resume_state
+        await UserHelloMessage(hello).send(self.writer)
+        data = await self.reader.readexactly(MESSAGE_TYPE_LENGTH)
+        message_type = MessageType(struct.unpack(">B", data)[0])
+        if message_type != MessageType.SERVER_HELLO:
+            raise RuntimeError(f"expected {MessageType.SERVER_HELLO.name} but received {message_type.name}")
+
+        capabilities = json.loads((await get_string(self.reader)).decode())
+        codec = Codec[capabilities["compression"].upper()]
+        logger.info(f"the server chose to compress with {codec.name}")
+        self.digest_algorithm = capabilities.get("digest", LEGACY_DIGEST)
+        if self.digest_algorithm not in self.digest_algorithms:
+            raise RuntimeError(f"the server uses the digest {self.digest_algorithm} that we do not support")
+        self.expected_changes.algorithm = self.digest_algorithm
+        self.journal_id = capabilities.get("journal")
+        # the server replays the journal from this version if it still has it, otherwise we sync from scratch
+        self.resuming = resume_state is not None and resume_state.get("journal") == self.journal_id
+        self.manifest_version = resume_state["version"] if self.resuming else None
+        if self.index is None or self.index.algorithm != self.digest_algorithm:
+            self.index = ManifestIndex(self.shared_dir_path,
+                                       os.path.join(self.shared_dir_path, METADATA_DIR_NAME, CLIENT_INDEX_NAME),
+                                       algorithm=self.digest_algorithm, ignore=self.sync_ignore,
+                                       hash_options=self.hash_options)
+            self.index.load()
+            self.edit_batcher.index = self.index
+        self.connection = Connection(self.writer, Compressor(codec, self.compression_levels.get(codec.name.lower())))
 
-    def start_new_observer(self, my_loop):
+    def start_observer(self, my_loop):
         """
-        start an observer that will call a handling function on changes made to the directory
+        start an observer that will call a handling function on changes made to the directory. it keeps
+        running when the connection is lost, the events of our own changes are dropped by the handler
         """
-        logger.debug("start new observer")
+        logger.debug("start observer")
         self.observer = Observer()
-        self.event_handler = MyHandler(self.reader, self.writer, self.shared_dir_path, self.lock, my_loop)
+        self.event_handler = MyHandler(self.edit_batcher, self.shared_dir_path, my_loop, self.expected_changes)
         self.observer.schedule(self.event_handler, self.shared_dir_path, recursive=True)
         self.observer.start()
 
+    async def session(self, my_loop) -> bool:
+        """
+        one connection to the server. the changes we made while we were not connected are sent first, then
+        we follow the server until the connection is lost. return True if the handshake succeeded
+        """
+        self.connection = None
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        try:
+            await self.handshake()
+            self.edit_batcher.attach(self.connection)
+            await self.client_flow()
+            if self.observer is None:
+                self.start_observer(my_loop)
+
+            while True:
+                await self.client_flow()
+        except (asyncio.IncompleteReadError, ConnectionError) as error:
+            logger.error(f"lost the connection to the server: {error!r}")
+        finally:
+            self.edit_batcher.detach()
+            if self.connection is not None:
+                await self.connection.close()
+            self.writer.close()
+        return self.connection is not None
+
     async def client(self):
         """
         connect to the server. monitor the synced folder, send edit requests to the server accordingly.
-        receive sync messages from the server and edit the folder to match it.
+        receive sync messages from the server and edit the folder to match it. when the connection is lost
+        we connect again, after a delay that doubles with every failed attempt, with jitter so the clients
+        of a server that restarted do not all come back at once
         """
         my_loop = asyncio.get_running_loop()
-        self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
-        await self.client_flow()
-        self.start_new_observer(my_loop)
-
-        while True:
-            client_task = asyncio.create_task(self.client_flow())
-            await client_task
-            if client_task.exception():
-                logger.error(client_task.exception())
-                if self.observer.is_alive:
-                    self.observer.stop()
-                    self.observer.join()
-                break
-
-            # while we sleep the observer is running
-            await asyncio.sleep(0.1)
+        delay = self.reconnect_delay
+        try:
+            while True:
+                try:
+                    if await self.session(my_loop):
+                        delay = self.reconnect_delay
+                except OSError as error:
+                    logger.error(f"failed to connect to the server: {error!r}")
+
+                if self.index is not None:
+                    self.index.save()
+                    self.save_resume_state()
+                wait = random.uniform(delay / 2, delay)
+                logger.info(f"connect again in {wait:.1f} seconds")
+                await asyncio.sleep(wait)
+                delay = min(delay * 2, self.max_reconnect_delay)
+        finally:
+            if self.observer is not None and self.observer.is_alive():
+                self.observer.stop()
+                self.observer.join()
+            if self.index is not None:
+                self.index.save()
+                self.save_resume_state()
@@ -0,0 +1,115 @@
+import asyncio
+import lzma
+import math
+import zlib
+from collections import Counter
+from enum import Enum
+
+from shared_folder_opu.logger_singleton import SingletonLogger
+
+logger = SingletonLogger.get_logger()
+
+DEFAULT_CODECS = ["zlib", "lzma"]
+DEFAULT_LEVELS = {"zlib": 6, "lzma": 1}
+# payloads smaller than this are not worth the cpu
+COMPRESSION_MIN_SIZE = 1024
+ENTROPY_SAMPLE_SIZE = 4096
+# bits per byte. data above it is most likely already compressed (archives, images, video)
+MAX_ENTROPY = 7.5
+
+
+class Codec(Enum):
+    NONE = 0
+    ZLIB = 1
+    LZMA = 2
+
+
+def sample_entropy(sample: bytes) -> float:
+    """
+    the shannon entropy of the sample in bits per byte
+    """
+    if not sample:
+        return 0.0
+
+    length = len(sample)
+    return -sum(count / length * math.log2(count / length) for count in Counter(sample).values())
+
+
+def choose_codec(offered: list[str], preferred: list[str]) -> Codec:
+    """
+    choose the first codec in our preference list that the other side offered
+    """
+    for name in preferred:
+        if name in offered and name.upper() in Codec.__members__:
+            return Codec[name.upper()]
+    return Codec.NONE
+
+
+def decompressobj(codec: Codec):
+    match codec:
+        case Codec.ZLIB:
+            return zlib.decompressobj()
+        case Codec.LZMA:
+            return lzma.LZMADecompressor()
+        case _:
+            raise RuntimeError(f"can not decompress codec {codec.name}")
+
+
+def decompress(codec: Codec, data: bytes) -> bytes:
+    if codec == Codec.NONE:
+        return data
+    return decompressobj(codec).decompress(data)
+
+
+class Compressor:
+    """
+    the compression that was negotiated for a connection
+    """
+
+    def __init__(self, codec: Codec = Codec.NONE, level: int = None, min_size: int = COMPRESSION_MIN_SIZE,
+                 max_entropy: float = MAX_ENTROPY):
+        self.codec = codec
+        self.level = level if level is not None else DEFAULT_LEVELS.get(codec.name.lower())
+        self.min_size = min_size
+        self.max_entropy = max_entropy
+
+    def should_compress(self, sample: bytes, size: int) -> bool:
+        """
+        skip small payloads and payloads that look compressed already
+        """
+        if self.codec == Codec.NONE or size < self.min_size:
+            return False
+        return sample_entropy(sample[:ENTROPY_SAMPLE_SIZE]) <= self.max_entropy
+
+    def compressobj(self):
+        match self.codec:
+            case Codec.ZLIB:
+                return zlib.compressobj(self.level)
+            case Codec.LZMA:
+                return lzma.LZMACompressor(preset=self.level)
+            case _:
+                raise RuntimeError(f"can not compress with codec {self.codec.name}")
+
+    def compress(self, data: bytes) -> bytes:
+        compressor = self.compressobj()
+        return compressor.compress(data) + compressor.flush()
+
+    async def compress_payload(self, data: bytes) -> tuple[Codec, bytes]:
+        """
+        compress a whole payload off the event loop. return the codec that was used and the data
+        """
+        if not self.should_compress(data, len(data)):
+            return Codec.NONE, data
+
+        compressed = await asyncio.get_running_loop().run_in_executor(None, self.compress, data)
+        if len(compressed) >= len(data):
+            return Codec.NONE, data
+
+        logger.debug(f"compressed {len(data)} bytes to {len(compressed)} with {self.codec.name}")
+        return self.codec, compressed
+
+
+async def decompress_payload(codec: Codec, data: bytes) -> bytes:
+    if codec == Codec.NONE:
+        return data
+    return await asyncio.get_running_loop().run_in_executor(None, decompress, codec, data)
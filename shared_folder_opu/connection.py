@@ -0,0 +1,135 @@
+import asyncio
+import collections
+import contextlib
+from asyncio import StreamWriter
+
+from shared_folder_opu.compression import Compressor
+from shared_folder_opu.logger_singleton import SingletonLogger
+from shared_folder_opu.protocol import Message
+
+logger = SingletonLogger.get_logger()
+
+
+class Connection:
+    """
+    the sending side of a connection. messages are queued and written one after another by a writer task,
+    so a message that is written in several parts is never interleaved with another one, and the task that
+    reads from the connection never waits for a slow peer unless it asks to. payloads are compressed with
+    the codec that was negotiated in the handshake.
+    if max_backlog is set, a peer that falls that many messages behind is disconnected.
+    """
+
+    def __init__(self, writer: StreamWriter, compressor: Compressor = None, max_backlog: int = None):
+        self.writer = writer
+        self.compressor = compressor or Compressor()
+        self.max_backlog = max_backlog
+        self.queue = collections.deque()  # (message, future of the sender or None)
+        self.ready = asyncio.Event()
+        self.writer_task = None
+        self.closed = False
+
+    @property
+    def backlog(self) -> int:
+        return len(self.queue)
+
+    def start(self):
+        if self.writer_task is None:
+            self.writer_task = asyncio.create_task(self.run())
+
+    def _enqueue(self, message: Message, done: asyncio.Future = None) -> bool:
+        if self.closed:
+            return False
+
+        # drop queued messages that this one makes stale. a message somebody waits for is always sent
+        if any(waiter is None and message.supersedes(queued) for queued, waiter in self.queue):
+            self.queue = collections.deque((queued, waiter) for queued, waiter in self.queue
+                                           if waiter is not None or not message.supersedes(queued))
+
+        if self.max_backlog is not None and len(self.queue) >= self.max_backlog:
+            logger.warning(f"the peer is {len(self.queue)} messages behind, disconnect it")
+            self.abort()
+            return False
+
+        self.start()
+        self.queue.append((message, done))
+        self.ready.set()
+        return True
+
+    def post(self, message: Message):
+        """
+        queue the message without waiting for it to be written
+        """
+        self._enqueue(message)
+
+    async def send(self, message: Message):
+        """
+        queue the message and wait until it was written. use it when the message streams a file that
+        is deleted after it was sent
+        """
+        done = asyncio.get_running_loop().create_future()
+        if not self._enqueue(message, done):
+            raise ConnectionResetError("the connection is closed")
+        await done
+
+    @staticmethod
+    def _finish(done: asyncio.Future, error: BaseException = None):
+        if done is None or done.done():
+            return
+
+        if error is None:
+            done.set_result(None)
+        else:
+            done.set_exception(error)
+
+    async def run(self):
+        """
+        the writer task. wait for the next queued message and write it
+        """
+        while True:
+            while not self.queue:
+                self.ready.clear()
+                await self.ready.wait()
+
+            message, done = self.queue.popleft()
+            try:
+                await message.send(self.writer, self.compressor)
+            except FileNotFoundError as error:
+                # the file was removed before we sent it, nothing was written
+                logger.warning(f"failed to send {message.__class__.__name__}: {error}")
+                self._finish(done, error)
+            except Exception as error:
+                logger.error(f"failed to write to the connection: {error}")
+                self._finish(done, error)
+                self.abort()
+                raise
+            else:
+                self._finish(done)
+
+    def _drop_queue(self):
+        while self.queue:
+            _, done = self.queue.popleft()
+            if done is not None and not done.done():
+                done.cancel()
+
+    def abort(self):
+        """
+        close the connection right away, without writing what is queued. the task that reads from the
+        connection sees it closed and cleans up
+        """
+        self.closed = True
+        self._drop_queue()
+        if self.writer_task is not None and self.writer_task is not asyncio.current_task():
+            self.writer_task.cancel()
+        self.writer.transport.abort()
+
+    async def close(self):
+        """
+        stop the writer task. messages that were not written yet are dropped
+        """
+        self.closed = True
+        if self.writer_task is not None:
+            self.writer_task.cancel()
+            with contextlib.suppress(asyncio.CancelledError, Exception):
+                await self.writer_task
+
+        self._drop_queue()
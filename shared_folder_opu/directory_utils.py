@@ -1,40 +1,76 @@
 import os
-import json
+import stat
+import tempfile
 
 from shared_folder_opu.logger_singleton import SingletonLogger
-from shared_folder_opu.general_utils import calculate_md5sum
+from shared_folder_opu.sync_ignore import SyncIgnore
 
 logger = SingletonLogger.get_logger()
 
+# hidden directory inside the shared folder that keeps our own metadata (snapshots, indexes).
+# it is never synced, so every walk over the shared folder skips it.
+METADATA_DIR_NAME = ".shared_folder"
+TEMP_DIR_NAME = "tmp"
 
-def calculate_file_md5(file_path: str):
+
+def _read_umask() -> int:
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+
+
+# the mode of a file we create, like open() gives it. the umask can only be read by setting it, so it is
+# read once, at startup
+NEW_FILE_MODE = 0o666 & ~_read_umask()
+
+
+def is_metadata_path(relative_path: str) -> bool:
+    return relative_path.split(os.sep, 1)[0] == METADATA_DIR_NAME
+
+
+def get_temp_dir(dir_path: str) -> str:
+    """
+    the directory for files that are still being received. it is on the same file system as the
+    shared folder, so a received file can be renamed to its place atomically
+    """
+    temp_dir = os.path.join(dir_path, METADATA_DIR_NAME, TEMP_DIR_NAME)
+    os.makedirs(temp_dir, exist_ok=True)
+    return temp_dir
+
+
+def place_file(temp_path: str, path: str | bytes):
+    """
+    rename a temporary file to its place. mkstemp creates files only the owner can access, so the file gets
+    the mode of the file it replaces, or the mode of a new file
+    """
+    try:
+        mode = stat.S_IMODE(os.stat(path).st_mode)
+    except FileNotFoundError:
+        mode = NEW_FILE_MODE
+    os.chmod(temp_path, mode)
+    os.replace(temp_path, path)
+
+
+def new_temp_file(dir_path: str) -> str:
     """
-    calculate md5sum of the file path
+    create an empty file in the temp directory and return its path, the caller removes it
     """
-    with open(file_path, 'rb') as file:
-        data = file.read()
-    return calculate_md5sum(data)
+    fd, temp_path = tempfile.mkstemp(dir=get_temp_dir(dir_path))
+    os.close(fd)
+    return temp_path
 
 
-def directory_to_json(dir_path: str):
+def walk_shared_folder(dir_path: str, ignore: SyncIgnore = None):
     """
-    create a json object of the shared folder. one dict is created for the dirs and one for the files.
+    os.walk over the shared folder that skips the metadata directory, and the paths the ignore file
+    ignores. an ignored directory is not entered at all
     """
-    file_to_hash = {}
-    directories = []
+    rules = ignore.current() if ignore is not None else None
     for root, dirs, files in os.walk(dir_path):
-        for directory in dirs:
-            full_path = os.path.join(root, directory)
-            relative_path = os.path.relpath(full_path, dir_path)
-            directories.append(relative_path)
-
-        for file_path in files:
-            full_path = os.path.join(root, file_path)
-            relative_path = os.path.relpath(full_path, dir_path)
-            md5sum = calculate_file_md5(full_path)
-            file_to_hash[relative_path] = md5sum
-
-    logger.debug(f"the files and their hashes: {file_to_hash}")
-    logger.debug(f"the directories are: {directories}")
-    directory_structure = (file_to_hash, directories)
-    return json.dumps(directory_structure, indent=4)
+        if root == dir_path and METADATA_DIR_NAME in dirs:
+            dirs.remove(METADATA_DIR_NAME)
+        if rules is not None and rules.rules:
+            relative_root = os.path.relpath(root, dir_path) if root != dir_path else ""
+            dirs[:] = [name for name in dirs if not rules.matches(os.path.join(relative_root, name), is_dir=True)]
+            files = [name for name in files if not rules.matches(os.path.join(relative_root, name))]
+        yield root, dirs, files
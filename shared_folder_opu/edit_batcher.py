@@ -0,0 +1,379 @@
+import asyncio
+import collections
+import itertools
+import os
+
+from shared_folder_opu.block_delta import DELTA_MIN_SIZE
+from shared_folder_opu.connection import Connection
+from shared_folder_opu.logger_singleton import SingletonLogger
+from shared_folder_opu.manifest import ManifestIndex
+from shared_folder_opu.protocol import UserEditMessage, UserEditTypes, UserBatchEditMessage, \
+    UserSignatureRequestMessage
+from shared_folder_opu.subscription import Subscription
+from shared_folder_opu.sync_ignore import SyncIgnore
+
+logger = SingletonLogger.get_logger()
+
+# the batch is sent when no change was made for this long
+EDIT_QUIET_WINDOW = 0.2
+# a folder that keeps changing is still sent at least this often
+MAX_BATCH_DELAY = 2.0
+MAX_BATCH_SIZE = 1000
+# the moves that were sent lately, the observer may report the moves under a moved directory after it was sent
+RECENT_MOVES = 64
+
+FILE = "file"
+DIRECTORY = "directory"
+
+
+def is_at_or_under(relative_path: str, directory: str) -> bool:
+    return relative_path == directory or relative_path.startswith(directory + os.sep)
+
+
+def moved_path(relative_path: str, source: str, destination: str) -> str:
+    return destination + relative_path[len(source):]
+
+
+class PendingChange:
+    """
+    what happened to a path since the last batch
+    """
+
+    def __init__(self, existed: bool):
+        # the path existed before the first event, so removing it must be sent to the server
+        self.existed = existed
+        # the old path must be removed before the new one is sent
+        self.removed = False
+        # FILE or DIRECTORY, or None if the path is only removed
+        self.kind = None
+
+
+class EditBatcher:
+    """
+    collect the local changes until the folder is quiet for quiet_window seconds, collapse the events of
+    each path (create, modify, modify is one upload, create and delete is nothing) and send them as one
+    batch. it runs on the event loop, the observer thread hands the events over with call_soon_threadsafe.
+    while there is no connection the changes are kept, and they are sent when the client connects again.
+    the index of the folder, when there is one, is used to recognize moves that were reported as a removal
+    and a creation. the changes outside the subscription and the changes of ignored paths are not sent.
+    """
+
+    def __init__(self, connection: Connection | None, shared_folder: str, quiet_window: float = EDIT_QUIET_WINDOW,
+                 max_delay: float = MAX_BATCH_DELAY, max_size: int = MAX_BATCH_SIZE, index: ManifestIndex = None,
+                 subscription: Subscription = None, ignore: SyncIgnore = None):
+        self.connection = connection
+        self.shared_folder = shared_folder
+        self.index = index
+        self.subscription = subscription or Subscription()
+        self.ignore = ignore or SyncIgnore(shared_folder)
+        self.quiet_window = quiet_window
+        self.max_delay = max_delay
+        self.max_size = max_size
+        self.pending: dict[str, PendingChange] = {}
+        # (source, destination) in the order they were made. the server renames the path, nothing is uploaded
+        self.moves: list[tuple[str, str]] = []
+        self.recent_moves = collections.deque(maxlen=RECENT_MOVES)
+        self.batch_ids = itertools.count(1)
+        self.unacknowledged: dict[int, list[str]] = {}  # batch id -> the paths it changed
+        self.unacknowledged_moves: dict[int, list[tuple[str, str]]] = {}
+        # the files whose signatures were requested and whose delta was not sent yet
+        self.awaiting_signatures: set[str] = set()
+        self.moved_away: set[str] = set()  # sources of paired moves whose removal was not reported yet
+        self._inodes = {}
+        self._inodes_version = None
+        self.timer = None
+        self.first_change_time = None
+
+    def is_synced(self, relative_path: str, is_dir: bool = False) -> bool:
+        """
+        whether the changes of the path are sent, it is called from the observer thread too
+        """
+        return self.subscription.matches(relative_path, is_dir) and not self.ignore.is_ignored(relative_path, is_dir)
+
+    def add(self, edit_type: UserEditTypes, relative_path: str, is_dir: bool = False, destination: str = None):
+        if edit_type != UserEditTypes.MOVE and not self.is_synced(relative_path, is_dir):
+            return
+
+        match edit_type:
+            case UserEditTypes.MOVE:
+                self.add_move(relative_path, destination, is_dir)
+                return
+            case UserEditTypes.CREATE | UserEditTypes.MODIFY:
+                change = self.pending.get(relative_path)
+                if change is None:
+                    change = self.pending[relative_path] = PendingChange(existed=edit_type != UserEditTypes.CREATE)
+                change.kind = DIRECTORY if is_dir else FILE
+            case UserEditTypes.DELETE:
+                if relative_path in self.moved_away:
+                    self.moved_away.discard(relative_path)
+                    return
+                # whatever was changed under the path is gone with it
+                prefix = relative_path + os.sep
+                for path in [path for path in self.pending if path.startswith(prefix)]:
+                    del self.pending[path]
+
+                change = self.pending.get(relative_path)
+                if change is None:
+                    change = self.pending[relative_path] = PendingChange(existed=True)
+                if not change.existed:
+                    logger.debug(f"{relative_path} was created and removed, nothing to send")
+                    del self.pending[relative_path]
+                else:
+                    change.removed = True
+                    change.kind = None
+
+        self.schedule()
+
+    def _is_implied_move(self, source: str, destination: str) -> bool:
+        """
+        the observer reports the move of every path under a moved directory too
+        """
+        for moved_source, moved_destination in itertools.chain(self.moves, self.recent_moves):
+            if source.startswith(moved_source + os.sep) and \
+                    destination == moved_path(source, moved_source, moved_destination):
+                return True
+        return False
+
+    def _add_contents(self, relative_path: str):
+        """
+        upload a directory with everything in it
+        """
+        self.add(UserEditTypes.CREATE, relative_path, is_dir=True)
+        for root, dirs, files in os.walk(os.path.join(self.shared_folder, relative_path)):
+            dirs[:] = [name for name in dirs
+                       if self.is_synced(os.path.relpath(os.path.join(root, name), self.shared_folder), True)]
+            for name in dirs:
+                self.add(UserEditTypes.CREATE, os.path.relpath(os.path.join(root, name), self.shared_folder), True)
+            for name in files:
+                self.add(UserEditTypes.MODIFY, os.path.relpath(os.path.join(root, name), self.shared_folder))
+
+    def add_move(self, source: str, destination: str, is_dir: bool):
+        """
+        a move is sent as is, so the server renames its copy. if the source itself changed since the last
+        batch, the server does not have it as it is, so the source is removed and the destination is uploaded
+        """
+        if self._is_implied_move(source, destination):
+            return
+
+        source_synced = self.is_synced(source, is_dir)
+        destination_synced = self.is_synced(destination, is_dir)
+        if not source_synced and not destination_synced:
+            return
+        if not (source_synced and destination_synced):
+            # a move into or out of the synced paths is a new path or a removal for the server
+            self.recent_moves.append((source, destination))
+            if source_synced:
+                self.add(UserEditTypes.DELETE, source, is_dir)
+            if destination_synced and is_dir:
+                self._add_contents(destination)
+            elif destination_synced:
+                self.add(UserEditTypes.MODIFY, destination)
+            return
+
+        parent = source
+        while parent:
+            if parent in self.pending or parent in self.awaiting_signatures:
+                logger.debug(f"{source} changed before it was moved, send it as a new {destination}")
+                self.add(UserEditTypes.DELETE, source)
+                if is_dir:
+                    self._add_contents(destination)
+                else:
+                    self.add(UserEditTypes.MODIFY, destination)
+                return
+            parent = os.path.dirname(parent)
+
+        # the destination is replaced, whatever happened to it before does not matter
+        for path in [path for path in self.pending if is_at_or_under(path, destination)]:
+            del self.pending[path]
+        # the changes under the source were made before the move, they are applied to the destination after it
+        for path in [path for path in self.pending if is_at_or_under(path, source)]:
+            self.pending[moved_path(path, source, destination)] = self.pending.pop(path)
+        self.moves.append((source, destination))
+        self.schedule()
+
+    def indexed_inodes(self) -> dict[int, str]:
+        """
+        inode -> path of the indexed files. it is built again only after the index changed
+        """
+        if self._inodes_version != self.index.version:
+            self._inodes = {entry.inode: relative_path for relative_path, entry in self.index.files.items()}
+            self._inodes_version = self.index.version
+        return self._inodes
+
+    def pair_moves(self, changes: dict[str, PendingChange]) -> list[tuple[str, str]]:
+        """
+        the observer reports a move as a removal and a creation when it does not see both sides, for example
+        when a file is moved into a directory that was just created, and the removal may come only after the
+        creation was sent. a new file with the inode of an indexed file that no longer exists is sent as a
+        move of it, and then as a change of the moved file, so a big file is sent as a block delta against
+        the moved copy and a small one is uploaded
+        """
+        if self.index is None:
+            return []
+        created = [relative_path for relative_path, change in changes.items()
+                   if change.kind == FILE and not change.existed]
+        if not created:
+            return []
+
+        inodes = self.indexed_inodes()
+        moves = []
+        for relative_path in created:
+            try:
+                source = inodes.get(os.stat(os.path.join(self.shared_folder, relative_path)).st_ino)
+            except FileNotFoundError:
+                continue
+            if source is None or source == relative_path or any(source == moved for moved, _ in moves) or \
+                    not self.is_synced(source) or os.path.lexists(os.path.join(self.shared_folder, source)):
+                continue
+
+            logger.debug(f"{relative_path} has the inode of the removed {source}, send it as a move")
+            changes[relative_path].existed = True
+            moves.append((source, relative_path))
+            if source in changes:
+                del changes[source]
+            else:
+                # the removal is reported later, the move already removed the path on the server
+                self.moved_away.add(source)
+        return moves
+
+    def attach(self, connection: Connection):
+        """
+        send the changes to a new connection. the batches the server did not acknowledge and the signature
+        requests that were not answered with a delta may have been lost with the previous connection, so their
+        paths are sent again, as they are now, together with the changes that were made while we were not connected
+        """
+        self.connection = connection
+        unacknowledged, self.unacknowledged = self.unacknowledged, {}
+        awaiting_signatures, self.awaiting_signatures = self.awaiting_signatures, set()
+        unacknowledged_moves, self.unacknowledged_moves = self.unacknowledged_moves, {}
+        # a move that was already applied is ignored by the server
+        self.moves = [move for batch_id in sorted(unacknowledged_moves) for move in unacknowledged_moves[batch_id]] + \
+            self.moves
+        for relative_path in sorted(awaiting_signatures.union(*unacknowledged.values())):
+            # where the path is now, after the moves that follow its change
+            for source, destination in self.moves:
+                if is_at_or_under(relative_path, source):
+                    relative_path = moved_path(relative_path, source, destination)
+            if relative_path in self.pending:
+                continue
+            change = self.pending[relative_path] = PendingChange(existed=True)
+            full_path = os.path.join(self.shared_folder, relative_path)
+            if os.path.isdir(full_path):
+                change.kind = DIRECTORY
+            elif os.path.lexists(full_path):
+                change.kind = FILE
+            else:
+                change.removed = True
+        if self.pending:
+            logger.info(f"send {len(self.pending)} changes that were made while we were not connected")
+        self.flush()
+
+    def detach(self):
+        """
+        the connection was lost, keep the changes until attach
+        """
+        self.connection = None
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+    def changed_paths(self) -> set[str]:
+        """
+        the paths whose local changes the server may not have applied yet
+        """
+        return set(self.pending).union(*self.unacknowledged.values(), self.awaiting_signatures, *self.moves,
+                                       *itertools.chain.from_iterable(self.unacknowledged_moves.values()))
+
+    def schedule(self):
+        """
+        wait for the folder to be quiet before sending, but do not wait forever
+        """
+        loop = asyncio.get_running_loop()
+        if len(self.pending) >= self.max_size:
+            self.flush()
+            return
+
+        if self.timer is not None:
+            if loop.time() - self.first_change_time >= self.max_delay:
+                return
+            self.timer.cancel()
+        else:
+            self.first_change_time = loop.time()
+        self.timer = loop.call_later(self.quiet_window, self.flush)
+
+    def flush(self):
+        """
+        send the collected changes. removals first, then the moves, then directories and then files, so
+        every path has its parent on the server. a removal under the destination of a move or above its
+        source was made after the move, so it is sent after the moves
+        """
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+        if self.connection is None:
+            return
+
+        changes, self.pending = self.pending, {}
+        moves, self.moves = self.moves, []
+        if not changes and not moves:
+            return
+
+        moves.extend(self.pair_moves(changes))
+        edits = []
+        signature_requests = []
+        removals = sorted(path for path, change in changes.items() if change.removed)
+        late_removals = [path for path in removals
+                         if any(is_at_or_under(path, destination) or is_at_or_under(source, path)
+                                for source, destination in moves)]
+        for relative_path in removals:
+            if relative_path not in late_removals:
+                edits.append(UserEditMessage(UserEditTypes.DELETE, relative_path.encode()))
+        for source, destination in moves:
+            edits.append(UserEditMessage(UserEditTypes.MOVE, source.encode(), destination=destination.encode()))
+        self.recent_moves.extend(moves)
+        for relative_path in late_removals:
+            edits.append(UserEditMessage(UserEditTypes.DELETE, relative_path.encode()))
+
+        for relative_path in sorted(path for path, change in changes.items() if change.kind == DIRECTORY):
+            edits.append(UserEditMessage(UserEditTypes.CREATE, relative_path.encode(), is_dir=True))
+
+        for relative_path in sorted(path for path, change in changes.items() if change.kind == FILE):
+            full_path = os.path.join(self.shared_folder, relative_path)
+            try:
+                size = os.path.getsize(full_path)
+            except FileNotFoundError:
+                # the deletion event will follow
+                continue
+
+            change = changes[relative_path]
+            if change.existed and not change.removed and size >= DELTA_MIN_SIZE:
+                # ask for the signatures of the copy of the server, so we can send only the changed blocks
+                signature_requests.append(UserSignatureRequestMessage(relative_path))
+            else:
+                edits.append(UserEditMessage(UserEditTypes.MODIFY, relative_path.encode(), full_path))
+
+        if edits:
+            batch_id = next(self.batch_ids)
+            self.unacknowledged[batch_id] = list(changes)
+            self.unacknowledged_moves[batch_id] = moves
+            logger.info(f"send batch {batch_id} of {len(edits)} edits")
+            self.connection.post(UserBatchEditMessage(batch_id, edits))
+
+        for request in signature_requests:
+            self.awaiting_signatures.add(request.file_path)
+            self.connection.post(request)
+
+    def signatures_answered(self, relative_path: str):
+        """
+        the delta or the whole file was sent for the signatures of the server, or there was nothing to send
+        """
+        self.awaiting_signatures.discard(relative_path)
+
+    def acknowledge(self, batch_id: int):
+        paths = self.unacknowledged.pop(batch_id, None)
+        self.unacknowledged_moves.pop(batch_id, None)
+        if paths is None:
+            logger.warning(f"the server acknowledged unknown batch {batch_id}")
+            return
+        logger.debug(f"the server applied batch {batch_id} of {len(paths)} paths")
@@ -0,0 +1,144 @@
+import os
+import threading
+import time
+
+from watchdog.events import FileSystemEvent, FileDeletedEvent, DirDeletedEvent, DirCreatedEvent, FileMovedEvent, \
+    DirMovedEvent
+
+from shared_folder_opu.hashing import DEFAULT_DIGEST, hash_file
+from shared_folder_opu.logger_singleton import SingletonLogger
+
+logger = SingletonLogger.get_logger()
+
+# the events of our own changes arrive within milliseconds, this only bounds the memory
+EXPECTATION_TTL = 5.0
+ABSENT = None
+DIRECTORY = "directory"
+MOVED_FROM = "moved from "
+
+
+class ExpectedChanges:
+    """
+    the changes we make to the folder ourselves when we apply what the server sent. the observer keeps
+    running, and an event that leaves a path in a state we expect is dropped instead of being sent back
+    to the server. a path is expected to be a file with a given digest, a directory, absent, or moved
+    from another path. it is used from the event loop and from the observer thread.
+    """
+
+    def __init__(self, shared_folder: str, ttl: float = EXPECTATION_TTL, algorithm: str = DEFAULT_DIGEST):
+        self.shared_folder = shared_folder
+        self.ttl = ttl
+        self.algorithm = algorithm
+        self.lock = threading.Lock()
+        self.expected = {}  # relative path -> list of (state, deadline)
+
+    def relative_path(self, path: str | bytes) -> str:
+        return os.path.relpath(os.fsdecode(path), self.shared_folder)
+
+    def _expect(self, path: str | bytes, state: str | None):
+        self.expect_all([(path, state)])
+
+    def expect_all(self, changes: list[tuple[str | bytes, str | None]]):
+        """
+        expect many (path, state) changes at once, with one lock and one deadline. the states are
+        digests, DIRECTORY or ABSENT
+        """
+        deadline = time.monotonic() + self.ttl
+        with self.lock:
+            for path, state in changes:
+                self.expected.setdefault(self.relative_path(path), []).append((state, deadline))
+
+    def expect_file(self, path: str | bytes, digest: str | bytes):
+        self._expect(path, digest.decode() if isinstance(digest, bytes) else digest)
+
+    def expect_directory(self, path: str | bytes):
+        self._expect(path, DIRECTORY)
+
+    def expect_removed(self, path: str | bytes):
+        """
+        a removed directory covers the events of everything under it
+        """
+        self._expect(path, ABSENT)
+
+    def expect_moved(self, source: str | bytes, destination: str | bytes):
+        """
+        a moved directory covers the moves of everything under it
+        """
+        self._expect(destination, MOVED_FROM + self.relative_path(source))
+
+    def _is_move_expected(self, source: str, destination: str) -> bool:
+        # not consumed, the observer reports the move of every path under a moved directory after it
+        with self.lock:
+            if MOVED_FROM + source in self._states(destination):
+                # the move was seen as a move, the source is not reported as removed
+                if ABSENT in self._states(source):
+                    self._consume(source, ABSENT)
+                return True
+
+            while True:
+                source, source_name = os.path.split(source)
+                destination, destination_name = os.path.split(destination)
+                if not source or not destination or source_name != destination_name:
+                    return False
+                if MOVED_FROM + source in self._states(destination):
+                    return True
+
+    def _states(self, relative_path: str) -> list:
+        now = time.monotonic()
+        entries = [(state, deadline) for state, deadline in self.expected.get(relative_path, []) if deadline > now]
+        if entries:
+            self.expected[relative_path] = entries
+        else:
+            self.expected.pop(relative_path, None)
+        return [state for state, _ in entries]
+
+    def _consume(self, relative_path: str, state: str | None):
+        entries = self.expected.get(relative_path, [])
+        for index, (expected_state, _) in enumerate(entries):
+            if expected_state == state:
+                del entries[index]
+                break
+        if not entries:
+            self.expected.pop(relative_path, None)
+
+    def _is_removal_expected(self, relative_path: str) -> bool:
+        with self.lock:
+            if ABSENT in self._states(relative_path):
+                # a path is removed once, unlike a written file that causes several events
+                self._consume(relative_path, ABSENT)
+                return True
+
+            parent = os.path.dirname(relative_path)
+            while parent:
+                if ABSENT in self._states(parent):
+                    return True
+                parent = os.path.dirname(parent)
+        return False
+
+    def is_expected(self, event: FileSystemEvent) -> bool:
+        """
+        whether the event was caused by one of our own changes
+        """
+        relative_path = self.relative_path(event.src_path)
+        if isinstance(event, (FileMovedEvent, DirMovedEvent)):
+            expected = self._is_move_expected(relative_path, self.relative_path(event.dest_path))
+        elif isinstance(event, (FileDeletedEvent, DirDeletedEvent)):
+            expected = self._is_removal_expected(relative_path)
+        elif isinstance(event, DirCreatedEvent):
+            with self.lock:
+                expected = DIRECTORY in self._states(relative_path)
+                if expected:
+                    self._consume(relative_path, DIRECTORY)
+        else:
+            with self.lock:
+                digests = [state for state in self._states(relative_path) if state not in (ABSENT, DIRECTORY)]
+            expected = False
+            if digests:
+                try:
+                    expected = hash_file(event.src_path, self.algorithm) in digests
+                except (FileNotFoundError, IsADirectoryError):
+                    pass
+
+        if expected:
+            logger.debug(f"ignore {event.event_type} of {relative_path}, we made this change")
+        return expected
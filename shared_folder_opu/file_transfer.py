@@ -0,0 +1,220 @@
+import asyncio
+import functools
+import os
+import shutil
+import struct
+import tempfile
+from asyncio import StreamReader, StreamWriter
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from shared_folder_opu.compression import Codec, Compressor, ENTROPY_SAMPLE_SIZE, decompressobj
+from shared_folder_opu.hashing import DEFAULT_DIGEST, new_hasher, hash_file
+from shared_folder_opu.logger_singleton import SingletonLogger
+
+logger = SingletonLogger.get_logger()
+
+# the size of the content and the codec it is compressed with
+CONTENT_HEADER_FORMAT = ">QB"
+# compressed content is sent in frames, each one starts with its length. an empty frame ends the content
+FRAME_LENGTH_FORMAT = ">I"
+TRANSFER_CHUNK_SIZE = 256 * 1024
+# the linux ioctl that makes a file share the blocks of another file, on btrfs, xfs and other file systems
+# with reflinks
+FICLONE = 0x40049409
+
+
+def _read_chunks(file_to_send, size: int):
+    """
+    yield chunks of the file that add up to exactly size bytes
+    """
+    remaining = size
+    while remaining:
+        chunk = file_to_send.read(min(TRANSFER_CHUNK_SIZE, remaining))
+        if not chunk:
+            # the file was truncated while we sent it. we already promised the size, so pad it.
+            # the hash will not match and the newer version will be sent again.
+            logger.warning(f"{file_to_send.name} was truncated while it was sent")
+            chunk = bytes(min(TRANSFER_CHUNK_SIZE, remaining))
+
+        remaining -= len(chunk)
+        yield chunk
+
+
+def _write_frame(writer: StreamWriter, data: bytes):
+    if data:
+        writer.write(struct.pack(FRAME_LENGTH_FORMAT, len(data)) + data)
+
+
+async def _send_raw(writer: StreamWriter, file_to_send, size: int, offset: int = 0):
+    """
+    send size bytes of the content from the offset as is. on a socket it goes from the page cache to the
+    socket with sendfile, without copying it through python. asyncio falls back to reading and writing when
+    the transport can not sendfile
+    """
+    sent = 0
+    if isinstance(writer.transport, asyncio.WriteTransport):
+        sent = await asyncio.get_running_loop().sendfile(writer.transport, file_to_send, offset, size)
+
+    # anything sendfile did not send because the file was truncated is padded by _read_chunks
+    file_to_send.seek(offset + sent)
+    for chunk in _read_chunks(file_to_send, size - sent):
+        writer.write(chunk)
+        await writer.drain()
+
+
+async def send_file_content(writer: StreamWriter, file_path: str | bytes, header: bytes = b"",
+                            compressor: Compressor = None, offset: int = 0):
+    """
+    write the header of the message, the size of the content as a 64-bit number and the codec, and then the
+    content. content that is not compressed is sent with sendfile, compressed content is streamed in fixed
+    size chunks, so only one chunk is held in memory. a sample from the start of the content decides if it
+    is worth compressing. the file is opened before anything is written, so if it does not exist
+    the stream is left untouched. a transfer that was interrupted continues from the offset, only the
+    rest of the file is sent.
+    """
+    with open(file_path, "rb") as file_to_send:
+        size = max(0, os.fstat(file_to_send.fileno()).st_size - offset)
+        file_to_send.seek(offset)
+        codec = Codec.NONE
+        if compressor is not None and compressor.codec != Codec.NONE:
+            sample = file_to_send.read(ENTROPY_SAMPLE_SIZE)
+            file_to_send.seek(offset)
+            if compressor.should_compress(sample, size):
+                codec = compressor.codec
+
+        writer.write(header + struct.pack(CONTENT_HEADER_FORMAT, size, codec.value))
+        if codec == Codec.NONE:
+            await _send_raw(writer, file_to_send, size, offset)
+            return
+
+        loop = asyncio.get_running_loop()
+        stream = compressor.compressobj()
+        for chunk in _read_chunks(file_to_send, size):
+            _write_frame(writer, await loop.run_in_executor(None, stream.compress, chunk))
+            await writer.drain()
+        _write_frame(writer, stream.flush())
+        writer.write(struct.pack(FRAME_LENGTH_FORMAT, 0))
+
+
+async def _receive_frames(reader: StreamReader, codec: Codec):
+    """
+    yield the decompressed chunks of compressed content
+    """
+    loop = asyncio.get_running_loop()
+    stream = decompressobj(codec)
+    frame_length_size = struct.calcsize(FRAME_LENGTH_FORMAT)
+    while length := struct.unpack(FRAME_LENGTH_FORMAT, await reader.readexactly(frame_length_size))[0]:
+        data = await reader.readexactly(length)
+        yield await loop.run_in_executor(None, stream.decompress, data)
+
+
+async def _receive_raw(reader: StreamReader, size: int):
+    remaining = size
+    while remaining:
+        chunk = await reader.readexactly(min(TRANSFER_CHUNK_SIZE, remaining))
+        remaining -= len(chunk)
+        yield chunk
+
+
+def _hash_prefix(partial_file, offset: int, hasher):
+    """
+    hash what we already have of an interrupted transfer, and drop anything after the offset
+    """
+    remaining = offset
+    while remaining:
+        chunk = partial_file.read(min(TRANSFER_CHUNK_SIZE, remaining))
+        if not chunk:
+            # the partial file is shorter than we thought, the digest will not match
+            break
+        hasher.update(chunk)
+        remaining -= len(chunk)
+    partial_file.seek(offset)
+    partial_file.truncate()
+
+
+def _open_received_file(temp_dir: str, partial_path: str | None):
+    if partial_path is None:
+        fd, temp_path = tempfile.mkstemp(dir=temp_dir)
+        return temp_path, os.fdopen(fd, "wb")
+    return partial_path, open(os.open(partial_path, os.O_RDWR | os.O_CREAT, 0o600), "r+b")
+
+
+def _write_chunk(temp_file, hasher, chunk: bytes):
+    hasher.update(chunk)
+    temp_file.write(chunk)
+
+
+async def receive_file_content(reader: StreamReader, temp_dir: str, algorithm: str = DEFAULT_DIGEST,
+                               partial_path: str = None, offset: int = 0, run=None) -> tuple[str, str]:
+    """
+    receive content that was sent by send_file_content into a temporary file. the digest is calculated
+    while the data streams. return the temporary path and the digest, the caller should rename
+    the file to its place or delete it.
+    a caller that passes partial_path receives into that file instead, after its first offset bytes. the
+    digest covers the whole file, and the file is kept if the transfer is interrupted, so it can continue
+    from where it stopped.
+    the file is opened, hashed and written off the event loop, by run(func, *args) when it is given, like
+    WorkerPool.run, otherwise by the default executor.
+    """
+    data = await reader.readexactly(struct.calcsize(CONTENT_HEADER_FORMAT))
+    size, codec = struct.unpack(CONTENT_HEADER_FORMAT, data)
+    codec = Codec(codec)
+    logger.debug(f"receive content of length {size} from offset {offset} compressed with {codec.name}")
+
+    if run is None:
+        run = functools.partial(asyncio.get_running_loop().run_in_executor, None)
+    hasher = new_hasher(algorithm)
+    temp_path, temp_file = await run(_open_received_file, temp_dir, partial_path)
+    try:
+        with temp_file:
+            if partial_path is not None:
+                await run(_hash_prefix, temp_file, offset, hasher)
+            received = 0
+            chunks = _receive_raw(reader, size) if codec == Codec.NONE else _receive_frames(reader, codec)
+            async for chunk in chunks:
+                await run(_write_chunk, temp_file, hasher, chunk)
+                received += len(chunk)
+
+        if received != size:
+            raise RuntimeError(f"received {received} bytes instead of {size}")
+    except BaseException:
+        if partial_path is None:
+            os.unlink(temp_path)
+        raise
+
+    return temp_path, hasher.hexdigest()
+
+
+def _reflink(source_path: str | bytes, temp_path: str) -> bool:
+    if fcntl is None:
+        return False
+    try:
+        with open(source_path, "rb") as source, open(temp_path, "wb") as copy:
+            fcntl.ioctl(copy.fileno(), FICLONE, source.fileno())
+    except OSError:
+        return False
+    return True
+
+
+def clone_file(source_path: str | bytes, temp_dir: str, algorithm: str = DEFAULT_DIGEST) -> tuple[str, str]:
+    """
+    copy a local file into a temporary file. the copy shares the blocks of the source when the file system
+    supports reflinks, otherwise it is copied by the kernel. the copy has the mode of the source and not the
+    mode mkstemp gives. return the temporary path and the digest of the copy, the caller should rename the file
+    to its place or delete it
+    """
+    fd, temp_path = tempfile.mkstemp(dir=temp_dir)
+    os.close(fd)
+    try:
+        if not _reflink(source_path, temp_path):
+            shutil.copyfile(source_path, temp_path)
+        shutil.copymode(source_path, temp_path)
+        # the source may have changed since it was indexed, the caller checks the digest of what we copied
+        return temp_path, hash_file(temp_path, algorithm)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
@@ -1,80 +1,102 @@
 import os
-from asyncio import StreamReader, StreamWriter, run, Lock, run_coroutine_threadsafe
 
 from watchdog.events import FileSystemEventHandler, FileModifiedEvent, FileCreatedEvent, FileDeletedEvent, \
-    DirModifiedEvent, DirCreatedEvent, DirDeletedEvent
+    DirModifiedEvent, DirCreatedEvent, DirDeletedEvent, FileMovedEvent, DirMovedEvent
 
+from shared_folder_opu.directory_utils import is_metadata_path
+from shared_folder_opu.edit_batcher import EditBatcher
+from shared_folder_opu.expected_changes import ExpectedChanges
 from shared_folder_opu.logger_singleton import SingletonLogger
-from shared_folder_opu.protocol import UserEditMessage, UserEditTypes, Message
+from shared_folder_opu.protocol import UserEditTypes
 
 logger = SingletonLogger.get_logger()
 
 
 class MyHandler(FileSystemEventHandler):
 
-    def __init__(self, reader: StreamReader, writer: StreamWriter, shared_folder: str, reading_lock: Lock, loop):
+    def __init__(self, edit_batcher: EditBatcher, shared_folder: str, loop,
+                 expected_changes: ExpectedChanges = None):
         self.loop = loop
-        self.communication_lock = reading_lock
         self.shared_folder = shared_folder
-        self.writer = writer
-        self.reader = reader
+        self.edit_batcher = edit_batcher
+        self.expected_changes = expected_changes or ExpectedChanges(shared_folder)
 
-    async def handle_communication(self, request: Message):
+    def handle_communication(self, edit_type: UserEditTypes, path: str, is_dir: bool = False,
+                             destination: str = None):
         """
-        write a message to the server. we use a reading lock because if a 2 or more files were created on
-        the same time we want the messages to be written separately
+        hand the change to the edit batcher. we are called from the observer thread, so it is done on the
+        event loop, and the observer never waits for the network. the batcher sends the changes to the
+        server once the folder is quiet
         """
-        async with self.communication_lock:
-            self.writer.write(request.pack())
-            await self.writer.drain()
+        relative_path = os.path.relpath(path, self.shared_folder)
+        if destination is not None:
+            destination = os.path.relpath(destination, self.shared_folder)
+        self.loop.call_soon_threadsafe(self.edit_batcher.add, edit_type, relative_path, is_dir, destination)
+
+    def is_ignored(self, event) -> bool:
+        """
+        events in our metadata directory (for example files that are being received) are not synced,
+        and neither are the events of the paths the ignore file or the subscription leave out, and the
+        events of changes we made ourselves to match the server
+        """
+        relative_path = os.path.relpath(event.src_path, self.shared_folder)
+        if is_metadata_path(relative_path) or not self.edit_batcher.is_synced(relative_path, event.is_directory):
+            return True
+        return self.expected_changes.is_expected(event)
 
     def on_modified(self, event: FileModifiedEvent | DirModifiedEvent):
         """
         called when a file or directory are modified
         """
-        logger.info(f'File {event.src_path} has been modified')
-
         if type(event) == DirModifiedEvent:
             # we react only on created or deleted directories. the server should not do anything
             # if a folder is modified
-            logger.debug("ignore this event since it is a modified directory")
             return
 
-        relative_path = os.path.relpath(event.src_path, self.shared_folder)
-        with open(event.src_path, "rb") as new_file:
-            content = new_file.read()
-        future = run_coroutine_threadsafe(
-            self.handle_communication(UserEditMessage(UserEditTypes.MODIFY, relative_path.encode(), content)),
-            self.loop
-        )
-        return future.result()
+        if self.is_ignored(event):
+            return
+
+        logger.info(f'File {event.src_path} has been modified')
+        self.handle_communication(UserEditTypes.MODIFY, event.src_path)
 
     def on_created(self, event: FileCreatedEvent | DirCreatedEvent):
         """
         called when a file or a directory is created
         """
+        if self.is_ignored(event):
+            return
+
         logger.info(f'File {event.src_path} has been created')
-        relative_path = os.path.relpath(event.src_path, self.shared_folder)
         logger.debug(f"is dir = {type(event) == DirCreatedEvent}")
-        future = run_coroutine_threadsafe(
-            self.handle_communication(
-                UserEditMessage(UserEditTypes.CREATE,
-                                relative_path.encode(),
-                                is_dir=(type(event) == DirCreatedEvent)
-                                )
-            ),
-            self.loop
-        )
-        future.result()
+        self.handle_communication(UserEditTypes.CREATE, event.src_path, is_dir=type(event) == DirCreatedEvent)
 
     def on_deleted(self, event: FileDeletedEvent | DirDeletedEvent):
         """
         called when a file or directory are deleted
         """
+        if self.is_ignored(event):
+            return
+
         logger.info(f'File {event.src_path} has been deleted')
-        relative_path = os.path.relpath(event.src_path, self.shared_folder)
-        future = run_coroutine_threadsafe(
-            self.handle_communication(UserEditMessage(UserEditTypes.DELETE, relative_path.encode())),
-            self.loop
-        )
-        future.result()
+        self.handle_communication(UserEditTypes.DELETE, event.src_path, is_dir=type(event) == DirDeletedEvent)
+
+    def on_moved(self, event: FileMovedEvent | DirMovedEvent):
+        """
+        called when a file or a directory is moved or renamed. moves into or out of our metadata directory
+        are ours, a received file is moved to its place and a removed file may be kept for a while
+        """
+        source = os.path.relpath(event.src_path, self.shared_folder)
+        destination = os.path.relpath(event.dest_path, self.shared_folder)
+        if is_metadata_path(source) or is_metadata_path(destination):
+            return
+        if not self.edit_batcher.is_synced(source, event.is_directory) and \
+                not self.edit_batcher.is_synced(destination, event.is_directory):
+            # for example an editor that renames its swap file
+            return
+
+        if self.expected_changes.is_expected(event):
+            return
+
+        logger.info(f'File {event.src_path} has been moved to {event.dest_path}')
+        self.handle_communication(UserEditTypes.MOVE, event.src_path, is_dir=type(event) == DirMovedEvent,
+                                  destination=event.dest_path)
@@ -34,6 +34,17 @@ async def get_string(reader):
     return received_str
 
 
+async def get_long_string(reader):
+    """
+    read a string that is framed with a 64-bit length
+    """
+    data = await reader.readexactly(8)
+    length = struct.unpack(">Q", data)[0]
+
+    logger.debug(f"try to read a long string of length: {length}")
+    return await reader.readexactly(length)
+
+
 async def get_local_file_path(reader, folder_path: bytes):
     relative_path = await get_string(reader)
     logger.info(f"relative path is {relative_path}")
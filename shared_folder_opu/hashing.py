@@ -0,0 +1,111 @@
+import hashlib
+import mmap
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from shared_folder_opu.logger_singleton import SingletonLogger
+
+logger = SingletonLogger.get_logger()
+
+# in order of preference. blake2b is the fastest on 64-bit machines, md5 is kept for old peers
+DEFAULT_DIGESTS = ["blake2b", "sha256", "md5"]
+DEFAULT_DIGEST = DEFAULT_DIGESTS[0]
+# a peer that does not negotiate the digest uses md5
+LEGACY_DIGEST = "md5"
+HASH_CHUNK_SIZE = 1024 * 1024
+# hashlib releases the GIL while it hashes big chunks, so threads hash on all the cores
+DEFAULT_HASH_WORKERS = os.cpu_count() or 1
+
+
+def new_hasher(algorithm: str):
+    match algorithm:
+        case "blake2b":
+            return hashlib.blake2b(digest_size=32)
+        case "sha256":
+            return hashlib.sha256()
+        case "md5":
+            return hashlib.md5()
+        case _:
+            raise ValueError(f"unsupported digest algorithm {algorithm}")
+
+
+def digest_length(algorithm: str) -> int:
+    """
+    the length of the hex digest
+    """
+    return new_hasher(algorithm).digest_size * 2
+
+
+def _read_into(file, chunk_size: int):
+    buffer = bytearray(chunk_size)
+    with memoryview(buffer) as view:
+        while length := file.readinto(buffer):
+            with view[:length] as chunk:
+                yield chunk
+
+
+def _read_mapped(file, chunk_size: int):
+    size = os.fstat(file.fileno()).st_size
+    if size == 0:
+        # an empty file can not be mapped
+        return
+
+    with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        if hasattr(mapped, "madvise"):
+            # the kernel reads ahead aggressively and frees the pages we passed
+            mapped.madvise(mmap.MADV_SEQUENTIAL)
+        with memoryview(mapped) as view:
+            for offset in range(0, size, chunk_size):
+                with view[offset:offset + chunk_size] as chunk:
+                    yield chunk
+
+
+def read_chunks(file_path: str | bytes, chunk_size: int = HASH_CHUNK_SIZE, use_mmap: bool = False,
+                drop_cache: bool = False):
+    """
+    yield the content of the file in chunks of chunk_size bytes, so the memory does not depend on the size
+    of the file. the chunks are views that are valid only until the next one is yielded. with use_mmap the
+    file is mapped instead of copied to a buffer. with drop_cache the pages of the file are released from
+    the page cache when we are done, so hashing a big folder does not push out the files that are in use
+    """
+    with open(file_path, "rb") as file:
+        try:
+            if use_mmap:
+                yield from _read_mapped(file, chunk_size)
+            else:
+                yield from _read_into(file, chunk_size)
+        finally:
+            if drop_cache and hasattr(os, "posix_fadvise"):
+                os.posix_fadvise(file.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+
+
+def hash_file(file_path: str | bytes, algorithm: str = DEFAULT_DIGEST, chunk_size: int = HASH_CHUNK_SIZE,
+              use_mmap: bool = False, drop_cache: bool = False) -> str:
+    """
+    the hex digest of the file. the file is read in chunks so big files are not loaded to memory
+    """
+    hasher = new_hasher(algorithm)
+    for chunk in read_chunks(file_path, chunk_size, use_mmap, drop_cache):
+        hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def _hash_or_none(file_path: str | bytes, algorithm: str, **options) -> str | None:
+    try:
+        return hash_file(file_path, algorithm, **options)
+    except (FileNotFoundError, IsADirectoryError):
+        return None
+
+
+def hash_files(file_paths: list[str | bytes], algorithm: str = DEFAULT_DIGEST,
+               max_workers: int = DEFAULT_HASH_WORKERS, **options) -> dict[str | bytes, str | None]:
+    """
+    hash many files in parallel. a file that was removed in the meantime gets None. the options are
+    passed to hash_file
+    """
+    if len(file_paths) <= 1 or max_workers <= 1:
+        return {file_path: _hash_or_none(file_path, algorithm, **options) for file_path in file_paths}
+
+    with ThreadPoolExecutor(max_workers, thread_name_prefix="hash") as executor:
+        digests = executor.map(lambda file_path: _hash_or_none(file_path, algorithm, **options), file_paths)
+        return dict(zip(file_paths, digests))
@@ -0,0 +1,161 @@
+import json
+import os
+import uuid
+from collections import deque
+
+from shared_folder_opu.directory_utils import METADATA_DIR_NAME
+from shared_folder_opu.logger_singleton import SingletonLogger
+from shared_folder_opu.manifest import ManifestDelta
+
+logger = SingletonLogger.get_logger()
+
+JOURNAL_NAME = "journal.log"
+# the journal is compacted to half of this size when it grows beyond it
+MAX_JOURNAL_SIZE = 16 * 1024 * 1024
+
+
+def merge_deltas(deltas: list[ManifestDelta]) -> ManifestDelta:
+    """
+    one delta with the changes of consecutive deltas. a removed path drops the earlier changes under it,
+    and the removals of the merged delta are applied before its files and directories, like in every delta
+    """
+    merged = ManifestDelta(deltas[0].base_version, deltas[-1].version)
+    directories = set()
+    removed = set()
+    for delta in deltas:
+        for relative_path in delta.removed:
+            prefix = relative_path + os.sep
+            for path in [path for path in merged.files if path == relative_path or path.startswith(prefix)]:
+                del merged.files[path]
+            directories = {path for path in directories if path != relative_path and not path.startswith(prefix)}
+            removed.add(relative_path)
+        directories.update(delta.directories)
+        merged.files.update(delta.files)
+        merged.moved.extend(delta.moved)
+    merged.removed = sorted(removed)
+    merged.directories = sorted(directories)
+    return merged
+
+
+class OperationJournal:
+    """
+    an append only log of the deltas the server published, one json line per delta. a client that
+    reconnects with the last version it applied gets only the deltas it missed, as long as they are still
+    in the journal. the journal keeps at most max_size bytes, the oldest deltas are dropped when it is
+    compacted. every journal has a random id, so a version from another journal (for example after the
+    manifest was lost) is never replayed
+    """
+
+    def __init__(self, path: str, max_size: int = MAX_JOURNAL_SIZE):
+        self.path = path
+        self.max_size = max_size
+        self.id = None
+        self.base_version = 0  # the oldest version a client can be replayed from
+        self.version = 0
+        self.entries: deque[tuple[ManifestDelta, int]] = deque()  # delta, length of its line
+        self.size = 0
+
+    @staticmethod
+    def for_folder(dir_path: str, max_size: int = MAX_JOURNAL_SIZE) -> "OperationJournal":
+        return OperationJournal(os.path.join(dir_path, METADATA_DIR_NAME, JOURNAL_NAME), max_size)
+
+    @staticmethod
+    def _delta_line(delta: ManifestDelta) -> str:
+        return json.dumps({"base": delta.base_version, "version": delta.version, "files": delta.files,
+                           "removed": delta.removed, "directories": delta.directories,
+                           "moved": delta.moved}) + "\n"
+
+    def _header_line(self) -> str:
+        return json.dumps({"id": self.id, "version": self.base_version}) + "\n"
+
+    def load(self):
+        """
+        read the journal from the disk. a missing or broken journal leaves the id None, the server
+        starts a new one
+        """
+        try:
+            with open(self.path, "r") as journal_file:
+                header = json.loads(journal_file.readline())
+                self.id, self.base_version = header["id"], header["version"]
+                self.version = self.base_version
+                self.entries.clear()
+                self.size = 0
+                for line in journal_file:
+                    entry = json.loads(line)
+                    delta = ManifestDelta(entry["base"], entry["version"], entry["files"], entry["removed"],
+                                          entry["directories"], entry.get("moved", []))
+                    if delta.base_version != self.version:
+                        raise ValueError(f"a gap between version {self.version} and {delta.base_version}")
+                    self.entries.append((delta, len(line)))
+                    self.size += len(line)
+                    self.version = delta.version
+        except FileNotFoundError:
+            logger.info(f"no journal in {self.path}")
+            self.id = None
+            return
+        except (OSError, ValueError, KeyError) as error:
+            logger.warning(f"failed to load the journal {self.path}: {error}")
+            self.id = None
+            return
+        logger.info(f"loaded {len(self.entries)} deltas from the journal, from version {self.base_version} "
+                    f"to {self.version}")
+
+    def _rewrite(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, "w") as journal_file:
+            journal_file.write(self._header_line())
+            journal_file.writelines(self._delta_line(delta) for delta, _ in self.entries)
+        os.replace(temp_path, self.path)
+
+    def reset(self, version: int):
+        """
+        start a new empty journal at the version. the clients of the previous journal get a full sync
+        """
+        self.id = uuid.uuid4().hex
+        self.base_version = self.version = version
+        self.entries.clear()
+        self.size = 0
+        self._rewrite()
+        logger.info(f"started journal {self.id} at version {version}")
+
+    def append(self, delta: ManifestDelta):
+        if self.id is None:
+            # the journal was not loaded or started, there is nothing to append to
+            return
+        if delta.base_version != self.version:
+            # the manifest changed without a delta, the journal can not describe what happened
+            logger.warning(f"the journal is at version {self.version}, the delta starts at {delta.base_version}")
+            self.reset(delta.base_version)
+
+        line = self._delta_line(delta)
+        with open(self.path, "a") as journal_file:
+            journal_file.write(line)
+        self.entries.append((delta, len(line)))
+        self.size += len(line)
+        self.version = delta.version
+        if self.size > self.max_size:
+            self.compact()
+
+    def compact(self):
+        """
+        drop the oldest deltas until the journal is half of its maximal size
+        """
+        while self.entries and self.size > self.max_size // 2:
+            delta, length = self.entries.popleft()
+            self.size -= length
+            self.base_version = delta.version
+        self._rewrite()
+        logger.info(f"compacted the journal, it starts at version {self.base_version}")
+
+    def can_replay(self, journal_id: str, version: int) -> bool:
+        return journal_id == self.id and self.base_version <= version <= self.version
+
+    def replay(self, version: int) -> ManifestDelta:
+        """
+        the changes from the version to the last version of the journal, as one delta
+        """
+        deltas = [delta for delta, _ in self.entries if delta.base_version >= version]
+        if not deltas:
+            return ManifestDelta(version, self.version)
+        return merge_deltas(deltas)
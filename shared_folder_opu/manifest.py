@@ -0,0 +1,489 @@
+import itertools
+import json
+import os
+from typing import NamedTuple
+
+from shared_folder_opu.directory_utils import walk_shared_folder, METADATA_DIR_NAME
+from shared_folder_opu.hashing import DEFAULT_DIGEST, DEFAULT_HASH_WORKERS, hash_file, hash_files, new_hasher
+from shared_folder_opu.logger_singleton import SingletonLogger
+from shared_folder_opu.manifest_codec import encode_manifest
+from shared_folder_opu.merkle import MerkleTree
+from shared_folder_opu.subscription import Subscription
+from shared_folder_opu.sync_ignore import SyncIgnore
+
+logger = SingletonLogger.get_logger()
+
+MANIFEST_SNAPSHOT_NAME = "manifest.json"
+SNAPSHOT_FORMAT_VERSION = 1
+DEFAULT_SAVE_EVERY = 1000
+
+
+class FileEntry(NamedTuple):
+    size: int
+    mtime_ns: int
+    inode: int
+    digest: str
+
+
+class ManifestDelta:
+    """
+    the changes between two versions of the manifest. removed paths are removed recursively, so a removed
+    directory is listed once and not together with everything under it.
+
+    moved lists the [source, destination] pairs of the paths that were renamed. they are only hints, the
+    sources are in removed and the destinations are in files and directories like any other change, so a
+    client that can not rename its copy applies the delta as usual.
+    """
+
+    def __init__(self, base_version: int, version: int, files: dict[str, str] = None, removed: list[str] = None,
+                 directories: list[str] = None, moved: list[list[str]] = None):
+        self.base_version = base_version
+        self.version = version
+        self.files = files or {}
+        self.removed = removed or []
+        self.directories = directories or []
+        self.moved = moved or []
+
+    def is_empty(self) -> bool:
+        return not (self.files or self.removed or self.directories)
+
+    def to_json(self) -> str:
+        return json.dumps({"files": self.files, "removed": self.removed, "directories": self.directories,
+                           "moved": self.moved})
+
+    @staticmethod
+    def from_json(base_version: int, version: int, data: str):
+        delta = json.loads(data)
+        return ManifestDelta(base_version, version, delta["files"], delta["removed"], delta["directories"],
+                             delta.get("moved", []))
+
+    def restricted_to(self, subscription: Subscription) -> "ManifestDelta":
+        """
+        the changes in the part of the folder the subscription covers. a move is kept only if both of its
+        paths are in it, otherwise it is a removal or a new path for the subscriber
+        """
+        if subscription.is_everything():
+            return self
+        removed = [path for path in self.removed if subscription.matches(path) or subscription.matches(path, True)]
+        moved = [[source, destination] for source, destination in self.moved
+                 if all(subscription.matches(path, destination in self.directories) for path in (source, destination))]
+        return ManifestDelta(self.base_version, self.version, subscription.filter_files(self.files), removed,
+                             sorted(subscription.filter_directories(self.directories)), moved)
+
+
+class ManifestIndex:
+    """
+    an index of the shared folder that keeps the hash of every file together with the stat values
+    it was calculated for. a file is hashed again only when its (size, mtime_ns, inode) changed.
+    all the digests are calculated with one algorithm, the files that need hashing are hashed in parallel.
+
+    every change bumps the version of the manifest and is recorded in a pending delta, so the
+    server can send only the changes since the last version it published. the paths the ignore file of
+    the folder ignores are not indexed.
+
+    the index is marked dirty by the changes and is not saved by them, the owner saves it when needs_save()
+    says so, off the event loop, from a copy that snapshot() takes.
+    """
+
+    def __init__(self, dir_path: str, snapshot_path: str = None, save_every: int = DEFAULT_SAVE_EVERY,
+                 algorithm: str = DEFAULT_DIGEST, hash_workers: int = DEFAULT_HASH_WORKERS,
+                 ignore: SyncIgnore = None, hash_options: dict = None):
+        self.dir_path = dir_path
+        self.ignore = ignore or SyncIgnore(dir_path)
+        self.algorithm = algorithm
+        self.hash_workers = hash_workers
+        # passed to hash_file, use_mmap and drop_cache
+        self.hash_options = hash_options or {}
+        self.snapshot_path = snapshot_path or os.path.join(dir_path, METADATA_DIR_NAME, MANIFEST_SNAPSHOT_NAME)
+        self.save_every = save_every
+        self.files: dict[str, FileEntry] = {}
+        self.directories: set[str] = set()
+        # digest -> the files with this content, so the same content is found under any of its paths
+        self.digest_paths: dict[str, set[str]] = {}
+        # directory -> the indexed paths right under it, "" is the top of the folder. removing or moving a
+        # directory visits only what is under it
+        self.children: dict[str, set[str]] = {}
+        self.tree = MerkleTree(algorithm)
+        self.version = 0
+        self._saved_version = 0
+        self._encoded_cache = None
+        self._reset_delta()
+
+    def _reset_delta(self):
+        self._delta_base_version = self.version
+        self._delta_files: dict[str, str] = {}
+        self._delta_removed: set[str] = set()
+        self._delta_directories: set[str] = set()
+        self._delta_moves: list[list[str]] = []
+
+    def _discard_pending(self, relative_paths: list[str]):
+        """
+        forget pending additions of paths that are now removed
+        """
+        for path in relative_paths:
+            self._delta_files.pop(path, None)
+            self._delta_directories.discard(path)
+
+    def _link(self, relative_path: str):
+        self.children.setdefault(os.path.dirname(relative_path), set()).add(relative_path)
+
+    def _unlink(self, relative_path: str):
+        parent = os.path.dirname(relative_path)
+        siblings = self.children.get(parent)
+        if siblings is not None:
+            siblings.discard(relative_path)
+            if not siblings:
+                del self.children[parent]
+
+    def _rebuild_children(self):
+        self.children = {}
+        for relative_path in itertools.chain(self.files, self.directories):
+            self._link(relative_path)
+
+    def _subtree(self, relative_path: str) -> list[str]:
+        """
+        the path and every indexed path under it
+        """
+        paths = []
+        stack = [relative_path]
+        while stack:
+            path = stack.pop()
+            paths.append(path)
+            stack.extend(self.children.get(path, ()))
+        return paths
+
+    def _add_digest_path(self, relative_path: str, digest: str):
+        self.digest_paths.setdefault(digest, set()).add(relative_path)
+
+    def _discard_digest_path(self, relative_path: str, digest: str):
+        paths = self.digest_paths.get(digest)
+        if paths is not None:
+            paths.discard(relative_path)
+            if not paths:
+                del self.digest_paths[digest]
+
+    def _changed(self):
+        self.version += 1
+        self._encoded_cache = None
+
+    def needs_save(self) -> bool:
+        return self.version - self._saved_version >= self.save_every
+
+    def load(self):
+        """
+        load the last snapshot from the disk. a missing or broken snapshot leaves the index empty
+        """
+        try:
+            with open(self.snapshot_path, "r") as snapshot_file:
+                snapshot = json.load(snapshot_file)
+        except FileNotFoundError:
+            logger.info(f"no manifest snapshot in {self.snapshot_path}")
+            return
+        except (OSError, ValueError) as error:
+            logger.warning(f"failed to load manifest snapshot {self.snapshot_path}: {error}")
+            return
+
+        if snapshot.get("format") != SNAPSHOT_FORMAT_VERSION:
+            logger.warning(f"ignore manifest snapshot with format {snapshot.get('format')}")
+            return
+
+        if snapshot.get("digest") != self.algorithm:
+            logger.warning(f"ignore manifest snapshot with {snapshot.get('digest')} digests, we use {self.algorithm}")
+            return
+
+        self.files = {path: FileEntry(*entry) for path, entry in snapshot["files"].items()}
+        self.directories = set(snapshot["directories"])
+        self._rebuild_tree()
+        self._rebuild_digest_paths()
+        self._rebuild_children()
+        self.version = snapshot.get("version", 0)
+        self._saved_version = self.version
+        self._encoded_cache = None
+        self._reset_delta()
+        logger.info(f"loaded {len(self.files)} files from manifest snapshot")
+
+    def snapshot(self) -> tuple[dict[str, FileEntry], set[str], int]:
+        """
+        a copy of the index to save or to encode while the index keeps changing. the entries are immutable,
+        so copying the containers is enough
+        """
+        return dict(self.files), set(self.directories), self.version
+
+    def save(self, snapshot: tuple[dict[str, FileEntry], set[str], int] = None):
+        """
+        write the index, or a snapshot of it that was taken earlier, to the snapshot file. a snapshot
+        can be written from a worker thread. we write a temporary file and rename it so a crash never
+        leaves a half written snapshot
+        """
+        files, directories, version = snapshot or self.snapshot()
+        os.makedirs(os.path.dirname(self.snapshot_path), exist_ok=True)
+        data = {
+            "format": SNAPSHOT_FORMAT_VERSION,
+            "digest": self.algorithm,
+            "files": {path: list(entry) for path, entry in files.items()},
+            "directories": sorted(directories),
+            "version": version,
+        }
+        temp_path = f"{self.snapshot_path}.tmp"
+        with open(temp_path, "w") as snapshot_file:
+            json.dump(data, snapshot_file)
+        os.replace(temp_path, self.snapshot_path)
+        self._saved_version = max(self._saved_version, version)
+
+    def refresh(self):
+        """
+        walk the shared folder and bring the index up to date. only files whose stat changed are hashed,
+        and they are hashed in parallel.
+        """
+        seen_files = set()
+        directories = set()
+        changed = {}  # relative path -> stat
+        for root, dirs, files in walk_shared_folder(self.dir_path, self.ignore):
+            for directory in dirs:
+                directories.add(os.path.relpath(os.path.join(root, directory), self.dir_path))
+
+            for file_name in files:
+                full_path = os.path.join(root, file_name)
+                relative_path = os.path.relpath(full_path, self.dir_path)
+                seen_files.add(relative_path)
+                try:
+                    stat = os.stat(full_path)
+                except FileNotFoundError:
+                    continue
+                if not self._is_current(relative_path, stat):
+                    changed[relative_path] = stat
+
+        seen_files.difference_update(self._hash_changed(changed))
+        rehashed = len(changed)
+
+        for relative_path in self.files.keys() - seen_files:
+            logger.debug(f"{relative_path} no longer exists, remove it from the index")
+            del self.files[relative_path]
+            self.version += 1
+
+        if directories != self.directories:
+            self.directories = directories
+            self.version += 1
+        self._rebuild_tree()
+        self._rebuild_digest_paths()
+        self._rebuild_children()
+        self._encoded_cache = None
+        self._reset_delta()
+        logger.info(f"index refreshed, {rehashed} out of {len(self.files)} files were hashed")
+
+    def _rebuild_tree(self):
+        self.tree = MerkleTree.build(self.file_to_hash(), self.directories, self.algorithm)
+
+    def _rebuild_digest_paths(self):
+        self.digest_paths = {}
+        for relative_path, entry in self.files.items():
+            self._add_digest_path(relative_path, entry.digest)
+
+    def _hash_changed(self, changed: dict[str, os.stat_result]) -> list[str]:
+        """
+        hash the changed files in parallel and update their entries. return the files that were removed
+        in the meantime
+        """
+        full_paths = [os.path.join(self.dir_path, relative_path) for relative_path in changed]
+        digests = hash_files(full_paths, self.algorithm, self.hash_workers, **self.hash_options)
+        vanished = []
+        for (relative_path, stat), full_path in zip(changed.items(), full_paths):
+            if digests[full_path] is None:
+                vanished.append(relative_path)
+                continue
+            self._set_entry(relative_path, stat, digests[full_path])
+        return vanished
+
+    def update_files(self, relative_paths: list[str]):
+        """
+        bring the entries of some files up to date without walking the whole folder. files that do not
+        exist are removed from the index
+        """
+        changed = {}
+        for relative_path in relative_paths:
+            try:
+                stat = os.stat(os.path.join(self.dir_path, relative_path))
+            except (FileNotFoundError, NotADirectoryError):
+                self.remove(relative_path)
+                continue
+            if not self._is_current(relative_path, stat):
+                changed[relative_path] = stat
+
+        for relative_path in self._hash_changed(changed):
+            self.remove(relative_path)
+
+    def update_file(self, relative_path: str, digest: str = None) -> bool:
+        """
+        update the entry of a single file. return True if the file was hashed again. a caller that
+        already calculated the digest of the file (for example while receiving it) can pass it.
+        """
+        full_path = os.path.join(self.dir_path, relative_path)
+        try:
+            stat = os.stat(full_path)
+        except FileNotFoundError:
+            logger.debug(f"{full_path} does not exist, remove it from the index")
+            self.remove(relative_path)
+            return False
+
+        if self._is_current(relative_path, stat):
+            return False
+
+        self._set_entry(relative_path, stat, digest or hash_file(full_path, self.algorithm, **self.hash_options))
+        return True
+
+    def _is_current(self, relative_path: str, stat: os.stat_result) -> bool:
+        entry = self.files.get(relative_path)
+        return entry is not None and (entry.size, entry.mtime_ns, entry.inode) == (stat.st_size, stat.st_mtime_ns,
+                                                                                 stat.st_ino)
+
+    def _set_entry(self, relative_path: str, stat: os.stat_result, digest: str):
+        entry = self.files.get(relative_path)
+        self.files[relative_path] = FileEntry(stat.st_size, stat.st_mtime_ns, stat.st_ino, digest)
+        self.tree.set_file(relative_path, digest)
+        if entry is None:
+            self._link(relative_path)
+        if entry is None or entry.digest != digest:
+            if entry is not None:
+                self._discard_digest_path(relative_path, entry.digest)
+            self._add_digest_path(relative_path, digest)
+            self._delta_files[relative_path] = digest
+            self._changed()
+
+    def add_directory(self, relative_path: str):
+        if relative_path in self.directories:
+            return
+
+        self.directories.add(relative_path)
+        self._link(relative_path)
+        self.tree.add_directory(relative_path)
+        self._delta_directories.add(relative_path)
+        self._changed()
+
+    def remove(self, relative_path: str):
+        """
+        remove a file or a directory with everything under it from the index
+        """
+        entry = self.files.pop(relative_path, None)
+        if entry is not None:
+            self._discard_digest_path(relative_path, entry.digest)
+            self._unlink(relative_path)
+            self.tree.remove(relative_path)
+            self._delta_files.pop(relative_path, None)
+            self._delta_removed.add(relative_path)
+            self._changed()
+            return
+
+        subtree = self._subtree(relative_path)
+        if len(subtree) == 1 and relative_path not in self.directories:
+            return
+
+        for path in subtree:
+            entry = self.files.pop(path, None)
+            if entry is not None:
+                self._discard_digest_path(path, entry.digest)
+            self.directories.discard(path)
+            self.children.pop(path, None)
+        self._unlink(relative_path)
+        self.tree.remove(relative_path)
+        self._discard_pending(subtree)
+        self._delta_removed.add(relative_path)
+        self._changed()
+
+    def move(self, source: str, destination: str):
+        """
+        move the entries of a renamed file or directory to its new path. the file did not change, so nothing
+        is hashed again
+        """
+        subtree = self._subtree(source)
+        moved_files = {destination + path[len(source):]: self.files[path] for path in subtree if path in self.files}
+        moved_dirs = [destination + path[len(source):] for path in subtree if path in self.directories]
+        if not moved_files and not moved_dirs:
+            logger.warning(f"{source} is not in the index, nothing to move")
+            return
+
+        self.remove(destination)
+        self.remove(source)
+        parent = os.path.dirname(destination)
+        while parent and parent not in self.directories:
+            self.add_directory(parent)
+            parent = os.path.dirname(parent)
+
+        for path in sorted(moved_dirs):
+            self.directories.add(path)
+            self._link(path)
+            self.tree.add_directory(path)
+            self._delta_directories.add(path)
+        for path, entry in moved_files.items():
+            self.files[path] = entry
+            self._link(path)
+            self._add_digest_path(path, entry.digest)
+            self.tree.set_file(path, entry.digest)
+            self._delta_files[path] = entry.digest
+        self._delta_moves.append([source, destination])
+        self._changed()
+
+    def take_delta(self) -> ManifestDelta:
+        """
+        return the changes since the last call and start collecting a new delta from the current version
+        """
+        delta = ManifestDelta(self._delta_base_version, self.version, dict(self._delta_files),
+                              sorted(self._delta_removed), sorted(self._delta_directories), self._delta_moves)
+        self._reset_delta()
+        return delta
+
+    def path_with_digest(self, digest: str) -> str | None:
+        """
+        any of the files with the digest, None if there is none
+        """
+        paths = self.digest_paths.get(digest)
+        return next(iter(paths)) if paths else None
+
+    def file_to_hash(self) -> dict[str, str]:
+        return {path: entry.digest for path, entry in self.files.items()}
+
+    def to_json(self) -> str:
+        """
+        the files and their digests and the sorted directories, as a json array
+        """
+        return json.dumps((self.file_to_hash(), sorted(self.directories)), indent=4)
+
+    def _encode(self, files: dict[str, FileEntry], directories: set[str]) -> bytes:
+        files = {path: (entry.size, entry.mtime_ns, entry.digest) for path, entry in files.items()}
+        return encode_manifest(files, directories, new_hasher(self.algorithm).digest_size)
+
+    def encode(self, snapshot: tuple[dict[str, FileEntry], set[str], int], subscription: Subscription = None) -> bytes:
+        """
+        encode a snapshot in the binary format that is sent to the clients, from a worker thread too. with a
+        subscription only the part of the folder it covers is encoded
+        """
+        files, directories, _ = snapshot
+        if subscription is not None and not subscription.is_everything():
+            return self._encode(subscription.filter_files(files), subscription.filter_directories(directories))
+        return self._encode(files, directories)
+
+    def encoded(self, subscription: Subscription = None) -> bytes | None:
+        """
+        the encoding of the whole manifest that is kept until the next change, or None if there is none
+        """
+        if subscription is not None and not subscription.is_everything():
+            return None
+        return self._encoded_cache
+
+    def keep_encoded(self, version: int, data: bytes):
+        """
+        keep the encoding of a snapshot of the whole manifest, unless the manifest changed since it was taken
+        """
+        if version == self.version:
+            self._encoded_cache = data
+
+    def to_bytes(self, subscription: Subscription = None) -> bytes:
+        """
+        the manifest in the binary format that is sent to the clients. it is kept until the next change.
+        with a subscription only the part of the folder it covers is encoded, and it is not kept
+        """
+        if subscription is not None and not subscription.is_everything():
+            return self._encode(subscription.filter_files(self.files),
+                                subscription.filter_directories(self.directories))
+        if self._encoded_cache is None:
+            self._encoded_cache = self._encode(self.files, self.directories)
+        return self._encoded_cache
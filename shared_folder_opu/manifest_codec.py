@@ -0,0 +1,110 @@
+import struct
+from typing import Iterator
+
+from shared_folder_opu.logger_singleton import SingletonLogger
+
+logger = SingletonLogger.get_logger()
+
+# the full manifest on the wire:
+#   header: format, length of a raw digest, number of directories, number of files
+#   directories: sorted paths
+#   files: sorted paths, each one followed by its size, mtime_ns and raw digest
+# a path is written as the length of the prefix it shares with the previous path and the rest of it
+MANIFEST_FORMAT_VERSION = 1
+HEADER_FORMAT = ">BBQQ"
+PATH_FORMAT = ">HH"
+FILE_FORMAT = ">QQ"
+
+HEADER_LENGTH = struct.calcsize(HEADER_FORMAT)
+PATH_LENGTH = struct.calcsize(PATH_FORMAT)
+FILE_LENGTH = struct.calcsize(FILE_FORMAT)
+
+
+def _shared_prefix_length(previous: bytes, path: bytes) -> int:
+    # a binary search compares slices in C instead of comparing byte by byte in python
+    low, high = 0, min(len(previous), len(path), 0xffff)
+    while low < high:
+        middle = (low + high + 1) // 2
+        if previous[:middle] == path[:middle]:
+            low = middle
+        else:
+            high = middle - 1
+    return low
+
+
+def _encode_path(previous: bytes, path: bytes) -> bytes:
+    shared = _shared_prefix_length(previous, path)
+    return struct.pack(PATH_FORMAT, shared, len(path) - shared) + path[shared:]
+
+
+def encode_manifest(files: dict[str, tuple[int, int, str]], directories: set[str], digest_length: int) -> bytes:
+    """
+    encode the files (path -> size, mtime_ns, hex digest) and the directories. digest_length is the length
+    of a raw digest in bytes
+    """
+    data = [struct.pack(HEADER_FORMAT, MANIFEST_FORMAT_VERSION, digest_length, len(directories), len(files))]
+
+    previous = b""
+    for path in sorted(directory.encode() for directory in directories):
+        data.append(_encode_path(previous, path))
+        previous = path
+
+    previous = b""
+    encoded_files = sorted((path.encode(), entry) for path, entry in files.items())
+    for path, (size, mtime_ns, digest) in encoded_files:
+        data.append(_encode_path(previous, path))
+        data.append(struct.pack(FILE_FORMAT, size, mtime_ns))
+        data.append(bytes.fromhex(digest))
+        previous = path
+
+    return b"".join(data)
+
+
+class EncodedManifest:
+    """
+    a manifest in the binary format. only the header is decoded when it is created, the paths are decoded
+    while they are iterated, so a caller that needs only the directories does not decode the files
+    """
+
+    def __init__(self, data: bytes):
+        self.data = memoryview(data)
+        version, self.digest_length, self.directory_count, self.file_count = struct.unpack_from(HEADER_FORMAT,
+                                                                                               self.data)
+        if version != MANIFEST_FORMAT_VERSION:
+            raise ValueError(f"unsupported manifest format {version}")
+        self._files_offset = None
+
+    def _read_path(self, offset: int, previous: bytes) -> tuple[bytes, int]:
+        shared, length = struct.unpack_from(PATH_FORMAT, self.data, offset)
+        offset += PATH_LENGTH
+        path = previous[:shared] + self.data[offset:offset + length].tobytes()
+        return path, offset + length
+
+    def directories(self) -> Iterator[str]:
+        offset = HEADER_LENGTH
+        path = b""
+        for _ in range(self.directory_count):
+            path, offset = self._read_path(offset, path)
+            yield path.decode()
+        self._files_offset = offset
+
+    def files(self) -> Iterator[tuple[str, int, int, str]]:
+        """
+        yield (path, size, mtime_ns, hex digest) of every file
+        """
+        if self._files_offset is None:
+            for _ in self.directories():
+                pass
+
+        offset = self._files_offset
+        path = b""
+        for _ in range(self.file_count):
+            path, offset = self._read_path(offset, path)
+            size, mtime_ns = struct.unpack_from(FILE_FORMAT, self.data, offset)
+            offset += FILE_LENGTH
+            digest = self.data[offset:offset + self.digest_length].hex()
+            offset += self.digest_length
+            yield path.decode(), size, mtime_ns, digest
+
+    def file_to_hash(self) -> dict[str, str]:
+        return {path: digest for path, _, _, digest in self.files()}
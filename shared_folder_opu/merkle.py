@@ -0,0 +1,182 @@
+import os
+import struct
+
+from shared_folder_opu.hashing import DEFAULT_DIGEST, new_hasher
+from shared_folder_opu.logger_singleton import SingletonLogger
+
+logger = SingletonLogger.get_logger()
+
+ROOT = ""
+FILE_KIND = b"f"
+DIRECTORY_KIND = b"d"
+
+# the nodes on the wire: the number of nodes, and for every node its path, the number of children and
+# the children. a child is its name, whether it is a directory, and its raw digest
+NODE_COUNT_FORMAT = ">I"
+NAME_LENGTH_FORMAT = ">H"
+CHILD_COUNT_FORMAT = ">I"
+IS_DIR_FORMAT = ">B"
+
+
+def split_path(relative_path: str) -> tuple[str, str]:
+    parent, name = os.path.split(relative_path)
+    return parent or ROOT, name
+
+
+def join_path(directory: str, name: str) -> str:
+    return os.path.join(directory, name) if directory else name
+
+
+class MerkleTree:
+    """
+    a hash for every directory of the shared folder, calculated from the names, the kinds and the digests of
+    its children. two folders with the same root hash are the same, and two different folders differ only
+    under the children whose hashes differ. a change invalidates the hashes of the directories above it, and
+    they are calculated again only when they are needed.
+    """
+
+    def __init__(self, algorithm: str = DEFAULT_DIGEST):
+        self.algorithm = algorithm
+        # directory -> child name -> digest of a file, or None for a directory
+        self.children: dict[str, dict[str, str | None]] = {ROOT: {}}
+        self.hashes: dict[str, str] = {}  # the directories whose hash is up to date
+
+    @staticmethod
+    def build(files: dict[str, str], directories: set[str], algorithm: str = DEFAULT_DIGEST) -> "MerkleTree":
+        tree = MerkleTree(algorithm)
+        for directory in sorted(directories):
+            tree.add_directory(directory)
+        for relative_path, digest in files.items():
+            tree.set_file(relative_path, digest)
+        return tree
+
+    def _invalidate(self, directory: str):
+        """
+        forget the hashes of the directory and the directories above it. if a directory has no hash,
+        the directories above it have none either
+        """
+        while directory in self.hashes:
+            del self.hashes[directory]
+            if directory == ROOT:
+                break
+            directory = split_path(directory)[0]
+
+    def add_directory(self, relative_path: str):
+        if relative_path in self.children:
+            return
+
+        parent, name = split_path(relative_path)
+        self.add_directory(parent)
+        self.children[relative_path] = {}
+        self.children[parent][name] = None
+        self._invalidate(parent)
+
+    def set_file(self, relative_path: str, digest: str):
+        parent, name = split_path(relative_path)
+        self.add_directory(parent)
+        siblings = self.children[parent]
+        if name in siblings and siblings[name] == digest:
+            return
+        if name in siblings and siblings[name] is None:
+            # a directory was replaced by a file
+            self._forget_directory(relative_path)
+        siblings[name] = digest
+        self._invalidate(parent)
+
+    def _forget_directory(self, relative_path: str):
+        for name, digest in self.children.pop(relative_path, {}).items():
+            if digest is None:
+                self._forget_directory(join_path(relative_path, name))
+        self.hashes.pop(relative_path, None)
+
+    def remove(self, relative_path: str):
+        """
+        remove a file or a directory with everything under it
+        """
+        parent, name = split_path(relative_path)
+        siblings = self.children.get(parent)
+        if siblings is None or name not in siblings:
+            return
+
+        if siblings.pop(name) is None:
+            self._forget_directory(relative_path)
+        self._invalidate(parent)
+
+    def hash(self, directory: str = ROOT) -> str | None:
+        """
+        the hex hash of the directory, None if it does not exist
+        """
+        if directory in self.hashes:
+            return self.hashes[directory]
+        if directory not in self.children:
+            return None
+
+        hasher = new_hasher(self.algorithm)
+        for name, digest in sorted(self.children[directory].items()):
+            if digest is None:
+                kind, digest = DIRECTORY_KIND, self.hash(join_path(directory, name))
+            else:
+                kind = FILE_KIND
+            hasher.update(name.encode() + b"\0" + kind + bytes.fromhex(digest))
+        self.hashes[directory] = hasher.hexdigest()
+        return self.hashes[directory]
+
+    def node(self, directory: str) -> dict[str, tuple[bool, str]]:
+        """
+        the children of the directory: name -> (is a directory, hex digest)
+        """
+        node = {}
+        for name, digest in self.children.get(directory, {}).items():
+            if digest is None:
+                node[name] = (True, self.hash(join_path(directory, name)))
+            else:
+                node[name] = (False, digest)
+        return node
+
+
+def encode_nodes(tree: MerkleTree, directories: list[str]) -> bytes:
+    """
+    the nodes of the directories. a directory that does not exist is sent without children
+    """
+    data = [struct.pack(NODE_COUNT_FORMAT, len(directories))]
+    for directory in directories:
+        node = tree.node(directory)
+        path = directory.encode()
+        data.append(struct.pack(f"{NAME_LENGTH_FORMAT}{len(path)}s", len(path), path))
+        data.append(struct.pack(CHILD_COUNT_FORMAT, len(node)))
+        for name, (is_dir, digest) in node.items():
+            name = name.encode()
+            data.append(struct.pack(f"{NAME_LENGTH_FORMAT}{len(name)}s", len(name), name))
+            data.append(struct.pack(IS_DIR_FORMAT, is_dir))
+            data.append(bytes.fromhex(digest))
+    return b"".join(data)
+
+
+def decode_nodes(data: bytes, digest_size: int) -> list[tuple[str, dict[str, tuple[bool, str]]]]:
+    """
+    the (directory, children) pairs that encode_nodes encoded. digest_size is the length of a raw digest
+    """
+    data = memoryview(data)
+    offset = 0
+
+    def read(layout: str):
+        nonlocal offset
+        value = struct.unpack_from(layout, data, offset)[0]
+        offset += struct.calcsize(layout)
+        return value
+
+    def read_bytes(length: int) -> bytes:
+        nonlocal offset
+        offset += length
+        return data[offset - length:offset].tobytes()
+
+    nodes = []
+    for _ in range(read(NODE_COUNT_FORMAT)):
+        directory = read_bytes(read(NAME_LENGTH_FORMAT)).decode()
+        children = {}
+        for _ in range(read(CHILD_COUNT_FORMAT)):
+            name = read_bytes(read(NAME_LENGTH_FORMAT)).decode()
+            is_dir = bool(read(IS_DIR_FORMAT))
+            children[name] = (is_dir, read_bytes(digest_size).hex())
+        nodes.append((directory, children))
+    return nodes
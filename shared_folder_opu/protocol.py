@@ -1,13 +1,18 @@
+import json
 import struct
 from enum import Enum
 from operator import xor
 
+from shared_folder_opu.compression import Compressor, Codec
+from shared_folder_opu.file_transfer import send_file_content
 from shared_folder_opu.logger_singleton import SingletonLogger
 
 logger = SingletonLogger.get_logger()
 
 MESSAGE_TYPE_LENGTH = 1
-MESSAGE_LENGTH_FIELD_LENGTH = 2
+# the payloads of sync and delta messages are framed with a 64-bit length
+MESSAGE_LENGTH_FIELD_LENGTH = 8
+VERSION_FIELD_LENGTH = 8
 FILE_NAME_LENGTH_FIELD_LENGTH = 2
 
 
@@ -16,12 +21,29 @@ class MessageType(Enum):
     USER_REQUEST = 1
     SERVER_SYNC = 2
     SERVER_FILE = 3
+    SERVER_DELTA = 4
+    USER_SYNC_REQUEST = 5
+    USER_SIGNATURE_REQUEST = 6
+    SERVER_SIGNATURES = 7
+    USER_DELTA_REQUEST = 8
+    SERVER_FILE_DELTA = 9
+    USER_HELLO = 10
+    SERVER_HELLO = 11
+    USER_BATCH_EDIT = 12
+    SERVER_BATCH_ACK = 13
+    USER_BULK_REQUEST = 14
+    SERVER_FILE_UNAVAILABLE = 15
+    SERVER_TREE_ROOT = 16
+    USER_TREE_REQUEST = 17
+    SERVER_TREE_NODES = 18
 
 
 class UserEditTypes(Enum):
     CREATE = 0
     DELETE = 1
     MODIFY = 2
+    PATCH = 3
+    MOVE = 4
 
 
 class StatusTypes(Enum):
@@ -33,20 +55,47 @@ class Message:
     def pack(self):
         raise NotImplemented
 
+    async def send(self, writer, compressor: Compressor = None):
+        """
+        write the message. messages with a big payload compress it with the compressor of the connection
+        """
+        writer.write(self.pack())
+        await writer.drain()
+
+    def supersedes(self, other: "Message") -> bool:
+        """
+        whether a queued message that was not sent yet is no longer needed once this message is queued
+        """
+        return False
+
 
 class UserEditMessage(Message):
     EDIT_TYPE_LENGTH = 1
     CODE = MessageType.USER_EDIT.value
 
-    def __init__(self, edit_type: UserEditTypes, file_name: bytes, content: bytes = None, is_dir=None):
-        logger.info(f"edit type is {edit_type.name} and content is {content}")
-        assert xor(edit_type == UserEditTypes.MODIFY, content is None)
+    def __init__(self, edit_type: UserEditTypes, file_name: bytes, source_path: str = None, is_dir=None,
+                 base_digest: str = None, target_digest: str = None, block_size: int = None,
+                 destination: bytes = None):
+        """
+        MODIFY sends the content of source_path. PATCH sends the block delta in source_path, that turns the
+        copy of the server with base_digest to the file with target_digest. the length of the digests
+        depends on the algorithm that was negotiated. MOVE renames file_name to destination
+        """
+        logger.info(f"edit type is {edit_type.name} and source path is {source_path}")
+        assert xor(edit_type in (UserEditTypes.MODIFY, UserEditTypes.PATCH), source_path is None)
         self.edit_type = UserEditTypes(edit_type)
         self.file_name = file_name
-        self.content = content
+        self.source_path = source_path
         self.is_dir = is_dir
+        self.base_digest = base_digest
+        self.target_digest = target_digest
+        self.block_size = block_size
+        self.destination = destination
 
     def pack(self) -> bytes:
+        """
+        for MODIFY and PATCH only the header is packed, the content is streamed by send
+        """
         match self.edit_type:
             case UserEditTypes.DELETE:
                 return struct.pack(f">BBH{len(self.file_name)}s",
@@ -55,13 +104,21 @@ class UserEditMessage(Message):
                                    self.file_name)
 
             case UserEditTypes.MODIFY:
-                return struct.pack(f">BBH{len(self.file_name)}sH{len(self.content)}s",
+                return struct.pack(f">BBH{len(self.file_name)}s",
+                                   self.CODE,
+                                   self.edit_type.value,
+                                   len(self.file_name),
+                                   self.file_name)
+
+            case UserEditTypes.PATCH:
+                return struct.pack(f">BBH{len(self.file_name)}s{len(self.base_digest)}s{len(self.target_digest)}sI",
                                    self.CODE,
                                    self.edit_type.value,
                                    len(self.file_name),
                                    self.file_name,
-                                   len(self.content),
-                                   self.content)
+                                   self.base_digest.encode(),
+                                   self.target_digest.encode(),
+                                   self.block_size)
 
             case UserEditTypes.CREATE:
                 return struct.pack(f">BBH{len(self.file_name)}sB",
@@ -70,49 +127,369 @@ class UserEditMessage(Message):
                                    self.file_name,
                                    self.is_dir)
 
+            case UserEditTypes.MOVE:
+                return struct.pack(f">BBH{len(self.file_name)}sH{len(self.destination)}s",
+                                   self.CODE, self.edit_type.value,
+                                   len(self.file_name),
+                                   self.file_name,
+                                   len(self.destination),
+                                   self.destination)
+
             case _:
                 raise RuntimeError(f"Attempted to pack an invalid message of type {self.edit_type.name}")
 
+    async def send(self, writer, compressor: Compressor = None):
+        if self.source_path is not None:
+            await send_file_content(writer, self.source_path, self.pack(), compressor)
+        else:
+            writer.write(self.pack())
+        await writer.drain()
+
+
+class UserBatchEditMessage(Message):
+    """
+    several edits that the server applies and acknowledges as a unit. the number of edits is written
+    first, and each edit follows as a whole USER_EDIT message
+    """
+    CODE = MessageType.USER_BATCH_EDIT.value
+    HEADER_FORMAT = ">QI"
+
+    def __init__(self, batch_id: int, edits: list[UserEditMessage]):
+        self.batch_id = batch_id
+        self.edits = edits
+
+    def pack(self):
+        return struct.pack(f">B{self.HEADER_FORMAT[1:]}", self.CODE, self.batch_id, len(self.edits))
+
+    async def send(self, writer, compressor: Compressor = None):
+        writer.write(self.pack())
+        for edit in self.edits:
+            try:
+                await edit.send(writer, compressor)
+            except FileNotFoundError:
+                # the count was already written. the file is gone, so tell the server to remove it too
+                logger.warning(f"{edit.source_path} was removed before it was sent")
+                await UserEditMessage(UserEditTypes.DELETE, edit.file_name).send(writer, compressor)
+        await writer.drain()
+
+
+class ServerBatchAckMessage(Message):
+    CODE = MessageType.SERVER_BATCH_ACK.value
+
+    def __init__(self, batch_id: int):
+        self.batch_id = batch_id
+
+    def pack(self):
+        return struct.pack(">BQ", self.CODE, self.batch_id)
+
 
 class UserRequestMessage(Message):
     CODE = MessageType.USER_REQUEST.value
 
-    def __init__(self, file_path: str, md5sum: str):
+    def __init__(self, file_path: str, digest: str):
         self.file_path = file_path
-        self.md5sum = md5sum
+        self.digest = digest
 
     def pack(self):
-        return struct.pack(f">BH{len(self.file_path)}s{len(self.md5sum)}s",
+        return struct.pack(f">BH{len(self.file_path)}s{len(self.digest)}s",
                            self.CODE,
                            len(self.file_path),
                            self.file_path.encode(),
-                           self.md5sum.encode())
+                           self.digest.encode())
+
+
+class UserBulkRequestMessage(Message):
+    """
+    request many files at once. the server answers every request in order, with the file or with
+    SERVER_FILE_UNAVAILABLE if it no longer has the requested version
+    """
+    CODE = MessageType.USER_BULK_REQUEST.value
+
+    def __init__(self, requests: list[tuple[str, str, int]]):
+        self.requests = requests  # (file path, digest, the offset to continue an interrupted transfer from)
+
+    def pack(self):
+        data = [struct.pack(">BI", self.CODE, len(self.requests))]
+        for file_path, digest, offset in self.requests:
+            file_path = file_path.encode()
+            data.append(struct.pack(f">H{len(file_path)}s{len(digest)}sQ", len(file_path), file_path, digest.encode(),
+                                    offset))
+        return b"".join(data)
+
+
+class ServerFileUnavailableMessage(Message):
+    CODE = MessageType.SERVER_FILE_UNAVAILABLE.value
+
+    def __init__(self, file_path: str):
+        self.file_path = file_path
+
+    def pack(self):
+        file_path = self.file_path.encode()
+        return struct.pack(f">BH{len(file_path)}s",
+                           self.CODE,
+                           len(file_path),
+                           file_path)
 
 
 class UserRequestResponse(Message):
+    """
+    the content of a requested file from the offset, the client already has what comes before it
+    """
     CODE = MessageType.SERVER_FILE.value
 
-    def __init__(self, file_path: str, content: str):
+    def __init__(self, file_path: str, source_path: str | bytes, offset: int = 0):
         self.file_path = file_path
-        self.content = content
+        self.source_path = source_path
+        self.offset = offset
 
     def pack(self):
-        return struct.pack(f">BH{len(self.file_path)}sH{len(self.content)}s",
+        """
+        only the header is packed, the content of the file is streamed by send
+        """
+        file_path = self.file_path.encode()
+        return struct.pack(f">BH{len(file_path)}sQ",
                            self.CODE,
-                           len(self.file_path),
-                           self.file_path.encode(),
-                           len(self.content),
-                           self.content.encode())
+                           len(file_path),
+                           file_path,
+                           self.offset)
 
+    async def send(self, writer, compressor: Compressor = None):
+        await send_file_content(writer, self.source_path, self.pack(), compressor, self.offset)
+        await writer.drain()
 
-class ServerSyncMessage(Message):
-    CODE = MessageType.SERVER_SYNC.value
+
+class UserSyncRequestMessage(Message):
+    """
+    sent by a client that missed a delta and needs the full manifest again
+    """
+    CODE = MessageType.USER_SYNC_REQUEST.value
+
+    def pack(self):
+        return struct.pack(">B", self.CODE)
+
+
+class CompressedPayloadMessage(Message):
+    """
+    a message with a payload that is compressed with the codec of each connection. the compressed payload
+    is kept per codec, so a broadcast compresses it only once
+    """
 
     def __init__(self, data: bytes):
         self.data = data
+        self._payloads = {}  # the codec of the connection -> (the codec that was used, the payload)
+
+    def pack_payload(self, codec: Codec, payload: bytes) -> bytes:
+        raise NotImplemented
+
+    def pack(self):
+        return self.pack_payload(Codec.NONE, self.data)
+
+    async def send(self, writer, compressor: Compressor = None):
+        compressor = compressor or Compressor()
+        if compressor.codec not in self._payloads:
+            self._payloads[compressor.codec] = await compressor.compress_payload(self.data)
+
+        codec, payload = self._payloads[compressor.codec]
+        writer.write(self.pack_payload(codec, payload))
+        await writer.drain()
+
+
+class ServerSyncMessage(CompressedPayloadMessage):
+    CODE = MessageType.SERVER_SYNC.value
+
+    def __init__(self, data: bytes, version: int):
+        super().__init__(data)
+        self.version = version
+
+    def supersedes(self, other: Message) -> bool:
+        # the whole manifest covers any older manifest or delta
+        return isinstance(other, (ServerSyncMessage, ServerDeltaMessage)) and other.version <= self.version
+
+    def pack_payload(self, codec: Codec, payload: bytes):
+        return struct.pack(f">BQBQ{len(payload)}s",
+                           self.CODE,
+                           self.version,
+                           codec.value,
+                           len(payload),
+                           payload)
+
+
+class ServerDeltaMessage(CompressedPayloadMessage):
+    """
+    the changes of the manifest from base_version to version
+    """
+    CODE = MessageType.SERVER_DELTA.value
+
+    def __init__(self, base_version: int, version: int, data: bytes):
+        super().__init__(data)
+        self.base_version = base_version
+        self.version = version
+
+    def pack_payload(self, codec: Codec, payload: bytes):
+        return struct.pack(f">BQQBQ{len(payload)}s",
+                           self.CODE,
+                           self.base_version,
+                           self.version,
+                           codec.value,
+                           len(payload),
+                           payload)
+
+
+class UserSignatureRequestMessage(Message):
+    """
+    ask the server for the block signatures of its copy of a file, before sending a PATCH
+    """
+    CODE = MessageType.USER_SIGNATURE_REQUEST.value
+
+    def __init__(self, file_path: str):
+        self.file_path = file_path
+
+    def pack(self):
+        file_path = self.file_path.encode()
+        return struct.pack(f">BH{len(file_path)}s",
+                           self.CODE,
+                           len(file_path),
+                           file_path)
+
+
+class ServerSignaturesMessage(Message):
+    """
+    the block signatures of the copy of the server and its digest. an empty digest means the server
+    does not have the file
+    """
+    CODE = MessageType.SERVER_SIGNATURES.value
+
+    def __init__(self, file_path: str, digest: str, signatures: bytes):
+        self.file_path = file_path
+        self.digest = digest
+        self.signatures = signatures
+
+    def pack(self):
+        file_path = self.file_path.encode()
+        return struct.pack(f">BH{len(file_path)}sH{len(self.digest)}sQ{len(self.signatures)}s",
+                           self.CODE,
+                           len(file_path),
+                           file_path,
+                           len(self.digest),
+                           self.digest.encode(),
+                           len(self.signatures),
+                           self.signatures)
+
+
+class UserDeltaRequestMessage(Message):
+    """
+    ask for a file the client has an older copy of. the server answers with a block delta
+    """
+    CODE = MessageType.USER_DELTA_REQUEST.value
+
+    def __init__(self, file_path: str, digest: str, signatures: bytes):
+        self.file_path = file_path
+        self.digest = digest
+        self.signatures = signatures
+
+    def pack(self):
+        file_path = self.file_path.encode()
+        return struct.pack(f">BH{len(file_path)}s{len(self.digest)}sQ{len(self.signatures)}s",
+                           self.CODE,
+                           len(file_path),
+                           file_path,
+                           self.digest.encode(),
+                           len(self.signatures),
+                           self.signatures)
+
+
+class ServerFileDeltaMessage(Message):
+    CODE = MessageType.SERVER_FILE_DELTA.value
+
+    def __init__(self, file_path: str, block_size: int, source_path: str):
+        self.file_path = file_path
+        self.block_size = block_size
+        self.source_path = source_path
+
+    def pack(self):
+        """
+        only the header is packed, the delta is streamed by send
+        """
+        file_path = self.file_path.encode()
+        return struct.pack(f">BH{len(file_path)}sI",
+                           self.CODE,
+                           len(file_path),
+                           file_path,
+                           self.block_size)
+
+    async def send(self, writer, compressor: Compressor = None):
+        await send_file_content(writer, self.source_path, self.pack(), compressor)
+        await writer.drain()
+
+
+class HelloMessage(Message):
+    """
+    the handshake at the start of a connection. the client sends its capabilities and the server answers
+    with what it chose. both are json objects, so new capabilities can be added
+    """
+    CODE = None
+
+    def __init__(self, capabilities: dict):
+        self.capabilities = capabilities
+
+    def pack(self):
+        data = json.dumps(self.capabilities).encode()
+        return struct.pack(f">BH{len(data)}s",
+                           self.CODE,
+                           len(data),
+                           data)
+
+
+class UserHelloMessage(HelloMessage):
+    CODE = MessageType.USER_HELLO.value
+
+
+class ServerHelloMessage(HelloMessage):
+    CODE = MessageType.SERVER_HELLO.value
+
+
+class ServerTreeRootMessage(Message):
+    """
+    sent instead of the whole manifest to a client that compares merkle trees. the client asks for the
+    nodes under the root only if its own root hash is different
+    """
+    CODE = MessageType.SERVER_TREE_ROOT.value
+
+    def __init__(self, version: int, root_hash: str):
+        self.version = version
+        self.root_hash = root_hash
+
+    def pack(self):
+        root_hash = bytes.fromhex(self.root_hash)
+        return struct.pack(f">BQ{len(root_hash)}s", self.CODE, self.version, root_hash)
+
+
+class UserTreeRequestMessage(Message):
+    """
+    ask for the children of directories, with the hashes of the files and of the sub directories
+    """
+    CODE = MessageType.USER_TREE_REQUEST.value
+
+    def __init__(self, directories: list[str]):
+        self.directories = directories
 
     def pack(self):
-        return struct.pack(f">BH{len(self.data)}s",
+        data = [struct.pack(">BI", self.CODE, len(self.directories))]
+        for directory in self.directories:
+            directory = directory.encode()
+            data.append(struct.pack(f">H{len(directory)}s", len(directory), directory))
+        return b"".join(data)
+
+
+class ServerTreeNodesMessage(CompressedPayloadMessage):
+    """
+    the nodes the client asked for, encoded by merkle.encode_nodes
+    """
+    CODE = MessageType.SERVER_TREE_NODES.value
+
+    def pack_payload(self, codec: Codec, payload: bytes):
+        return struct.pack(f">BBQ{len(payload)}s",
                            self.CODE,
-                           len(self.data),
-                           self.data)
+                           codec.value,
+                           len(payload),
+                           payload)
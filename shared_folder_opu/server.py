@@ -1,69 +1,280 @@
 import asyncio
+import json
 import struct
-from asyncio import wait_for, StreamReader, StreamWriter
+from asyncio import StreamReader, StreamWriter
 
+from shared_folder_opu.broadcast_scheduler import BroadcastScheduler, BROADCAST_LATENCY, MAX_BROADCAST_DELAY
+from shared_folder_opu.compression import Compressor, choose_codec, DEFAULT_CODECS, DEFAULT_LEVELS
+from shared_folder_opu.connection import Connection
+from shared_folder_opu.general_utils import get_string
+from shared_folder_opu.hashing import DEFAULT_DIGEST, LEGACY_DIGEST
+from shared_folder_opu.journal import OperationJournal, MAX_JOURNAL_SIZE
 from shared_folder_opu.logger_singleton import SingletonLogger
-from shared_folder_opu.directory_utils import directory_to_json
-from shared_folder_opu.protocol import ServerSyncMessage, MESSAGE_TYPE_LENGTH, MessageType, Message
-from shared_folder_opu.server_handlers import handle_user_edit, handle_user_request
+from shared_folder_opu.manifest import ManifestIndex, ManifestDelta, FileEntry
+from shared_folder_opu.protocol import ServerSyncMessage, ServerDeltaMessage, MESSAGE_TYPE_LENGTH, MessageType, \
+    Message, ServerHelloMessage, ServerBatchAckMessage, ServerTreeRootMessage
+from shared_folder_opu.worker_pool import WorkerPool, DEFAULT_WORKERS
+from shared_folder_opu.server_handlers import handle_user_edit, handle_user_request, handle_signature_request, \
+    handle_user_delta_request, handle_batch_edit, handle_bulk_request, handle_tree_request
+from shared_folder_opu.subscription import Subscription
 
 logger = SingletonLogger.get_logger()
 
+# a client that falls this many messages behind is disconnected, it will sync again when it reconnects
+MAX_CLIENT_BACKLOG = 1000
+# a client that is this many messages behind gets the whole manifest instead of another delta
+COALESCE_BACKLOG = 16
+
 
 class SharedFolderServer:
-    def __init__(self, host, port, shared_dir_path):
+    def __init__(self, host, port, shared_dir_path, compression_codecs: list[str] = None,
+                 compression_levels: dict[str, int] = None, max_client_backlog: int = MAX_CLIENT_BACKLOG,
+                 coalesce_backlog: int = COALESCE_BACKLOG, max_workers: int = DEFAULT_WORKERS,
+                 digest_algorithm: str = DEFAULT_DIGEST, max_journal_size: int = MAX_JOURNAL_SIZE,
+                 broadcast_latency: float = BROADCAST_LATENCY, max_broadcast_delay: float = MAX_BROADCAST_DELAY,
+                 hash_options: dict = None):
         self.host = host
         self.port = port
         self.shared_dir_path = shared_dir_path
-        self.clients = []  # List to keep track of connected clients
+        self.clients: dict[StreamWriter, Connection] = {}  # keep track of connected clients
+        # the clients that sync only a part of the folder, and the last version each of them was sent
+        self.subscriptions: dict[StreamWriter, Subscription] = {}
+        self.client_versions: dict[StreamWriter, int] = {}
+        # every digest of the shared folder is calculated with one algorithm, the clients must support it
+        self.manifest = ManifestIndex(shared_dir_path, algorithm=digest_algorithm, hash_options=hash_options)
+        # the published deltas, a client that reconnects gets only the ones it missed
+        self.journal = OperationJournal.for_folder(shared_dir_path, max_journal_size)
+        self.compression_codecs = compression_codecs if compression_codecs is not None else DEFAULT_CODECS
+        self.compression_levels = compression_levels or DEFAULT_LEVELS
+        self.max_client_backlog = max_client_backlog
+        self.coalesce_backlog = coalesce_backlog
+        # blocking filesystem and hash work runs here, not on the event loop
+        self.workers = WorkerPool(max_workers)
+        # a burst of edits is published as one delta
+        self.broadcast_scheduler = BroadcastScheduler(self.broadcast_changes, broadcast_latency, max_broadcast_delay)
+        # the manifest snapshot is written by a worker, one save at a time
+        self.save_task = None
+        # deltas are published one at a time, and none while a new client gets its first message, so every
+        # client receives the versions in order even when a full sync is encoded by a worker
+        self.publish_lock = asyncio.Lock()
 
-    async def broadcast(self, message: Message):
+    async def broadcast(self, delta: ManifestDelta):
         """
-        send the message to all the connected clients
+        queue the delta to all the connected clients, each client has its own writer task, so a slow
+        client does not delay the others. a client that is far behind gets the whole manifest instead of
+        a delta, and the deltas it did not receive yet are dropped. a subscribed client gets only the
+        changes in its part of the folder, from the last version it was sent, and nothing when there are none.
+        the caller holds the publish lock
         """
         logger.debug(f"send broadcast to {len(self.clients)} clients")
-        for client in self.clients:
-            client.write(message.pack())
-            await client.drain()
+        message = ServerDeltaMessage(delta.base_version, delta.version, delta.to_json().encode())
+        # the manifest is at the version of the delta only until the first await
+        snapshot = self.manifest.snapshot() if any(client.backlog >= self.coalesce_backlog
+                                                   for client in self.clients.values()) else None
+        # clients with the same subscription share the work
+        sync_messages: dict[Subscription | None, ServerSyncMessage] = {}
+        parts: dict[Subscription, ManifestDelta] = {}
+        for writer, client in list(self.clients.items()):
+            if writer not in self.clients:
+                continue  # disconnected while a full sync was encoded
+            subscription = self.subscriptions.get(writer)
+            if snapshot is not None and client.backlog >= self.coalesce_backlog:
+                if subscription not in sync_messages:
+                    sync_messages[subscription] = await self.full_sync_message(subscription, snapshot)
+                client.post(sync_messages[subscription])
+            elif subscription is None:
+                client.post(message)
+            else:
+                if subscription not in parts:
+                    parts[subscription] = delta.restricted_to(subscription)
+                if parts[subscription].is_empty():
+                    continue
+                client.post(ServerDeltaMessage(self.client_versions[writer], delta.version,
+                                               parts[subscription].to_json().encode()))
+            if writer in self.client_versions:
+                self.client_versions[writer] = delta.version
+
+    def get_connection(self, writer: StreamWriter) -> Connection:
+        if writer not in self.clients:
+            return Connection(writer)
+        return self.clients[writer]
+
+    async def full_sync_message(self, subscription: Subscription = None,
+                                snapshot: tuple[dict[str, FileEntry], set[str], int] = None) -> ServerSyncMessage:
+        """
+        the whole manifest, or the part of it a subscription covers, at the version of the snapshot. a big
+        tree takes a while to encode, so a worker encodes a snapshot of it and the event loop only copies it
+        """
+        version = self.manifest.version if snapshot is None else snapshot[2]
+        data = self.manifest.encoded(subscription) if version == self.manifest.version else None
+        if data is None:
+            data = await self.workers.run(self.manifest.encode, snapshot or self.manifest.snapshot(), subscription)
+            if subscription is None:
+                self.manifest.keep_encoded(version, data)
+        return ServerSyncMessage(data, version)
+
+    def tree_root_message(self) -> ServerTreeRootMessage:
+        return ServerTreeRootMessage(self.manifest.version, self.manifest.tree.hash())
+
+    async def first_message(self, capabilities: dict, subscription: Subscription = None) -> Message:
+        """
+        the first message to a client that connected. a client that was connected before gets the deltas it
+        missed if they are still in the journal, a client that compares merkle trees asks only for the parts
+        of the folder that differ, and any other client gets the whole manifest. a subscribed client gets
+        only its part of the folder, the merkle tree covers the whole folder
+        """
+        resume = capabilities.get("resume")
+        if resume and self.journal.can_replay(resume.get("journal"), resume.get("version")):
+            delta = self.journal.replay(resume["version"])
+            logger.info(f"replay the journal from version {delta.base_version} to {delta.version}")
+            if subscription is not None:
+                delta = delta.restricted_to(subscription)
+            return ServerDeltaMessage(delta.base_version, delta.version, delta.to_json().encode())
+        if resume:
+            logger.info(f"version {resume.get('version')} is not in the journal, sync the whole folder")
+        if capabilities.get("merkle") and subscription is None:
+            return self.tree_root_message()
+        return await self.full_sync_message(subscription)
+
+    async def publish_changes(self):
+        """
+        broadcast the changes of the manifest since the last broadcast, the caller holds the publish lock.
+        the changes that arrive while a full sync is encoded are published too, so when it returns the next
+        delta starts at the current version
+        """
+        delta = self.manifest.take_delta()
+        if delta.is_empty():
+            logger.debug("the edit did not change the manifest, nothing to broadcast")
+        while not delta.is_empty():
+            self.journal.append(delta)
+            await self.broadcast(delta)
+            delta = self.manifest.take_delta()
+
+    async def broadcast_changes(self):
+        """
+        publish the changes of the manifest since the last broadcast and save the manifest now and then
+        """
+        async with self.publish_lock:
+            await self.publish_changes()
+        if self.manifest.needs_save() and (self.save_task is None or self.save_task.done()):
+            self.save_task = asyncio.create_task(self.save_manifest())
+
+    async def save_manifest(self):
+        """
+        save a copy of the manifest off the event loop, the loop only copies it
+        """
+        try:
+            await self.workers.run(self.manifest.save, self.manifest.snapshot())
+        except OSError as error:
+            logger.error(f"failed to save the manifest snapshot: {error}")
 
     async def handle_message(self, message: MessageType, reader: StreamReader, writer: StreamWriter):
         """
         call the right function to handle with the message we received
         """
+        connection = self.get_connection(writer)
         match message:
             case MessageType.USER_EDIT:
-                await handle_user_edit(reader, self.shared_dir_path)
-                await self.broadcast(ServerSyncMessage(directory_to_json(self.shared_dir_path).encode()))
+                await handle_user_edit(reader, connection, self.shared_dir_path, self.manifest, self.workers)
+                self.broadcast_scheduler.mark_dirty()
+            case MessageType.USER_BATCH_EDIT:
+                batch_id, count = await handle_batch_edit(reader, connection, self.shared_dir_path, self.manifest,
+                                                          self.workers)
+                self.broadcast_scheduler.mark_dirty(count)
+                connection.post(ServerBatchAckMessage(batch_id))
             case MessageType.USER_REQUEST:
-                await handle_user_request(reader, writer, self.shared_dir_path)
+                await handle_user_request(reader, connection, self.shared_dir_path, self.manifest)
+            case MessageType.USER_BULK_REQUEST:
+                await handle_bulk_request(reader, connection, self.shared_dir_path, self.manifest)
+            case MessageType.USER_SIGNATURE_REQUEST:
+                if await handle_signature_request(reader, connection, self.shared_dir_path, self.manifest,
+                                                  self.workers):
+                    self.broadcast_scheduler.mark_dirty()
+            case MessageType.USER_DELTA_REQUEST:
+                if await handle_user_delta_request(reader, connection, self.shared_dir_path, self.manifest,
+                                                   self.workers):
+                    self.broadcast_scheduler.mark_dirty()
+            case MessageType.USER_SYNC_REQUEST:
+                async with self.publish_lock:
+                    # the deltas that follow start where the full sync ends
+                    await self.publish_changes()
+                    message = await self.full_sync_message(self.subscriptions.get(writer))
+                    connection.post(message)
+                    if writer in self.subscriptions:
+                        self.client_versions[writer] = message.version
+            case MessageType.USER_TREE_REQUEST:
+                await handle_tree_request(reader, connection, self.manifest)
             case _:
                 logger.error(f"received invalid message type {message.name}")
 
+    async def handshake(self, reader: StreamReader, writer: StreamWriter) -> tuple[Connection, dict]:
+        """
+        the client starts with its capabilities, answer with the compression codec we chose and the digest
+        algorithm of the manifest. a client that does not list its digests is an old one that uses md5, and
+        a client that does not send a subscription syncs the whole folder.
+        return the connection and the capabilities of the client
+        """
+        data = await reader.readexactly(MESSAGE_TYPE_LENGTH)
+        message_type = MessageType(struct.unpack(">B", data)[0])
+        if message_type != MessageType.USER_HELLO:
+            raise RuntimeError(f"expected {MessageType.USER_HELLO.name} but received {message_type.name}")
+
+        capabilities = json.loads((await get_string(reader)).decode())
+        logger.debug(f"client capabilities: {capabilities}")
+        codec = choose_codec(capabilities.get("compression", []), self.compression_codecs)
+        logger.info(f"compress with {codec.name}")
+        digests = capabilities.get("digests", [LEGACY_DIGEST])
+        if self.manifest.algorithm not in digests:
+            raise RuntimeError(f"the client supports only the digests {digests}, we use {self.manifest.algorithm}")
+
+        connection = Connection(writer, Compressor(codec, self.compression_levels.get(codec.name.lower())),
+                                self.max_client_backlog)
+        await connection.send(ServerHelloMessage({"compression": codec.name.lower(),
+                                                  "digest": self.manifest.algorithm,
+                                                  "journal": self.journal.id}))
+        return connection, capabilities
+
     async def _handle_client(self, reader: StreamReader, writer: StreamWriter):
         """
         a new client is connected. wait for messages from the client and handle them. also,
-        add the writer to a list, so we can include it in the broadcast. when the client disconnects
-        we remove the writer from the list.
+        add the client to the clients, so we can include it in the broadcast. when the client disconnects
+        we remove it.
         """
-        self.clients.append(writer)  # Add client to clients list
-        writer.write(ServerSyncMessage(directory_to_json(self.shared_dir_path).encode()).pack())
-        await writer.drain()
-
         try:
-            while True:
-                await asyncio.sleep(0.1)
+            connection, capabilities = await self.handshake(reader, writer)
+            subscription = Subscription.from_json(capabilities.get("subscription"))
+            if subscription.is_everything():
+                subscription = None
+            else:
+                logger.info(f"the client subscribed to {subscription}")
+            async with self.publish_lock:
+                # the first message covers the changes that were not published yet, the next delta starts after it
+                await self.publish_changes()
+                if subscription is not None:
+                    self.subscriptions[writer] = subscription
+                    self.client_versions[writer] = self.manifest.version
+                self.clients[writer] = connection
+                connection.post(await self.first_message(capabilities, subscription))
 
-                try:
-                    data = await wait_for(reader.readexactly(MESSAGE_TYPE_LENGTH), timeout=0.01)
-                except asyncio.TimeoutError:
-                    continue
+            while True:
+                # wait for the next message, the writer task of the connection sends in the meantime
+                data = await reader.readexactly(MESSAGE_TYPE_LENGTH)
                 message_type = MessageType(struct.unpack(">B", data)[0])
                 logger.debug(f"received message of type: {message_type.name}")
                 await self.handle_message(message_type, reader, writer)
 
+        except asyncio.IncompleteReadError as error:
+            if error.partial:
+                raise
+            logger.debug("the client closed the connection")
+
         finally:
             logger.info("client disconnected")
-            self.clients.remove(writer)  # Remove client from clients list
+            connection = self.clients.pop(writer, None)
+            self.subscriptions.pop(writer, None)
+            self.client_versions.pop(writer, None)
+            if connection is not None:
+                await connection.close()
             writer.close()
             await writer.wait_closed()
 
@@ -80,8 +291,27 @@ class SharedFolderServer:
         """
         main method of the server, should call it to run the server.
         """
+        self.manifest.load()
+        self.journal.load()
+        # the journal continues only if it ends where the manifest snapshot ends, and nothing changed since
+        loaded_version = self.manifest.version
+        await self.workers.run(self.manifest.refresh)
+        if self.journal.id is None or self.journal.version != loaded_version or \
+                self.manifest.version != loaded_version:
+            self.journal.reset(self.manifest.version)
+        # nothing changes the index before we serve, so the whole tree is hashed off the event loop
+        await self.workers.run(self.manifest.tree.hash)
+        self.manifest.save()
+
         server = await asyncio.start_server(
             self.handle_client, self.host, self.port)
-        async with server:
-            await server.serve_forever()
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            await self.broadcast_scheduler.flush()
+            if self.save_task is not None:
+                await self.save_task
+            self.manifest.save()
+            self.workers.shutdown()
 
@@ -1,90 +1,369 @@
+import functools
 import os
 import struct
-from asyncio import StreamReader, StreamWriter
+import tempfile
+from asyncio import StreamReader
 from shutil import rmtree
 
+from shared_folder_opu.block_delta import sign_file, pack_signatures, unpack_signatures, write_delta, patch_into
+from shared_folder_opu.connection import Connection
 from shared_folder_opu.logger_singleton import SingletonLogger
-from shared_folder_opu.protocol import UserEditMessage, UserEditTypes, UserRequestResponse
-from shared_folder_opu.directory_utils import calculate_file_md5
-from shared_folder_opu.general_utils import get_string, get_local_file_path
+from shared_folder_opu.protocol import UserEditMessage, UserEditTypes, UserRequestResponse, ServerSignaturesMessage, \
+    ServerFileDeltaMessage, UserBatchEditMessage, MessageType, ServerFileUnavailableMessage, ServerTreeNodesMessage
+from shared_folder_opu.directory_utils import get_temp_dir, new_temp_file, place_file
+from shared_folder_opu.file_transfer import receive_file_content
+from shared_folder_opu.general_utils import get_local_file_path, get_long_string, get_string
+from shared_folder_opu.hashing import digest_length
+from shared_folder_opu.manifest import ManifestIndex
+from shared_folder_opu.merkle import encode_nodes
+from shared_folder_opu.worker_pool import WorkerPool
 
 logger = SingletonLogger.get_logger()
 
 
-async def handle_delete_file(reader: StreamReader, folder_path: str):
-    full_path = await get_local_file_path(reader, folder_path.encode())
-    logger.info(f"handle deletion of file {full_path}")
+def get_relative_path(full_path: bytes, folder_path: str) -> str:
+    return os.path.relpath(full_path.decode(), folder_path)
+
+
+def remove_path(full_path: bytes) -> bool:
+    """
+    remove a file or a directory tree. return False if it does not exist
+    """
     if not os.path.exists(full_path):
-        logger.warning(f"file {full_path} does not exist")
-        return
+        return False
 
     if os.path.isdir(full_path):
         rmtree(full_path)
     else:
         os.unlink(full_path)
+    return True
+
+
+def create_path(full_path: bytes, is_dir: bool) -> bool:
+    """
+    create an empty file or a directory. return False if the path already exists
+    """
+    if os.path.exists(full_path):
+        return False
+
+    if is_dir:
+        os.mkdir(full_path)
+    else:
+        fd = os.open(full_path, os.O_CREAT)
+        os.close(fd)
+    return True
+
+
+async def handle_delete_file(reader: StreamReader, folder_path: str, manifest: ManifestIndex, workers: WorkerPool):
+    full_path = await get_local_file_path(reader, folder_path.encode())
+    relative_path = get_relative_path(full_path, folder_path)
+    logger.info(f"handle deletion of file {full_path}")
+    if not await workers.run(remove_path, full_path, path=relative_path):
+        logger.warning(f"file {full_path} does not exist")
+    manifest.remove(relative_path)
 
 
-async def handle_create_file(reader: StreamReader, folder_path: str):
+async def handle_create_file(reader: StreamReader, folder_path: str, manifest: ManifestIndex, workers: WorkerPool):
     full_path = await get_local_file_path(reader, folder_path.encode())
+    relative_path = get_relative_path(full_path, folder_path)
     is_dir_data = await reader.readexactly(1)
     is_dir = bool(struct.unpack(">B", is_dir_data)[0])
     logger.info(f"is dir - {is_dir}")
 
     logger.info(f"handle creation of file {full_path}")
-    if os.path.exists(full_path):
+    if not await workers.run(create_path, full_path, is_dir, path=relative_path):
         logger.warning(f"{full_path} already exists, do nothing")
         return
 
     if is_dir:
-        os.mkdir(full_path)
+        manifest.add_directory(relative_path)
     else:
-        fd = os.open(full_path, os.O_CREAT)
-        os.close(fd)
+        manifest.update_file(relative_path)
+
+
+def move_path(source: bytes, destination: bytes) -> bool:
+    """
+    rename a file or a directory tree, replacing whatever is at the destination. return False if the
+    source does not exist
+    """
+    if not os.path.exists(source):
+        return False
 
+    os.makedirs(os.path.dirname(destination), exist_ok=True)
+    remove_path(destination)
+    os.rename(source, destination)
+    return True
 
-async def handle_modify_file(reader: StreamReader, folder_path: str):
+
+async def handle_move_file(reader: StreamReader, folder_path: str, manifest: ManifestIndex, workers: WorkerPool):
+    source = await get_local_file_path(reader, folder_path.encode())
+    destination = await get_local_file_path(reader, folder_path.encode())
+    relative_source = get_relative_path(source, folder_path)
+    relative_destination = get_relative_path(destination, folder_path)
+    logger.info(f"handle move of {source} to {destination}")
+    if not await workers.run(move_path, source, destination, path=(relative_source, relative_destination)):
+        logger.warning(f"{source} does not exist, do nothing")
+        return
+
+    manifest.move(relative_source, relative_destination)
+
+
+async def handle_modify_file(reader: StreamReader, folder_path: str, manifest: ManifestIndex, workers: WorkerPool):
     full_path = await get_local_file_path(reader, folder_path.encode())
+    relative_path = get_relative_path(full_path, folder_path)
     logger.info(f"handle modification of file {full_path}")
-    content = await get_string(reader)
+    temp_path, digest = await receive_file_content(reader, get_temp_dir(folder_path), manifest.algorithm,
+                                                   run=workers.run)
+
+    await workers.run(place_file, temp_path, full_path, path=relative_path)
+    manifest.update_file(relative_path, digest)
+
+
+async def send_signatures(connection: Connection, folder_path: str, relative_path: str, manifest: ManifestIndex,
+                          workers: WorkerPool) -> bool:
+    """
+    send the block signatures of our copy of the file, so the client can send a PATCH. return True if our
+    index was behind the file and was updated
+    """
+    full_path = os.path.join(folder_path, relative_path)
+    block_size, signatures, digest = 0, [], ""
+    changed = False
+    try:
+        if relative_path in manifest.files:
+            # the digest is calculated in the same pass, so it matches the signatures even if the index is behind
+            digest, block_size, signatures = await workers.run(functools.partial(sign_file, **manifest.hash_options),
+                                                               full_path, None, manifest.algorithm, path=relative_path)
+    except (FileNotFoundError, IsADirectoryError):
+        logger.warning(f"{full_path} is indexed but is not a file")
+    if not digest:
+        logger.info(f"no copy of {relative_path}, the client should send the whole file")
+    elif digest != indexed_digest(manifest, relative_path):
+        logger.warning(f"the index is behind {relative_path}, update it")
+        changed = manifest.update_file(relative_path, digest)
 
-    os.unlink(full_path)
-    with open(full_path, "w") as file_to_write:
-        file_to_write.write(content.decode())
+    await connection.send(ServerSignaturesMessage(relative_path, digest, pack_signatures(block_size, signatures)))
+    return changed
 
 
-async def handle_user_edit(reader: StreamReader, folder_path: str):
+async def handle_signature_request(reader: StreamReader, connection: Connection, folder_path: str,
+                                   manifest: ManifestIndex, workers: WorkerPool) -> bool:
+    full_path = await get_local_file_path(reader, folder_path.encode())
+    logger.debug(f"user {connection.writer} requested the signatures of {full_path}")
+    return await send_signatures(connection, folder_path, get_relative_path(full_path, folder_path), manifest, workers)
+
+
+def patch_file(full_path: bytes, block_size: int, delta_path: str, target_digest: str, temp_dir: str,
+               algorithm: str) -> str:
+    """
+    build the new file from our copy and the delta, and put it in place only if it has the expected digest.
+    return the digest of the patched file
+    """
+    fd, temp_path = tempfile.mkstemp(dir=temp_dir)
+    os.close(fd)
+    digest = patch_into(full_path, block_size, delta_path, temp_path, algorithm)
+
+    if digest != target_digest:
+        os.unlink(temp_path)
+    else:
+        # the patched file keeps the mode of our copy, an executable stays executable
+        place_file(temp_path, full_path)
+    return digest
+
+
+async def handle_patch_file(reader: StreamReader, connection: Connection, folder_path: str, manifest: ManifestIndex,
+                            workers: WorkerPool):
+    """
+    apply a block delta to our copy of the file. if our copy is not the one the delta was made for,
+    send the signatures again so the client can retry
+    """
+    full_path = await get_local_file_path(reader, folder_path.encode())
+    base_digest = (await reader.readexactly(digest_length(manifest.algorithm))).decode()
+    target_digest = (await reader.readexactly(digest_length(manifest.algorithm))).decode()
+    block_size = struct.unpack(">I", await reader.readexactly(4))[0]
+    logger.info(f"handle patch of file {full_path}")
+    temp_dir = get_temp_dir(folder_path)
+    delta_path, _ = await receive_file_content(reader, temp_dir, run=workers.run)
+
+    relative_path = get_relative_path(full_path, folder_path)
+    try:
+        entry = manifest.files.get(relative_path)
+        if entry is None or entry.digest != base_digest:
+            logger.warning(f"the patch of {full_path} was made for another version of the file")
+            await send_signatures(connection, folder_path, relative_path, manifest, workers)
+            return
+
+        digest = await workers.run(patch_file, full_path, block_size, delta_path, target_digest, temp_dir,
+                                   manifest.algorithm, path=relative_path)
+        if digest != target_digest:
+            logger.warning(f"the patched {full_path} has digest {digest} instead of {target_digest}")
+            await send_signatures(connection, folder_path, relative_path, manifest, workers)
+            return
+
+        manifest.update_file(relative_path, digest)
+    finally:
+        await workers.run(os.unlink, delta_path)
+
+
+async def handle_user_edit(reader: StreamReader, connection: Connection, folder_path: str, manifest: ManifestIndex,
+                           workers: WorkerPool):
     data = await reader.readexactly(UserEditMessage.EDIT_TYPE_LENGTH)
     edit_type = UserEditTypes(struct.unpack(">B", data)[0])
 
     match UserEditTypes(edit_type):
         case UserEditTypes.MODIFY:
-            await handle_modify_file(reader, folder_path)
+            await handle_modify_file(reader, folder_path, manifest, workers)
+        case UserEditTypes.PATCH:
+            await handle_patch_file(reader, connection, folder_path, manifest, workers)
         case UserEditTypes.CREATE:
-            await handle_create_file(reader, folder_path)
+            await handle_create_file(reader, folder_path, manifest, workers)
         case UserEditTypes.DELETE:
-            await handle_delete_file(reader, folder_path)
+            await handle_delete_file(reader, folder_path, manifest, workers)
+        case UserEditTypes.MOVE:
+            await handle_move_file(reader, folder_path, manifest, workers)
         case _:
             logger.error("received unsupported type")
 
 
-async def handle_user_request(reader: StreamReader, writer: StreamWriter, folder_path: str):
+async def handle_batch_edit(reader: StreamReader, connection: Connection, folder_path: str,
+                            manifest: ManifestIndex, workers: WorkerPool) -> tuple[int, int]:
+    """
+    apply all the edits of a batch one after another. return the id of the batch, so it can be acknowledged,
+    and the number of edits in it
+    """
+    header_length = struct.calcsize(UserBatchEditMessage.HEADER_FORMAT)
+    batch_id, count = struct.unpack(UserBatchEditMessage.HEADER_FORMAT, await reader.readexactly(header_length))
+    logger.info(f"handle batch {batch_id} of {count} edits")
+
+    for _ in range(count):
+        code = struct.unpack(">B", await reader.readexactly(1))[0]
+        if code != MessageType.USER_EDIT.value:
+            raise RuntimeError(f"expected an edit in batch {batch_id} but received message code {code}")
+        await handle_user_edit(reader, connection, folder_path, manifest, workers)
+
+    return batch_id, count
+
+
+def indexed_digest(manifest: ManifestIndex, relative_path: str) -> str | None:
+    """
+    the digest of our copy of the file. every change to the folder goes through the index, so the file
+    is not hashed again to validate a request
+    """
+    entry = manifest.files.get(relative_path)
+    return entry.digest if entry is not None else None
+
+
+def content_source(manifest: ManifestIndex, relative_path: str, digest: str) -> str | None:
+    """
+    a file with the requested content. the requested path if it still has it, otherwise any other file with
+    the same digest, so content that appears under many paths is served from whichever of them we have
+    """
+    if indexed_digest(manifest, relative_path) == digest:
+        return relative_path
+    return manifest.path_with_digest(digest)
+
+
+async def handle_user_request(reader: StreamReader, connection: Connection, folder_path: str,
+                              manifest: ManifestIndex):
     full_path = await get_local_file_path(reader, folder_path.encode())
-    expected_md5sum = await reader.readexactly(32)
-    logger.debug(f"user {writer} requested for {full_path}")
+    expected_digest = (await reader.readexactly(digest_length(manifest.algorithm))).decode()
+    logger.debug(f"user {connection.writer} requested for {full_path}")
 
-    if not os.path.exists(full_path):
-        logger.warning(f"no such file {full_path}")
-        return
+    relative_path = get_relative_path(full_path, folder_path)
+    await send_requested_file(connection, folder_path, relative_path,
+                              content_source(manifest, relative_path, expected_digest))
 
-    with open(full_path, "r") as file_to_read:
-        content = file_to_read.read()
 
-    md5sum = calculate_file_md5(full_path)
-    logger.debug(f"md5sum of {full_path} is {md5sum}")
+async def send_requested_file(connection: Connection, folder_path: str, relative_path: str, source: str | None,
+                              offset: int = 0) -> bool:
+    """
+    send the content of the source file from the offset as the requested path. return False if it was
+    not sent
+    """
+    if source is None:
+        logger.warning(f"no file has the requested content of {relative_path}")
+        return False
+    if source != relative_path:
+        logger.debug(f"send {source} that has the requested content of {relative_path}")
+
+    source_path = os.path.join(folder_path, source)
+    try:
+        await connection.send(UserRequestResponse(relative_path, source_path, offset))
+    except FileNotFoundError:
+        logger.warning(f"{source_path} was deleted before it was sent")
+        return False
+    return True
+
+
+async def handle_bulk_request(reader: StreamReader, connection: Connection, folder_path: str,
+                              manifest: ManifestIndex):
+    """
+    answer many file requests back to back, in the order they were requested. every request is answered,
+    a file that cannot be sent is answered with SERVER_FILE_UNAVAILABLE. a request with an offset continues
+    a transfer that was interrupted
+    """
+    count = struct.unpack(">I", await reader.readexactly(4))[0]
+    requests = []
+    for _ in range(count):
+        full_path = await get_local_file_path(reader, folder_path.encode())
+        expected_digest = await reader.readexactly(digest_length(manifest.algorithm))
+        offset = struct.unpack(">Q", await reader.readexactly(8))[0]
+        requests.append((full_path, expected_digest, offset))
+    logger.debug(f"user {connection.writer} requested {count} files")
+
+    for full_path, expected_digest, offset in requests:
+        relative_path = get_relative_path(full_path, folder_path)
+        source = content_source(manifest, relative_path, expected_digest.decode())
+        if source is not None and offset > manifest.files[source].size:
+            offset = 0
+        if not await send_requested_file(connection, folder_path, relative_path, source, offset):
+            await connection.send(ServerFileUnavailableMessage(relative_path))
+
+
+async def handle_user_delta_request(reader: StreamReader, connection: Connection, folder_path: str,
+                                    manifest: ManifestIndex, workers: WorkerPool) -> bool:
+    """
+    the client has an older copy of the file, send only a block delta against the signatures of its copy.
+    if our copy is not the requested version, the requested content is sent whole from a file that has it,
+    or the client is told that it is unavailable and gets the new version in a delta. return True if our
+    index was behind the file and was updated
+    """
+    full_path = await get_local_file_path(reader, folder_path.encode())
+    expected_digest = (await reader.readexactly(digest_length(manifest.algorithm))).decode()
+    block_size, signatures = unpack_signatures(await get_long_string(reader))
+    relative_path = get_relative_path(full_path, folder_path)
+    logger.debug(f"user {connection.writer} requested a delta of {full_path}")
+
+    changed = False
+    delta_path = await workers.run(new_temp_file, folder_path)
+    try:
+        try:
+            digest = await workers.run(write_delta, full_path, block_size, signatures, delta_path,
+                                       manifest.algorithm, path=relative_path)
+        except (FileNotFoundError, IsADirectoryError):
+            logger.warning(f"no such file {full_path}")
+            digest = None
+
+        if expected_digest == digest:
+            await connection.send(ServerFileDeltaMessage(relative_path, block_size, delta_path))
+            return changed
+
+        logger.warning(f"expected digest is {expected_digest} but the updated value is {digest}")
+        if digest is not None and digest != indexed_digest(manifest, relative_path):
+            # the file changed and the index missed it, publishing the change sends the client the new version
+            changed = manifest.update_file(relative_path, digest)
+        if not await send_requested_file(connection, folder_path, relative_path,
+                                         content_source(manifest, relative_path, expected_digest)):
+            await connection.send(ServerFileUnavailableMessage(relative_path))
+        return changed
+    finally:
+        await workers.run(os.unlink, delta_path)
 
-    if expected_md5sum != md5sum.encode():
-        logger.warning(f"expected md5sum is {expected_md5sum} but the updated value is {md5sum.encode()}")
-        return
 
-    writer.write(UserRequestResponse(os.path.relpath(full_path.decode(), folder_path), content).pack())
-    await writer.drain()
+async def handle_tree_request(reader: StreamReader, connection: Connection, manifest: ManifestIndex):
+    """
+    answer with the merkle tree nodes of the requested directories
+    """
+    count = struct.unpack(">I", await reader.readexactly(4))[0]
+    directories = [(await get_string(reader)).decode() for _ in range(count)]
+    logger.debug(f"user {connection.writer} requested the tree nodes of {count} directories")
+    await connection.send(ServerTreeNodesMessage(encode_nodes(manifest.tree, directories)))
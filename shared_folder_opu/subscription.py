@@ -0,0 +1,78 @@
+import fnmatch
+import os
+from typing import NamedTuple
+
+from shared_folder_opu.logger_singleton import SingletonLogger
+
+logger = SingletonLogger.get_logger()
+
+
+def _matches_pattern(relative_path: str, pattern: str) -> bool:
+    """
+    a pattern with a separator is matched against the whole relative path, any other pattern against
+    the name only, like "*.log"
+    """
+    if os.sep in pattern:
+        return fnmatch.fnmatchcase(relative_path, pattern)
+    return fnmatch.fnmatchcase(os.path.basename(relative_path), pattern)
+
+
+class Subscription(NamedTuple):
+    """
+    the part of the shared folder a client syncs: the subtrees under the roots, and in them the files that
+    match an include pattern, without the paths that match an exclude pattern or are under one. no roots
+    is the whole folder, and no include patterns is every file. the directories above the roots are part
+    of it, so the roots have their parents
+    """
+    roots: tuple[str, ...] = ()
+    include: tuple[str, ...] = ()
+    exclude: tuple[str, ...] = ()
+
+    @staticmethod
+    def from_json(data: dict | None) -> "Subscription":
+        if not data:
+            return Subscription()
+        return Subscription(tuple(os.path.normpath(root) for root in data.get("roots", []) if root.strip(os.sep)),
+                            tuple(data.get("include", [])), tuple(data.get("exclude", [])))
+
+    def to_json(self) -> dict:
+        return {"roots": list(self.roots), "include": list(self.include), "exclude": list(self.exclude)}
+
+    def is_everything(self) -> bool:
+        return not (self.roots or self.include or self.exclude)
+
+    def _is_under_root(self, relative_path: str) -> bool:
+        return not self.roots or any(relative_path == root or relative_path.startswith(root + os.sep)
+                                     for root in self.roots)
+
+    def _is_above_root(self, relative_path: str) -> bool:
+        return any(root.startswith(relative_path + os.sep) for root in self.roots)
+
+    def _is_excluded(self, relative_path: str) -> bool:
+        path = relative_path
+        while path:
+            if any(_matches_pattern(path, pattern) for pattern in self.exclude):
+                return True
+            path = os.path.dirname(path)
+        return False
+
+    def matches(self, relative_path: str, is_dir: bool = False) -> bool:
+        """
+        whether the file or the directory is synced
+        """
+        if is_dir and self._is_above_root(relative_path):
+            return True
+        if not self._is_under_root(relative_path) or self._is_excluded(relative_path):
+            return False
+        return is_dir or not self.include or any(_matches_pattern(relative_path, pattern)
+                                                 for pattern in self.include)
+
+    def filter_files(self, files: dict) -> dict:
+        if self.is_everything():
+            return files
+        return {relative_path: value for relative_path, value in files.items() if self.matches(relative_path)}
+
+    def filter_directories(self, directories) -> set[str]:
+        if self.is_everything():
+            return set(directories)
+        return {relative_path for relative_path in directories if self.matches(relative_path, is_dir=True)}
@@ -0,0 +1,168 @@
+import os
+import re
+import time
+
+from shared_folder_opu.logger_singleton import SingletonLogger
+
+logger = SingletonLogger.get_logger()
+
+# the ignore file at the top of the shared folder. it is synced like any other file, so every client and the
+# server ignore the same paths
+SYNC_IGNORE_NAME = ".syncignore"
+# the ignore file is checked for changes at most this often
+RELOAD_CHECK_INTERVAL = 1.0
+
+
+def _translate(pattern: str) -> str:
+    """
+    the regular expression of a gitignore glob. * and ? do not match a separator, ** matches any number
+    of directories
+    """
+    regex = []
+    index = 0
+    while index < len(pattern):
+        char = pattern[index]
+        if pattern.startswith("**/", index):
+            regex.append("(?:.*/)?")
+            index += 3
+            continue
+        if pattern.startswith("**", index):
+            regex.append(".*")
+            index += 2
+            continue
+        if char == "*":
+            regex.append("[^/]*")
+        elif char == "?":
+            regex.append("[^/]")
+        elif char == "[":
+            end = pattern.find("]", index + 2)
+            if end == -1:
+                regex.append(re.escape(char))
+            else:
+                members = pattern[index + 1:end].replace("\\", "\\\\")
+                if members.startswith("!"):
+                    members = "^" + members[1:]
+                regex.append(f"[{members}]")
+                index = end
+        elif char == "\\" and index + 1 < len(pattern):
+            index += 1
+            regex.append(re.escape(pattern[index]))
+        else:
+            regex.append(re.escape(char))
+        index += 1
+    return "".join(regex)
+
+
+class IgnoreRule:
+    """
+    one line of an ignore file
+    """
+
+    def __init__(self, line: str):
+        self.negated = line.startswith("!")
+        if self.negated:
+            line = line[1:]
+        elif line.startswith("\\"):
+            line = line[1:]
+        self.directory_only = line.endswith("/")
+        line = line.rstrip("/")
+        # a pattern with a separator is relative to the top of the folder, any other pattern matches at any depth
+        anchored = "/" in line
+        prefix = "" if anchored else "(?:.*/)?"
+        self.regex = re.compile(f"{prefix}{_translate(line.lstrip('/'))}")
+
+    def matches(self, path: str, is_dir: bool) -> bool:
+        return (is_dir or not self.directory_only) and self.regex.fullmatch(path) is not None
+
+
+class IgnoreRules:
+    """
+    the compiled rules of an ignore file, in gitignore syntax: blank lines and lines that start with # are
+    skipped, a pattern that ends with / matches only directories, and a pattern that starts with ! includes
+    again what an earlier pattern ignored. the last matching pattern decides. without negated patterns, all
+    the patterns are one regular expression
+    """
+
+    def __init__(self, lines: list[str]):
+        self.rules = []
+        for line in lines:
+            line = line.rstrip("\n").rstrip()
+            if line and not line.startswith("#"):
+                self.rules.append(IgnoreRule(line))
+        self.combined = None
+        if not any(rule.negated for rule in self.rules):
+            files = [f"(?:{rule.regex.pattern})" for rule in self.rules if not rule.directory_only]
+            directories = [f"(?:{rule.regex.pattern})" for rule in self.rules]
+            self.combined = (re.compile("|".join(files)) if files else None,
+                             re.compile("|".join(directories)) if directories else None)
+
+    def matches(self, relative_path: str, is_dir: bool = False) -> bool:
+        """
+        whether the path itself is ignored, its parents are not checked
+        """
+        path = relative_path.replace(os.sep, "/")
+        if self.combined is not None:
+            regex = self.combined[is_dir]
+            return regex is not None and regex.fullmatch(path) is not None
+        for rule in reversed(self.rules):
+            if rule.matches(path, is_dir):
+                return not rule.negated
+        return False
+
+
+class SyncIgnore:
+    """
+    the ignore file of a shared folder. it is read again when it changed, so a new pattern applies to the
+    next event and the next walk. it is used from the event loop and from the observer thread, a reload
+    replaces the rules at once
+    """
+
+    def __init__(self, dir_path: str, check_interval: float = RELOAD_CHECK_INTERVAL):
+        self.path = os.path.join(dir_path, SYNC_IGNORE_NAME)
+        self.check_interval = check_interval
+        self.rules = IgnoreRules([])
+        self._stat = None
+        self._next_check = 0.0
+
+    def current(self) -> IgnoreRules:
+        """
+        the rules, read again if the ignore file changed since it was read
+        """
+        now = time.monotonic()
+        if now < self._next_check:
+            return self.rules
+        self._next_check = now + self.check_interval
+        try:
+            stat = os.stat(self.path)
+            stat = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+        except FileNotFoundError:
+            stat = None
+        if stat != self._stat:
+            self._stat = stat
+            self.rules = IgnoreRules(self._read() if stat is not None else [])
+            logger.info(f"loaded {len(self.rules.rules)} patterns from {self.path}")
+        return self.rules
+
+    def _read(self) -> list[str]:
+        try:
+            with open(self.path, "r", errors="replace") as ignore_file:
+                return ignore_file.readlines()
+        except OSError as error:
+            logger.warning(f"failed to read {self.path}: {error}")
+            return []
+
+    def is_ignored(self, relative_path: str, is_dir: bool = False) -> bool:
+        """
+        whether the path or one of the directories above it is ignored
+        """
+        rules = self.current()
+        if not rules.rules:
+            return False
+        if rules.matches(relative_path, is_dir):
+            return True
+        parent = os.path.dirname(relative_path)
+        while parent:
+            if rules.matches(parent, is_dir=True):
+                return True
+            parent = os.path.dirname(parent)
+        return False
@@ -0,0 +1,62 @@
+import os
+
+from shared_folder_opu.logger_singleton import SingletonLogger
+
+logger = SingletonLogger.get_logger()
+
+
+class SyncPlan:
+    """
+    the actions that make the local folder match the remote folder, in the order they are executed:
+    removals first, then the missing directories (parents before children), then the files to request
+    """
+
+    def __init__(self):
+        self.deletes: list[str] = []  # local files that do not exist remotely
+        self.rmtrees: list[str] = []  # local directories that do not exist remotely, with everything under them
+        self.mkdirs: list[str] = []
+        self.fetches: dict[str, str] = {}  # missing files -> remote digest
+        self.updates: dict[str, str] = {}  # files whose content differs -> remote digest
+
+    def is_empty(self) -> bool:
+        return not (self.deletes or self.rmtrees or self.mkdirs or self.fetches or self.updates)
+
+    def __repr__(self):
+        return (f"SyncPlan(deletes={len(self.deletes)}, rmtrees={len(self.rmtrees)}, mkdirs={len(self.mkdirs)}, "
+                f"fetches={len(self.fetches)}, updates={len(self.updates)})")
+
+
+def _has_ancestor_in(relative_path: str, directories: set[str]) -> bool:
+    parent = os.path.dirname(relative_path)
+    while parent:
+        if parent in directories:
+            return True
+        parent = os.path.dirname(parent)
+    return False
+
+
+def plan_sync(local_files: dict[str, str], local_directories: set[str], remote_files: dict[str, str],
+              remote_directories: set[str]) -> SyncPlan:
+    """
+    diff the local index with the remote manifest. every path is looked up in a set or a dict, so the
+    plan is built in one pass over each side. a path that is a file on one side and a directory on the
+    other is removed and then created again
+    """
+    plan = SyncPlan()
+    removed_directories = local_directories - remote_directories
+    # removing a directory removes everything under it, so only the topmost ones are listed
+    plan.rmtrees = sorted(path for path in removed_directories if not _has_ancestor_in(path, removed_directories))
+    plan.deletes = sorted(path for path in local_files.keys() - remote_files.keys()
+                          if not _has_ancestor_in(path, removed_directories))
+    # the sorted order puts every directory before its children
+    plan.mkdirs = sorted(remote_directories - local_directories)
+
+    for relative_path, digest in remote_files.items():
+        local_digest = local_files.get(relative_path)
+        if local_digest is None:
+            plan.fetches[relative_path] = digest
+        elif local_digest != digest:
+            plan.updates[relative_path] = digest
+
+    logger.debug(f"planned {plan}")
+    return plan
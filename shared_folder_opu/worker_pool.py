@@ -0,0 +1,63 @@
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from shared_folder_opu.logger_singleton import SingletonLogger
+
+logger = SingletonLogger.get_logger()
+
+DEFAULT_WORKERS = min(32, (os.cpu_count() or 1) + 4)
+
+
+class WorkerPool:
+    """
+    run blocking filesystem and hash work on a bounded thread pool, so the event loop keeps serving the
+    other clients. a job on a path runs after the jobs that were submitted before it on the same path, on a
+    directory above it or on a path under it, so the removal or the move of a directory is ordered with the
+    jobs on its contents. jobs on unrelated paths run in parallel.
+    """
+
+    def __init__(self, max_workers: int = DEFAULT_WORKERS):
+        self.executor = ThreadPoolExecutor(max_workers, thread_name_prefix="worker")
+        self.last_jobs: dict[str, asyncio.Future] = {}  # path -> completes when the last job on it is done
+
+    def _related_jobs(self, path: str) -> set[asyncio.Future]:
+        """
+        the last jobs on the path, on the directories above it and on the paths under it. only the jobs
+        that did not finish are kept, so looking for the paths under it is cheap
+        """
+        jobs = set()
+        parent = path
+        while parent:
+            if parent in self.last_jobs:
+                jobs.add(self.last_jobs[parent])
+            parent = os.path.dirname(parent)
+        prefix = path + os.sep
+        jobs.update(job for job_path, job in self.last_jobs.items() if job_path.startswith(prefix))
+        return jobs
+
+    async def run(self, func, *args, path: str | tuple[str, ...] = None):
+        """
+        run the job on a worker. a job that changes more than one path, like a move, passes all of them
+        """
+        loop = asyncio.get_running_loop()
+        if path is None:
+            return await loop.run_in_executor(self.executor, func, *args)
+
+        paths = (path,) if isinstance(path, str) else path
+        previous = set().union(*(self._related_jobs(job_path) for job_path in paths))
+        done = loop.create_future()
+        for job_path in paths:
+            self.last_jobs[job_path] = done
+        try:
+            if previous:
+                await asyncio.wait(previous)
+            return await loop.run_in_executor(self.executor, func, *args)
+        finally:
+            done.set_result(None)
+            for job_path in paths:
+                if self.last_jobs.get(job_path) is done:
+                    del self.last_jobs[job_path]
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
@@ -0,0 +1,100 @@
+import hashlib
+import io
+import os
+import zlib
+
+import pytest
+
+from shared_folder_opu.block_delta import compute_signatures, generate_delta, apply_delta, roll_checksum, \
+    pack_signatures, unpack_signatures, weak_checksum, strong_hash, sign_file, COPY_INSTRUCTION
+
+BLOCK_SIZE = 2048
+
+
+def write_file(path, content: bytes):
+    with open(path, "wb") as new_file:
+        new_file.write(content)
+
+
+def test_roll_checksum_matches_adler32():
+    data = os.urandom(3 * BLOCK_SIZE)
+    checksum = weak_checksum(data[:BLOCK_SIZE])
+    for offset in range(1, 2 * BLOCK_SIZE):
+        checksum = roll_checksum(checksum, data[offset - 1], data[offset + BLOCK_SIZE - 1], BLOCK_SIZE)
+        assert checksum == zlib.adler32(data[offset:offset + BLOCK_SIZE])
+
+
+def test_signatures_pack_unpack(tmp_path):
+    write_file(tmp_path / "old", os.urandom(5 * BLOCK_SIZE + 7))
+    block_size, signatures = compute_signatures(tmp_path / "old", BLOCK_SIZE)
+
+    assert len(signatures) == 6
+    assert unpack_signatures(pack_signatures(block_size, signatures)) == (block_size, signatures)
+
+
+@pytest.mark.parametrize("change", [
+    lambda old: old[:100] + b"inserted" + old[100:],
+    lambda old: old[:5000] + old[5100:],
+    lambda old: old[:3 * BLOCK_SIZE] + b"x" * 10 + old[3 * BLOCK_SIZE + 10:],
+    lambda old: old + b"appended",
+    lambda old: b"",
+    lambda old: os.urandom(1000),
+])
+def test_delta_rebuilds_new_file(tmp_path, change):
+    old = os.urandom(10 * BLOCK_SIZE + 123)
+    new = change(old)
+    write_file(tmp_path / "old", old)
+    write_file(tmp_path / "new", new)
+
+    block_size, signatures = compute_signatures(tmp_path / "old", BLOCK_SIZE)
+    delta = io.BytesIO()
+    source_md5 = generate_delta(tmp_path / "new", block_size, signatures, delta)
+    delta.seek(0)
+    rebuilt = io.BytesIO()
+    rebuilt_md5 = apply_delta(tmp_path / "old", block_size, delta, rebuilt)
+
+    assert rebuilt.getvalue() == new
+    assert rebuilt_md5 == source_md5
+
+
+def test_small_change_sends_little_data(tmp_path):
+    old = os.urandom(100 * BLOCK_SIZE)
+    new = old[:50 * BLOCK_SIZE + 3] + b"CHANGED" + old[50 * BLOCK_SIZE + 10:]
+    write_file(tmp_path / "old", old)
+    write_file(tmp_path / "new", new)
+
+    block_size, signatures = compute_signatures(tmp_path / "old", BLOCK_SIZE)
+    delta = io.BytesIO()
+    generate_delta(tmp_path / "new", block_size, signatures, delta)
+
+    assert len(delta.getvalue()) < 2 * BLOCK_SIZE
+    assert delta.getvalue()[0] == COPY_INSTRUCTION
+
+
+def test_sign_file_hashes_in_the_same_pass(tmp_path):
+    content = os.urandom(700 * BLOCK_SIZE + 7)
+    write_file(tmp_path / "old", content)
+
+    digest, block_size, signatures = sign_file(tmp_path / "old", BLOCK_SIZE, "sha256", use_mmap=True)
+
+    assert digest == hashlib.sha256(content).hexdigest()
+    blocks = [content[offset:offset + BLOCK_SIZE] for offset in range(0, len(content), BLOCK_SIZE)]
+    assert signatures == [(weak_checksum(block), strong_hash(block)) for block in blocks]
+
+
+def test_changed_region_is_skipped_and_the_blocks_after_it_are_found(tmp_path):
+    old = os.urandom(200 * BLOCK_SIZE)
+    # longer than a block and not a multiple of it, so the blocks after it are shifted
+    new = old[:50 * BLOCK_SIZE] + os.urandom(20 * BLOCK_SIZE + 77) + old[50 * BLOCK_SIZE:]
+    write_file(tmp_path / "old", old)
+    write_file(tmp_path / "new", new)
+
+    block_size, signatures = compute_signatures(tmp_path / "old", BLOCK_SIZE)
+    delta = io.BytesIO()
+    generate_delta(tmp_path / "new", block_size, signatures, delta)
+    delta.seek(0)
+    rebuilt = io.BytesIO()
+    apply_delta(tmp_path / "old", block_size, delta, rebuilt)
+
+    assert rebuilt.getvalue() == new
+    assert len(delta.getvalue()) < 40 * BLOCK_SIZE
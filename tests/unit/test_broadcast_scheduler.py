@@ -0,0 +1,37 @@
+import asyncio
+
+import pytest
+
+from unittest.mock import AsyncMock
+
+from shared_folder_opu.broadcast_scheduler import BroadcastScheduler
+
+
+@pytest.mark.asyncio
+async def test_burst_of_edits_is_published_once():
+    publish = AsyncMock()
+    scheduler = BroadcastScheduler(publish, latency=0.01, max_delay=1.0)
+
+    for _ in range(100):
+        scheduler.mark_dirty()
+    scheduler.mark_dirty(5)
+    await asyncio.sleep(0.05)
+
+    publish.assert_awaited_once()
+    assert (scheduler.broadcasts, scheduler.published_edits, scheduler.max_edits_per_broadcast) == (1, 105, 105)
+    await scheduler.flush()
+    publish.assert_awaited_once()
+
+
+@pytest.mark.asyncio
+async def test_edits_that_keep_coming_are_published_after_max_delay():
+    publish = AsyncMock()
+    scheduler = BroadcastScheduler(publish, latency=0.02, max_delay=0.05)
+
+    for _ in range(10):
+        scheduler.mark_dirty()
+        await asyncio.sleep(0.01)
+
+    assert publish.await_count >= 1
+    await scheduler.flush()
+    assert scheduler.published_edits == 10
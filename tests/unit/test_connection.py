@@ -0,0 +1,67 @@
+import asyncio
+
+import pytest
+
+from unittest.mock import MagicMock
+
+from shared_folder_opu.connection import Connection
+from shared_folder_opu.protocol import ServerSyncMessage, ServerDeltaMessage, UserSyncRequestMessage
+
+
+def stalled_writer() -> tuple[MagicMock, asyncio.Event]:
+    """
+    a writer of a peer that does not read, drain waits until the event is set
+    """
+    unblock = asyncio.Event()
+    writer = MagicMock()
+
+    async def drain():
+        await unblock.wait()
+
+    writer.drain = drain
+    return writer, unblock
+
+
+@pytest.mark.asyncio
+async def test_messages_are_written_in_order():
+    written = []
+    writer, unblock = stalled_writer()
+    writer.write.side_effect = written.append
+    unblock.set()
+    connection = Connection(writer)
+
+    connection.post(ServerDeltaMessage(1, 2, b"{}"))
+    await connection.send(UserSyncRequestMessage())
+
+    assert [data[0] for data in written] == [ServerDeltaMessage.CODE, UserSyncRequestMessage.CODE]
+    await connection.close()
+
+
+@pytest.mark.asyncio
+async def test_sync_supersedes_queued_deltas():
+    writer, unblock = stalled_writer()
+    connection = Connection(writer)
+    connection.post(UserSyncRequestMessage())
+    await asyncio.sleep(0)  # the writer task is stuck on the first message
+
+    connection.post(ServerDeltaMessage(1, 2, b"{}"))
+    connection.post(ServerDeltaMessage(2, 3, b"{}"))
+    sync_message = ServerSyncMessage(b"[{}, []]", 3)
+    connection.post(sync_message)
+
+    assert [message for message, _ in connection.queue] == [sync_message]
+    await connection.close()
+
+
+@pytest.mark.asyncio
+async def test_peer_over_backlog_is_disconnected():
+    writer, unblock = stalled_writer()
+    connection = Connection(writer, max_backlog=3)
+    for version in range(5):
+        connection.post(ServerDeltaMessage(version, version + 1, b"{}"))
+    await asyncio.sleep(0)
+
+    writer.transport.abort.assert_called_once()
+    assert connection.backlog == 0
+    with pytest.raises(ConnectionResetError):
+        await connection.send(UserSyncRequestMessage())
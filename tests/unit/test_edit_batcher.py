@@ -0,0 +1,203 @@
+import os
+
+import pytest
+
+from unittest.mock import MagicMock
+
+from shared_folder_opu.block_delta import DELTA_MIN_SIZE
+from shared_folder_opu.edit_batcher import EditBatcher
+from shared_folder_opu.manifest import ManifestIndex
+from shared_folder_opu.protocol import UserEditTypes, UserBatchEditMessage, UserSignatureRequestMessage
+from shared_folder_opu.subscription import Subscription
+
+
+def posted_edits(connection: MagicMock) -> list[tuple[UserEditTypes, bytes]]:
+    (batch,), _ = connection.post.call_args
+    assert isinstance(batch, UserBatchEditMessage)
+    return [(edit.edit_type, edit.file_name) for edit in batch.edits]
+
+
+@pytest.mark.asyncio
+async def test_events_of_a_path_are_collapsed(tmp_path):
+    with open(os.path.join(tmp_path, "a"), "wb") as new_file:
+        new_file.write(b"123")
+    connection = MagicMock()
+    batcher = EditBatcher(connection, str(tmp_path))
+
+    batcher.add(UserEditTypes.CREATE, "a")
+    batcher.add(UserEditTypes.MODIFY, "a")
+    batcher.add(UserEditTypes.MODIFY, "a")
+    batcher.add(UserEditTypes.CREATE, "temp")
+    batcher.add(UserEditTypes.DELETE, "temp")
+    batcher.flush()
+
+    assert posted_edits(connection) == [(UserEditTypes.MODIFY, b"a")]
+
+
+@pytest.mark.asyncio
+async def test_removals_come_before_directories_and_files(tmp_path):
+    os.mkdir(os.path.join(tmp_path, "dir"))
+    with open(os.path.join(tmp_path, "dir", "a"), "wb") as new_file:
+        new_file.write(b"123")
+    connection = MagicMock()
+    batcher = EditBatcher(connection, str(tmp_path))
+
+    batcher.add(UserEditTypes.CREATE, os.path.join("dir", "a"))
+    batcher.add(UserEditTypes.CREATE, "dir", is_dir=True)
+    batcher.add(UserEditTypes.MODIFY, os.path.join("old", "b"))
+    batcher.add(UserEditTypes.DELETE, "old", is_dir=True)
+    batcher.flush()
+
+    assert posted_edits(connection) == [
+        (UserEditTypes.DELETE, b"old"),
+        (UserEditTypes.CREATE, b"dir"),
+        (UserEditTypes.MODIFY, os.path.join("dir", "a").encode()),
+    ]
+    assert list(batcher.unacknowledged) == [1]
+    batcher.acknowledge(1)
+    assert batcher.unacknowledged == {}
+
+
+@pytest.mark.asyncio
+async def test_changes_are_kept_while_detached_and_resent_on_attach(tmp_path):
+    for file_name in ("a", "gone"):
+        with open(os.path.join(tmp_path, file_name), "wb") as new_file:
+            new_file.write(b"123")
+    connection = MagicMock()
+    batcher = EditBatcher(connection, str(tmp_path))
+    batcher.add(UserEditTypes.CREATE, "a")
+    batcher.add(UserEditTypes.CREATE, "gone")
+    batcher.flush()
+
+    # the batch was not acknowledged when the connection was lost
+    batcher.detach()
+    os.unlink(os.path.join(tmp_path, "gone"))
+    batcher.add(UserEditTypes.CREATE, "dir", is_dir=True)
+    batcher.flush()
+    assert batcher.changed_paths() == {"a", "gone", "dir"}
+
+    new_connection = MagicMock()
+    batcher.attach(new_connection)
+
+    assert posted_edits(new_connection) == [
+        (UserEditTypes.DELETE, b"gone"),
+        (UserEditTypes.CREATE, b"dir"),
+        (UserEditTypes.MODIFY, b"a"),
+    ]
+
+
+@pytest.mark.asyncio
+async def test_signature_requests_without_a_delta_are_sent_again_on_attach(tmp_path):
+    for file_name, size in (("big", DELTA_MIN_SIZE), ("small", 3)):
+        with open(os.path.join(tmp_path, file_name), "wb") as new_file:
+            new_file.write(b"1" * size)
+    connection = MagicMock()
+    batcher = EditBatcher(connection, str(tmp_path))
+    batcher.add(UserEditTypes.MODIFY, "big")
+    batcher.add(UserEditTypes.MODIFY, "small")
+    batcher.flush()
+    (batch,), _ = connection.post.call_args_list[0]
+    (request,), _ = connection.post.call_args_list[1]
+    assert isinstance(request, UserSignatureRequestMessage) and request.file_path == "big"
+
+    # the batch of the small file was applied, the signatures of the big one never came
+    batcher.acknowledge(batch.batch_id)
+    batcher.detach()
+    assert batcher.changed_paths() == {"big"}
+
+    new_connection = MagicMock()
+    batcher.attach(new_connection)
+
+    (request,), _ = new_connection.post.call_args
+    assert isinstance(request, UserSignatureRequestMessage) and request.file_path == "big"
+    batcher.signatures_answered("big")
+    assert batcher.changed_paths() == set()
+
+
+@pytest.mark.asyncio
+async def test_moves_are_sent_between_removals_and_creations(tmp_path):
+    os.makedirs(os.path.join(tmp_path, "new", "sub"))
+    with open(os.path.join(tmp_path, "new", "sub", "c"), "wb") as new_file:
+        new_file.write(b"123")
+    connection = MagicMock()
+    batcher = EditBatcher(connection, str(tmp_path))
+
+    batcher.add(UserEditTypes.DELETE, "old")
+    batcher.add(UserEditTypes.MOVE, "dir", is_dir=True, destination="new")
+    # the observer reports the moves under the moved directory too
+    batcher.add(UserEditTypes.MOVE, os.path.join("dir", "sub"), is_dir=True, destination=os.path.join("new", "sub"))
+    batcher.add(UserEditTypes.CREATE, os.path.join("new", "sub", "c"))
+    batcher.add(UserEditTypes.DELETE, os.path.join("new", "b"))
+    batcher.flush()
+
+    (batch,), _ = connection.post.call_args
+    assert [(edit.edit_type, edit.file_name, edit.destination) for edit in batch.edits] == [
+        (UserEditTypes.DELETE, b"old", None),
+        (UserEditTypes.MOVE, b"dir", b"new"),
+        (UserEditTypes.DELETE, os.path.join("new", "b").encode(), None),
+        (UserEditTypes.MODIFY, os.path.join("new", "sub", "c").encode(), None),
+    ]
+
+
+@pytest.mark.asyncio
+async def test_move_of_a_changed_file_is_sent_as_removal_and_upload(tmp_path):
+    with open(os.path.join(tmp_path, "b"), "wb") as new_file:
+        new_file.write(b"123")
+    connection = MagicMock()
+    batcher = EditBatcher(connection, str(tmp_path))
+
+    batcher.add(UserEditTypes.MODIFY, "a")
+    batcher.add(UserEditTypes.MOVE, "a", destination="b")
+    batcher.flush()
+
+    assert posted_edits(connection) == [(UserEditTypes.DELETE, b"a"), (UserEditTypes.MODIFY, b"b")]
+
+
+@pytest.mark.asyncio
+async def test_removal_and_creation_of_the_same_inode_is_sent_as_a_move(tmp_path):
+    with open(os.path.join(tmp_path, "a"), "wb") as new_file:
+        new_file.write(b"123")
+    index = ManifestIndex(str(tmp_path))
+    index.refresh()
+    connection = MagicMock()
+    batcher = EditBatcher(connection, str(tmp_path), index=index)
+
+    os.mkdir(os.path.join(tmp_path, "dir"))
+    os.rename(os.path.join(tmp_path, "a"), os.path.join(tmp_path, "dir", "b"))
+    batcher.add(UserEditTypes.CREATE, "dir", is_dir=True)
+    batcher.add(UserEditTypes.CREATE, os.path.join("dir", "b"))
+    batcher.flush()
+    # the removal is reported after the batch was sent
+    batcher.add(UserEditTypes.DELETE, "a")
+
+    (batch,), _ = connection.post.call_args
+    assert [(edit.edit_type, edit.file_name, edit.destination) for edit in batch.edits] == [
+        (UserEditTypes.MOVE, b"a", os.path.join("dir", "b").encode()),
+        (UserEditTypes.CREATE, b"dir", None),
+        (UserEditTypes.MODIFY, os.path.join("dir", "b").encode(), None),
+    ]
+    assert batcher.pending == {}
+
+
+@pytest.mark.asyncio
+async def test_changes_outside_the_subscription_are_not_sent(tmp_path):
+    os.makedirs(os.path.join(tmp_path, "synced", "dir"))
+    with open(os.path.join(tmp_path, "synced", "dir", "a"), "wb") as new_file:
+        new_file.write(b"123")
+    connection = MagicMock()
+    subscription = Subscription(roots=("synced",), exclude=("*.log",))
+    batcher = EditBatcher(connection, str(tmp_path), subscription=subscription)
+
+    batcher.add(UserEditTypes.MODIFY, os.path.join("other", "b"))
+    batcher.add(UserEditTypes.MODIFY, os.path.join("synced", "c.log"))
+    batcher.add(UserEditTypes.MOVE, os.path.join("synced", "d"), destination=os.path.join("other", "d"))
+    batcher.add(UserEditTypes.MOVE, os.path.join("other", "dir"), is_dir=True,
+                destination=os.path.join("synced", "dir"))
+    batcher.add(UserEditTypes.MOVE, os.path.join("other", "dir", "a"), destination=os.path.join("synced", "dir", "a"))
+    batcher.flush()
+
+    assert posted_edits(connection) == [
+        (UserEditTypes.DELETE, os.path.join("synced", "d").encode()),
+        (UserEditTypes.CREATE, os.path.join("synced", "dir").encode()),
+        (UserEditTypes.MODIFY, os.path.join("synced", "dir", "a").encode()),
+    ]
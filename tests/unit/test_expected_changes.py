@@ -0,0 +1,65 @@
+import os
+
+from watchdog.events import FileCreatedEvent, FileModifiedEvent, FileDeletedEvent, DirCreatedEvent, DirDeletedEvent, \
+    FileMovedEvent, DirMovedEvent
+
+from shared_folder_opu.expected_changes import ExpectedChanges
+from shared_folder_opu.hashing import hash_file
+
+
+def test_written_file_is_expected_only_with_its_content(tmp_path):
+    path = os.path.join(tmp_path, "a")
+    with open(path, "wb") as new_file:
+        new_file.write(b"123")
+    expected_changes = ExpectedChanges(str(tmp_path))
+    expected_changes.expect_file(path.encode(), hash_file(path).encode())
+
+    assert expected_changes.is_expected(FileCreatedEvent(path))
+    assert expected_changes.is_expected(FileModifiedEvent(path))
+
+    with open(path, "wb") as new_file:
+        new_file.write(b"changed by the user")
+    assert not expected_changes.is_expected(FileModifiedEvent(path))
+
+
+def test_removed_directory_covers_its_children(tmp_path):
+    expected_changes = ExpectedChanges(str(tmp_path))
+    directory = os.path.join(tmp_path, "dir")
+    expected_changes.expect_removed(directory)
+
+    assert expected_changes.is_expected(FileDeletedEvent(os.path.join(directory, "sub", "a")))
+    assert expected_changes.is_expected(DirDeletedEvent(directory))
+    # the removal was seen, a later deletion is made by the user
+    assert not expected_changes.is_expected(DirDeletedEvent(directory))
+    assert not expected_changes.is_expected(FileDeletedEvent(os.path.join(tmp_path, "other")))
+
+
+def test_created_directory_is_expected_once(tmp_path):
+    expected_changes = ExpectedChanges(str(tmp_path))
+    directory = os.path.join(tmp_path, "dir")
+    expected_changes.expect_directory(directory)
+
+    assert expected_changes.is_expected(DirCreatedEvent(directory))
+    assert not expected_changes.is_expected(DirCreatedEvent(directory))
+
+
+def test_expectations_expire(tmp_path):
+    expected_changes = ExpectedChanges(str(tmp_path), ttl=0)
+    expected_changes.expect_removed(os.path.join(tmp_path, "a"))
+
+    assert not expected_changes.is_expected(FileDeletedEvent(os.path.join(tmp_path, "a")))
+    assert expected_changes.expected == {}
+
+
+def test_moved_directory_covers_the_moves_under_it(tmp_path):
+    expected_changes = ExpectedChanges(str(tmp_path))
+    source = os.path.join(tmp_path, "dir")
+    destination = os.path.join(tmp_path, "new", "dir2")
+    expected_changes.expect_moved(source, destination)
+
+    assert expected_changes.is_expected(DirMovedEvent(source, destination))
+    assert expected_changes.is_expected(FileMovedEvent(os.path.join(source, "sub", "a"),
+                                                       os.path.join(destination, "sub", "a")))
+    assert not expected_changes.is_expected(FileMovedEvent(os.path.join(source, "a"),
+                                                           os.path.join(destination, "b")))
+    assert not expected_changes.is_expected(DirMovedEvent(destination, source))
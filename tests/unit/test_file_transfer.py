@@ -0,0 +1,141 @@
+import asyncio
+import os
+import socket
+import stat
+
+import pytest
+
+from unittest.mock import MagicMock, AsyncMock, patch
+
+from shared_folder_opu.compression import Codec, Compressor
+from shared_folder_opu.hashing import hash_file
+from shared_folder_opu.file_transfer import send_file_content, receive_file_content, clone_file, TRANSFER_CHUNK_SIZE
+
+
+async def transfer(tmp_path, content: bytes, compressor: Compressor = None) -> tuple[bytes, bytes]:
+    """
+    send the content with send_file_content and receive it with receive_file_content.
+    return what was written on the wire and what was received
+    """
+    source_path = os.path.join(tmp_path, "source")
+    with open(source_path, "wb") as source:
+        source.write(content)
+
+    written = []
+    writer = MagicMock()
+    writer.write.side_effect = written.append
+    writer.drain = AsyncMock()
+    await send_file_content(writer, source_path, b"", compressor)
+
+    reader = asyncio.StreamReader()
+    reader.feed_data(b"".join(written))
+    reader.feed_eof()
+    temp_path, digest = await receive_file_content(reader, str(tmp_path))
+    with open(temp_path, "rb") as received:
+        received_content = received.read()
+
+    assert digest == hash_file(source_path)
+    return b"".join(written), received_content
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("codec", [Codec.NONE, Codec.ZLIB, Codec.LZMA])
+async def test_transfer_round_trip(tmp_path, codec):
+    content = b"some text that repeats itself " * (TRANSFER_CHUNK_SIZE // 10)
+
+    wire, received = await transfer(tmp_path, content, Compressor(codec))
+
+    assert received == content
+    if codec != Codec.NONE:
+        assert len(wire) < len(content) / 10
+
+
+@pytest.mark.asyncio
+async def test_random_content_is_not_compressed(tmp_path):
+    content = os.urandom(100 * 1024)
+
+    wire, received = await transfer(tmp_path, content, Compressor(Codec.ZLIB))
+
+    assert received == content
+    assert wire[8] == Codec.NONE.value
+
+
+@pytest.mark.asyncio
+async def test_small_content_is_not_compressed(tmp_path):
+    content = b"a" * 100
+
+    wire, received = await transfer(tmp_path, content, Compressor(Codec.ZLIB))
+
+    assert received == content
+    assert wire[8] == Codec.NONE.value
+
+
+@pytest.mark.asyncio
+async def test_raw_content_is_sent_with_sendfile(tmp_path):
+    content = os.urandom(3 * TRANSFER_CHUNK_SIZE + 1)
+    source_path = os.path.join(tmp_path, "source")
+    with open(source_path, "wb") as source:
+        source.write(content)
+
+    server_sock, client_sock = socket.socketpair()
+    reader, receiving_writer = await asyncio.open_connection(sock=server_sock)
+    _, writer = await asyncio.open_connection(sock=client_sock)
+    loop = asyncio.get_running_loop()
+    with patch.object(loop, "sendfile", wraps=loop.sendfile) as mock_sendfile:
+        sending = asyncio.create_task(send_file_content(writer, source_path, b"", Compressor(Codec.ZLIB)))
+        temp_path, digest = await receive_file_content(reader, str(tmp_path))
+        await sending
+    writer.close()
+    receiving_writer.close()
+
+    mock_sendfile.assert_called_once()
+    assert digest == hash_file(source_path)
+    with open(temp_path, "rb") as received:
+        assert received.read() == content
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("codec", [Codec.NONE, Codec.ZLIB])
+async def test_interrupted_transfer_continues_from_offset(tmp_path, codec):
+    content = os.urandom(TRANSFER_CHUNK_SIZE) + b"compressible " * TRANSFER_CHUNK_SIZE
+    source_path = os.path.join(tmp_path, "source")
+    with open(source_path, "wb") as source:
+        source.write(content)
+    partial_path = os.path.join(tmp_path, "partial")
+
+    async def receive(offset: int, cut: int = None) -> str:
+        written = []
+        writer = MagicMock()
+        writer.write.side_effect = written.append
+        writer.drain = AsyncMock()
+        await send_file_content(writer, source_path, b"", Compressor(codec), offset)
+        reader = asyncio.StreamReader()
+        reader.feed_data(b"".join(written)[:cut])
+        reader.feed_eof()
+        return (await receive_file_content(reader, str(tmp_path), partial_path=partial_path, offset=offset))[1]
+
+    with pytest.raises(asyncio.IncompleteReadError):
+        await receive(0, cut=TRANSFER_CHUNK_SIZE + 1000)
+    # the partial file is kept, with what was received before the connection was lost
+    offset = os.path.getsize(partial_path)
+    assert 0 < offset < len(content)
+
+    assert await receive(offset) == hash_file(source_path)
+    with open(partial_path, "rb") as received:
+        assert received.read() == content
+
+
+def test_clone_file_copies_and_hashes_the_content(tmp_path):
+    source_path = os.path.join(tmp_path, "source")
+    with open(source_path, "wb") as source:
+        source.write(os.urandom(3 * TRANSFER_CHUNK_SIZE))
+    os.chmod(source_path, 0o754)
+
+    # without reflinks the file is copied
+    with patch("shared_folder_opu.file_transfer._reflink", return_value=False):
+        temp_path, digest = clone_file(source_path, str(tmp_path))
+
+    assert digest == hash_file(source_path)
+    assert stat.S_IMODE(os.stat(temp_path).st_mode) == 0o754
+    with open(temp_path, "rb") as copy, open(source_path, "rb") as source:
+        assert copy.read() == source.read()
@@ -0,0 +1,46 @@
+import hashlib
+import os
+
+import pytest
+
+from shared_folder_opu.hashing import hash_file, hash_files, digest_length
+
+
+@pytest.mark.parametrize("algorithm, expected", [
+    ("blake2b", hashlib.blake2b(b"123", digest_size=32).hexdigest()),
+    ("sha256", hashlib.sha256(b"123").hexdigest()),
+    ("md5", hashlib.md5(b"123").hexdigest()),
+])
+def test_hash_file(tmp_path, algorithm, expected):
+    path = os.path.join(tmp_path, "a")
+    with open(path, "wb") as new_file:
+        new_file.write(b"123")
+
+    assert hash_file(path, algorithm) == expected
+    assert len(expected) == digest_length(algorithm)
+
+
+def test_hash_files_in_parallel(tmp_path):
+    paths = []
+    for index in range(20):
+        paths.append(os.path.join(tmp_path, str(index)))
+        with open(paths[-1], "wb") as new_file:
+            new_file.write(os.urandom(index * 1000))
+    paths.append(os.path.join(tmp_path, "removed"))
+
+    digests = hash_files(paths, "sha256", max_workers=4)
+
+    assert digests == {path: hash_file(path, "sha256") for path in paths[:-1]} | {paths[-1]: None}
+
+
+@pytest.mark.parametrize("use_mmap", [False, True])
+@pytest.mark.parametrize("size", [0, 1000, 3 * 4096 + 1])
+def test_hash_file_in_small_chunks(tmp_path, use_mmap, size):
+    path = os.path.join(tmp_path, "a")
+    content = os.urandom(size)
+    with open(path, "wb") as new_file:
+        new_file.write(content)
+
+    digest = hash_file(path, "sha256", chunk_size=4096, use_mmap=use_mmap, drop_cache=True)
+
+    assert digest == hashlib.sha256(content).hexdigest()
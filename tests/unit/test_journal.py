@@ -0,0 +1,34 @@
+from shared_folder_opu.journal import OperationJournal, merge_deltas
+from shared_folder_opu.manifest import ManifestDelta
+
+
+def test_merge_drops_changes_under_removed_paths():
+    deltas = [ManifestDelta(0, 2, {"dir/a": "1", "b": "2"}, directories=["dir"]),
+              ManifestDelta(2, 3, removed=["dir"]),
+              ManifestDelta(3, 5, {"dir": "3", "b": "4"})]
+
+    merged = merge_deltas(deltas)
+
+    assert (merged.base_version, merged.version) == (0, 5)
+    assert merged.files == {"b": "4", "dir": "3"}
+    assert merged.removed == ["dir"]
+    assert merged.directories == []
+
+
+def test_replay_after_load_and_compaction(tmp_path):
+    journal = OperationJournal(str(tmp_path / "journal.log"), max_size=300)
+    journal.reset(10)
+    for version in range(11, 16):
+        journal.append(ManifestDelta(version - 1, version, {f"file{version}": "digest"}))
+
+    loaded = OperationJournal(journal.path, max_size=300)
+    loaded.load()
+
+    assert loaded.id == journal.id
+    assert (loaded.base_version, loaded.version) == (journal.base_version, 15)
+    assert journal.base_version > 10  # the oldest deltas were compacted away
+    assert not loaded.can_replay(journal.id, 10)
+    assert not loaded.can_replay("another journal", 15)
+    assert loaded.can_replay(journal.id, 14)
+    assert loaded.replay(14).files == {"file15": "digest"}
+    assert loaded.replay(15).is_empty()
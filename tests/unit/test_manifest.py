@@ -0,0 +1,237 @@
+import hashlib
+import json
+import os
+
+from unittest.mock import patch
+
+from shared_folder_opu.directory_utils import METADATA_DIR_NAME
+from shared_folder_opu.manifest import ManifestIndex
+
+
+def write_file(path, content: bytes):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as new_file:
+        new_file.write(content)
+
+
+def test_refresh_indexes_the_folder(tmp_path):
+    write_file(os.path.join(tmp_path, "a"), b"123")
+    write_file(os.path.join(tmp_path, "dir", "b"), b"456")
+    os.mkdir(os.path.join(tmp_path, "empty"))
+
+    manifest = ManifestIndex(str(tmp_path), algorithm="sha256")
+    manifest.refresh()
+
+    file_to_hash, directories = json.loads(manifest.to_json())
+    assert file_to_hash == {"a": hashlib.sha256(b"123").hexdigest(),
+                            os.path.join("dir", "b"): hashlib.sha256(b"456").hexdigest()}
+    assert directories == ["dir", "empty"]
+
+
+def test_refresh_rehashes_only_changed_files(tmp_path):
+    write_file(os.path.join(tmp_path, "a"), b"123")
+    write_file(os.path.join(tmp_path, "b"), b"456")
+    manifest = ManifestIndex(str(tmp_path))
+    manifest.refresh()
+
+    write_file(os.path.join(tmp_path, "b"), b"changed")
+    with patch("shared_folder_opu.hashing.hash_file", return_value="0" * 64) as mock_hash:
+        manifest.refresh()
+
+    mock_hash.assert_called_once_with(os.path.join(tmp_path, "b"), manifest.algorithm)
+    assert manifest.files["b"].digest == "0" * 64
+
+
+def test_snapshot_survives_restart(tmp_path):
+    write_file(os.path.join(tmp_path, "a"), b"123")
+    manifest = ManifestIndex(str(tmp_path))
+    manifest.refresh()
+    manifest.save()
+
+    restarted = ManifestIndex(str(tmp_path))
+    restarted.load()
+    with patch("shared_folder_opu.hashing.hash_file") as mock_hash:
+        restarted.refresh()
+
+    mock_hash.assert_not_called()
+    assert restarted.file_to_hash() == manifest.file_to_hash()
+    assert METADATA_DIR_NAME not in restarted.directories
+
+
+def test_remove_directory_removes_children(tmp_path):
+    write_file(os.path.join(tmp_path, "dir", "a"), b"123")
+    write_file(os.path.join(tmp_path, "dir2", "b"), b"456")
+    manifest = ManifestIndex(str(tmp_path))
+    manifest.refresh()
+
+    manifest.remove("dir")
+
+    assert list(manifest.files.keys()) == [os.path.join("dir2", "b")]
+    assert manifest.directories == {"dir2"}
+
+
+def test_take_delta_contains_only_changes(tmp_path):
+    write_file(os.path.join(tmp_path, "a"), b"123")
+    write_file(os.path.join(tmp_path, "dir", "b"), b"456")
+    manifest = ManifestIndex(str(tmp_path))
+    manifest.refresh()
+    base_version = manifest.version
+
+    write_file(os.path.join(tmp_path, "c"), b"789")
+    manifest.update_file("c")
+    os.mkdir(os.path.join(tmp_path, "new_dir"))
+    manifest.add_directory("new_dir")
+    manifest.remove("dir")
+    delta = manifest.take_delta()
+
+    assert delta.base_version == base_version
+    assert delta.version == base_version + 3
+    assert list(delta.files.keys()) == ["c"]
+    assert delta.removed == ["dir"]
+    assert delta.directories == ["new_dir"]
+    assert manifest.take_delta().is_empty()
+
+
+def test_delta_forgets_additions_that_were_removed(tmp_path):
+    manifest = ManifestIndex(str(tmp_path))
+    manifest.refresh()
+
+    write_file(os.path.join(tmp_path, "dir", "a"), b"123")
+    manifest.add_directory("dir")
+    manifest.update_file(os.path.join("dir", "a"))
+    manifest.remove("dir")
+    delta = manifest.take_delta()
+
+    assert delta.files == {}
+    assert delta.directories == []
+    assert delta.removed == ["dir"]
+
+
+def test_update_files_rehashes_only_changed_files(tmp_path):
+    write_file(os.path.join(tmp_path, "a"), b"123")
+    write_file(os.path.join(tmp_path, "b"), b"456")
+    manifest = ManifestIndex(str(tmp_path))
+    manifest.refresh()
+
+    write_file(os.path.join(tmp_path, "a"), b"changed")
+    os.unlink(os.path.join(tmp_path, "b"))
+    with patch("shared_folder_opu.hashing.hash_file", return_value="0" * 64) as mock_hash:
+        manifest.update_files(["a", "b", "missing"])
+
+    mock_hash.assert_called_once_with(os.path.join(tmp_path, "a"), manifest.algorithm)
+    assert manifest.file_to_hash() == {"a": "0" * 64}
+
+
+def test_move_keeps_the_entries_and_reports_the_move(tmp_path):
+    write_file(os.path.join(tmp_path, "dir", "sub", "a"), b"123")
+    write_file(os.path.join(tmp_path, "b"), b"456")
+    manifest = ManifestIndex(str(tmp_path))
+    manifest.refresh()
+    entry = manifest.files[os.path.join("dir", "sub", "a")]
+
+    os.makedirs(os.path.join(tmp_path, "new"))
+    os.rename(os.path.join(tmp_path, "dir"), os.path.join(tmp_path, "new", "dir2"))
+    with patch("shared_folder_opu.manifest.hash_file") as hash_file:
+        manifest.move("dir", os.path.join("new", "dir2"))
+    hash_file.assert_not_called()
+    delta = manifest.take_delta()
+
+    assert manifest.files[os.path.join("new", "dir2", "sub", "a")] == entry
+    assert manifest.directories == {"new", os.path.join("new", "dir2"), os.path.join("new", "dir2", "sub")}
+    assert delta.removed == ["dir"]
+    assert delta.moved == [["dir", os.path.join("new", "dir2")]]
+    assert delta.files == {os.path.join("new", "dir2", "sub", "a"): entry.digest}
+    refreshed = ManifestIndex(str(tmp_path))
+    refreshed.refresh()
+    assert manifest.tree.hash() == refreshed.tree.hash()
+
+
+def test_files_are_found_by_digest(tmp_path):
+    write_file(os.path.join(tmp_path, "a"), b"123")
+    write_file(os.path.join(tmp_path, "dir", "b"), b"123")
+    manifest = ManifestIndex(str(tmp_path))
+    manifest.refresh()
+    digest = manifest.files["a"].digest
+
+    assert manifest.digest_paths == {digest: {"a", os.path.join("dir", "b")}}
+    manifest.remove("dir")
+    assert manifest.path_with_digest(digest) == "a"
+    write_file(os.path.join(tmp_path, "a"), b"456")
+    manifest.update_file("a")
+    assert manifest.path_with_digest(digest) is None
+
+
+def test_changes_mark_the_index_dirty_and_a_snapshot_is_saved_as_it_was(tmp_path):
+    write_file(os.path.join(tmp_path, "a"), b"123")
+    write_file(os.path.join(tmp_path, "b"), b"456")
+    manifest = ManifestIndex(str(tmp_path), save_every=2)
+    manifest.refresh()
+    manifest.save()
+    os.unlink(manifest.snapshot_path)
+
+    manifest.add_directory("dir")
+    assert not manifest.needs_save()
+    manifest.remove("a")
+    assert manifest.needs_save()
+    assert not os.path.exists(manifest.snapshot_path)
+
+    snapshot = manifest.snapshot()
+    assert manifest.needs_save()
+    manifest.remove("b")
+    manifest.save(snapshot)
+    assert not manifest.needs_save()
+
+    restarted = ManifestIndex(str(tmp_path))
+    restarted.load()
+    assert set(restarted.files) == {"b"}
+    assert restarted.directories == {"dir"}
+
+
+def test_directory_changes_keep_the_children_index(tmp_path):
+    for relative_path in ["a", os.path.join("dir", "b"), os.path.join("dir", "sub", "c"), os.path.join("dir2", "d")]:
+        write_file(os.path.join(tmp_path, relative_path), relative_path.encode())
+    manifest = ManifestIndex(str(tmp_path))
+    manifest.refresh()
+
+    os.rename(os.path.join(tmp_path, "dir"), os.path.join(tmp_path, "dir2", "moved"))
+    manifest.move("dir", os.path.join("dir2", "moved"))
+    os.unlink(os.path.join(tmp_path, "dir2", "d"))
+    manifest.remove(os.path.join("dir2", "d"))
+    os.unlink(os.path.join(tmp_path, "dir2", "moved", "sub", "c"))
+    os.rmdir(os.path.join(tmp_path, "dir2", "moved", "sub"))
+    manifest.remove(os.path.join("dir2", "moved", "sub"))
+
+    refreshed = ManifestIndex(str(tmp_path))
+    refreshed.refresh()
+    assert manifest.file_to_hash() == refreshed.file_to_hash()
+    assert manifest.directories == refreshed.directories
+    assert manifest.children == refreshed.children
+
+
+def test_hash_options_are_passed_to_hash_file(tmp_path):
+    write_file(os.path.join(tmp_path, "a"), b"123")
+    manifest = ManifestIndex(str(tmp_path), hash_options={"use_mmap": True, "drop_cache": True})
+
+    with patch("shared_folder_opu.hashing.hash_file", return_value="0" * 64) as mock_hash:
+        manifest.refresh()
+
+    mock_hash.assert_called_once_with(os.path.join(tmp_path, "a"), manifest.algorithm, use_mmap=True,
+                                      drop_cache=True)
+
+
+def test_an_encoded_snapshot_is_kept_only_while_the_manifest_is_at_its_version(tmp_path):
+    write_file(os.path.join(tmp_path, "a"), b"123")
+    manifest = ManifestIndex(str(tmp_path))
+    manifest.refresh()
+    snapshot = manifest.snapshot()
+    data = manifest.encode(snapshot)
+    assert data == manifest.to_bytes()
+    assert manifest.encoded() == data
+
+    manifest.add_directory("dir")
+    manifest.keep_encoded(snapshot[2], data)
+    assert manifest.encoded() is None
+
+    snapshot = manifest.snapshot()
+    manifest.keep_encoded(snapshot[2], manifest.encode(snapshot))
+    assert manifest.encoded() == manifest.to_bytes()
@@ -0,0 +1,32 @@
+import hashlib
+import time
+
+from shared_folder_opu.manifest_codec import encode_manifest, EncodedManifest
+
+
+def test_manifest_round_trip():
+    files = {
+        "dir/a": (3, 10, hashlib.md5(b"123").hexdigest()),
+        "dir/ab": (0, 20, hashlib.md5(b"").hexdigest()),
+        "ñame": (5, 30, hashlib.md5(b"12345").hexdigest()),
+    }
+    directories = {"dir", "dir/sub", "empty"}
+
+    manifest = EncodedManifest(encode_manifest(files, directories, 16))
+
+    assert list(manifest.directories()) == sorted(directories)
+    assert {path: (size, mtime_ns, digest) for path, size, mtime_ns, digest in manifest.files()} == files
+
+
+def test_big_manifest_is_compact_and_fast():
+    files = {f"some/deep/directory/file{index}": (index, index, hashlib.blake2b(str(index).encode(),
+                                                                                  digest_size=32).hexdigest())
+             for index in range(100000)}
+
+    data = encode_manifest(files, {"some", "some/deep", "some/deep/directory"}, 32)
+    start = time.process_time()
+    file_to_hash = EncodedManifest(data).file_to_hash()
+
+    assert time.process_time() - start < 2
+    assert len(data) < len(files) * 64
+    assert file_to_hash == {path: digest for path, (_, _, digest) in files.items()}
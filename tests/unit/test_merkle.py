@@ -0,0 +1,34 @@
+import hashlib
+
+from shared_folder_opu.merkle import MerkleTree, encode_nodes, decode_nodes, ROOT
+
+
+def digest(data: bytes) -> str:
+    return hashlib.md5(data).hexdigest()
+
+
+def test_incremental_changes_match_a_rebuilt_tree():
+    tree = MerkleTree.build({"a": digest(b"a"), "dir/b": digest(b"b"), "dir/sub/c": digest(b"c")}, {"dir/sub"},
+                            "md5")
+    root_hash = tree.hash()
+    unchanged_hash = tree.hash("dir/sub")
+
+    tree.set_file("dir/b", digest(b"changed"))
+    tree.remove("a")
+    tree.add_directory("empty")
+
+    assert tree.hash() != root_hash
+    assert tree.hash("dir/sub") == unchanged_hash
+    rebuilt = MerkleTree.build({"dir/b": digest(b"changed"), "dir/sub/c": digest(b"c")}, {"dir", "dir/sub", "empty"},
+                               "md5")
+    assert tree.hash() == rebuilt.hash()
+
+
+def test_nodes_round_trip():
+    tree = MerkleTree.build({"a": digest(b"a"), "dir/b": digest(b"b")}, {"dir"}, "md5")
+
+    nodes = decode_nodes(encode_nodes(tree, [ROOT, "dir", "missing"]), 16)
+
+    assert nodes == [(ROOT, {"a": (False, digest(b"a")), "dir": (True, tree.hash("dir"))}),
+                     ("dir", {"b": (False, digest(b"b"))}),
+                     ("missing", {})]
@@ -1,12 +1,20 @@
 import asyncio
+import hashlib
 import os.path
+import stat
 import struct
 import pytest
 
 from unittest.mock import AsyncMock, patch, MagicMock
 
-from shared_folder_opu.protocol import MessageType, UserEditTypes
+from shared_folder_opu.block_delta import compute_signatures, pack_signatures, write_delta
+from shared_folder_opu.compression import Codec
+from shared_folder_opu.connection import Connection
+from shared_folder_opu.directory_utils import get_temp_dir, NEW_FILE_MODE
+from shared_folder_opu.protocol import MessageType, UserEditTypes, UserRequestResponse, ServerFileUnavailableMessage, \
+    UserDeltaRequestMessage, UserSignatureRequestMessage
 from shared_folder_opu.server import SharedFolderServer
+from shared_folder_opu.server_handlers import patch_file
 
 
 @pytest.mark.asyncio
@@ -124,34 +132,77 @@ async def test_handle_create_file_when_exists(mock_open, mock_mkdir, mock_exists
 
 
 @pytest.mark.asyncio
-@patch("json.dumps")
-@patch('hashlib.md5')
-@patch("builtins.open")
-@patch("os.unlink")
-async def test_handle_modify(mock_unlink, mock_open, mock_md5, mock_dumps):
-    test_file_path = '/tmp/server1'
-    server = SharedFolderServer("localhost", 1234, test_file_path)
+async def test_handle_modify(tmp_path):
+    test_file_path = str(tmp_path)
+    server = SharedFolderServer("localhost", 1234, test_file_path, digest_algorithm="md5")
     file_name = "my_file"
     content = "BEST FILE EVER"
+    with open(os.path.join(test_file_path, file_name), "w") as old_file:
+        old_file.write("old content")
 
-    mock_dumps.return_value = ""
-    mock_md5.hexdigest.return_value = "\x00" * 32
     writer = MagicMock()
     reader = AsyncMock()
-    reader.readexactly = asyncio.coroutine(
-        AsyncMock(side_effect=[
+    reader.readexactly = AsyncMock(side_effect=[
+        struct.pack(">B", UserEditTypes.MODIFY.value),
+        struct.pack(">H", len(file_name)),
+        struct.pack(f">{len(file_name)}s", file_name.encode()),
+        struct.pack(">QB", len(content), Codec.NONE.value),
+        struct.pack(f">{len(content)}s", content.encode())
+    ])
+
+    await server.handle_message(MessageType.USER_EDIT, reader, writer)
+
+    with open(os.path.join(test_file_path, file_name)) as modified_file:
+        assert modified_file.read() == content
+    assert server.manifest.files[file_name].digest == hashlib.md5(content.encode()).hexdigest()
+    assert os.listdir(get_temp_dir(test_file_path)) == []
+
+
+@pytest.mark.asyncio
+async def test_modified_file_keeps_its_mode_and_a_new_file_gets_the_default_one(tmp_path):
+    test_file_path = str(tmp_path)
+    server = SharedFolderServer("localhost", 1234, test_file_path, digest_algorithm="md5")
+    with open(os.path.join(test_file_path, "script"), "w") as old_file:
+        old_file.write("old content")
+    os.chmod(os.path.join(test_file_path, "script"), 0o750)
+
+    writer = MagicMock()
+    for file_name in ("script", "new"):
+        reader = AsyncMock()
+        reader.readexactly = AsyncMock(side_effect=[
             struct.pack(">B", UserEditTypes.MODIFY.value),
             struct.pack(">H", len(file_name)),
-            struct.pack(f">{len(file_name)}s", file_name.encode()),
-            struct.pack(">H", len(content)),
-            struct.pack(f">{len(content)}s", content.encode())
+            file_name.encode(),
+            struct.pack(">QB", 3, Codec.NONE.value),
+            b"new",
         ])
-    )
+        await server.handle_message(MessageType.USER_EDIT, reader, writer)
 
-    await server.handle_message(MessageType.USER_EDIT, reader, writer)
+    assert stat.S_IMODE(os.stat(os.path.join(test_file_path, "script")).st_mode) == 0o750
+    # the same mode open() gives a new file
+    with open(os.path.join(test_file_path, "created"), "w") as created_file:
+        assert stat.S_IMODE(os.fstat(created_file.fileno()).st_mode) == NEW_FILE_MODE
+    assert stat.S_IMODE(os.stat(os.path.join(test_file_path, "new")).st_mode) == NEW_FILE_MODE
 
-    mock_unlink.assert_called_once_with(os.path.join(test_file_path, file_name).encode())
-    mock_open.assert_called_with(os.path.join(test_file_path, file_name).encode(), "w")
+
+def test_patched_file_keeps_the_mode_of_its_base(tmp_path):
+    base_path = os.path.join(tmp_path, "script")
+    new_path = os.path.join(tmp_path, "new")
+    delta_path = os.path.join(tmp_path, "delta")
+    with open(base_path, "wb") as base_file:
+        base_file.write(b"#!/bin/sh\n" + b"echo old\n" * 1000)
+    with open(new_path, "wb") as new_file:
+        new_file.write(b"#!/bin/sh\n" + b"echo old\n" * 999 + b"echo new\n")
+    os.chmod(base_path, 0o755)
+    block_size, signatures = compute_signatures(base_path)
+    target_digest = write_delta(new_path, block_size, signatures, delta_path, "md5")
+
+    assert patch_file(base_path.encode(), block_size, delta_path, target_digest, str(tmp_path), "md5") == \
+        target_digest
+
+    assert stat.S_IMODE(os.stat(base_path).st_mode) == 0o755
+    with open(base_path, "rb") as patched_file, open(new_path, "rb") as new_file:
+        assert patched_file.read() == new_file.read()
 
 
 @pytest.mark.asyncio
@@ -159,7 +210,7 @@ async def test_handle_modify(mock_unlink, mock_open, mock_md5, mock_dumps):
 async def test_handle_file_request_wrong_md5sum(mock_md5):
     test_file_path = '/tmp/server'
     file_name = "my_file"
-    server = SharedFolderServer("localhost", 1234, test_file_path)
+    server = SharedFolderServer("localhost", 1234, test_file_path, digest_algorithm="md5")
     mock_md5.hexdigest.return_value = "\x00" * 32
 
     writer = AsyncMock()
@@ -175,3 +226,122 @@ async def test_handle_file_request_wrong_md5sum(mock_md5):
     await server.handle_message(MessageType.USER_REQUEST, reader, writer)
 
     writer.write.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_handle_bulk_request_answers_every_file(tmp_path):
+    test_file_path = str(tmp_path)
+    server = SharedFolderServer("localhost", 1234, test_file_path, digest_algorithm="md5")
+    content = b"BEST FILE EVER"
+    for file_name in ("a", "b"):
+        with open(os.path.join(test_file_path, file_name), "wb") as new_file:
+            new_file.write(content)
+    server.manifest.refresh()
+
+    written = []
+    writer = MagicMock()
+    writer.write.side_effect = written.append
+    writer.drain = AsyncMock()
+    server.clients[writer] = Connection(writer)
+    reader = AsyncMock()
+    reader.readexactly = AsyncMock(side_effect=[
+        struct.pack(">I", 3),
+        struct.pack(">H", 1), b"a", hashlib.md5(content).hexdigest().encode(), struct.pack(">Q", 5),
+        struct.pack(">H", 1), b"c", hashlib.md5(content).hexdigest().encode(), struct.pack(">Q", 0),
+        struct.pack(">H", 1), b"b", b"0" * 32, struct.pack(">Q", 0),
+    ])
+
+    await server.handle_message(MessageType.USER_BULK_REQUEST, reader, writer)
+    await server.clients[writer].close()
+
+    data = b"".join(written)
+    # the client already has the first 5 bytes of a
+    first = UserRequestResponse("a", "", 5).pack() + struct.pack(">QB", len(content) - 5, Codec.NONE.value) + \
+        content[5:]
+    # c is not in the folder, its content is sent from a file with the same digest
+    second = UserRequestResponse("c", "").pack() + struct.pack(">QB", len(content), Codec.NONE.value) + content
+    assert data == first + second + ServerFileUnavailableMessage("b").pack()
+
+
+@pytest.mark.asyncio
+async def test_delta_request_for_a_diverged_copy_is_answered(tmp_path):
+    test_file_path = str(tmp_path)
+    server = SharedFolderServer("localhost", 1234, test_file_path, digest_algorithm="md5")
+    requested = b"requested version" * 1000
+    for file_name, content in (("a", requested), ("b", requested)):
+        with open(os.path.join(test_file_path, file_name), "wb") as new_file:
+            new_file.write(content)
+    server.manifest.refresh()
+    server.manifest.take_delta()
+    # our copy of a changed and the index missed it, b still has the requested content
+    with open(os.path.join(test_file_path, "a"), "wb") as changed_file:
+        changed_file.write(b"diverged")
+    with open(os.path.join(test_file_path, "client_copy"), "wb") as client_copy:
+        client_copy.write(b"old version" * 1000)
+    signatures = pack_signatures(*compute_signatures(os.path.join(test_file_path, "client_copy")))
+
+    written = []
+    writer = MagicMock()
+    writer.write.side_effect = written.append
+    writer.drain = AsyncMock()
+    server.clients[writer] = Connection(writer)
+    for file_name, content in (("a", requested), ("c", b"lost version")):
+        reader = asyncio.StreamReader()
+        reader.feed_data(UserDeltaRequestMessage(file_name, hashlib.md5(content).hexdigest(), signatures).pack()[1:])
+        await server.handle_message(MessageType.USER_DELTA_REQUEST, reader, writer)
+    await server.clients[writer].close()
+
+    # the whole content of a is sent from b, and the version of c that no file has is unavailable
+    assert b"".join(written) == UserRequestResponse("a", "").pack() + \
+        struct.pack(">QB", len(requested), Codec.NONE.value) + requested + ServerFileUnavailableMessage("c").pack()
+    assert server.manifest.files["a"].digest == hashlib.md5(b"diverged").hexdigest()
+    assert server.broadcast_scheduler.pending_edits == 1
+
+
+@pytest.mark.asyncio
+async def test_signature_request_publishes_the_correction_of_a_stale_index(tmp_path):
+    test_file_path = str(tmp_path)
+    server = SharedFolderServer("localhost", 1234, test_file_path, digest_algorithm="md5")
+    with open(os.path.join(test_file_path, "a"), "wb") as new_file:
+        new_file.write(b"indexed")
+    server.manifest.refresh()
+    with open(os.path.join(test_file_path, "a"), "wb") as changed_file:
+        changed_file.write(b"changed behind the index")
+
+    writer = MagicMock()
+    writer.drain = AsyncMock()
+    server.clients[writer] = Connection(writer)
+    reader = asyncio.StreamReader()
+    reader.feed_data(UserSignatureRequestMessage("a").pack()[1:])
+    await server.handle_message(MessageType.USER_SIGNATURE_REQUEST, reader, writer)
+    await server.clients[writer].close()
+
+    assert server.manifest.files["a"].digest == hashlib.md5(b"changed behind the index").hexdigest()
+    assert server.broadcast_scheduler.pending_edits == 1
+    assert server.manifest.take_delta().files == {"a": server.manifest.files["a"].digest}
+
+
+@pytest.mark.asyncio
+async def test_signature_request_publishes_nothing_when_the_index_was_not_updated(tmp_path):
+    test_file_path = str(tmp_path)
+    server = SharedFolderServer("localhost", 1234, test_file_path, digest_algorithm="md5")
+    file_path = os.path.join(test_file_path, "a")
+    with open(file_path, "wb") as new_file:
+        new_file.write(b"indexed")
+    server.manifest.refresh()
+    # the same size and modification time, so the stat of the file says the index is current
+    mtime_ns = os.stat(file_path).st_mtime_ns
+    with open(file_path, "wb") as changed_file:
+        changed_file.write(b"changed")
+    os.utime(file_path, ns=(mtime_ns, mtime_ns))
+
+    writer = MagicMock()
+    writer.drain = AsyncMock()
+    server.clients[writer] = Connection(writer)
+    reader = asyncio.StreamReader()
+    reader.feed_data(UserSignatureRequestMessage("a").pack()[1:])
+    await server.handle_message(MessageType.USER_SIGNATURE_REQUEST, reader, writer)
+    await server.clients[writer].close()
+
+    assert server.broadcast_scheduler.pending_edits == 0
+    assert server.manifest.take_delta().is_empty()
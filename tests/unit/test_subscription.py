@@ -0,0 +1,58 @@
+import os
+
+from shared_folder_opu.manifest import ManifestDelta, ManifestIndex
+from shared_folder_opu.manifest_codec import EncodedManifest
+from shared_folder_opu.subscription import Subscription
+
+FOO = os.path.join("projects", "foo")
+SUBSCRIPTION = Subscription.from_json({"roots": [FOO + os.sep], "include": ["*.py", "*.txt"],
+                                       "exclude": ["*.log", os.path.join(FOO, "build")]})
+
+
+def test_paths_are_matched_under_the_roots():
+    assert SUBSCRIPTION.roots == (FOO,)
+    assert SUBSCRIPTION.matches(os.path.join(FOO, "main.py"))
+    assert SUBSCRIPTION.matches(os.path.join(FOO, "src", "notes.txt"))
+    assert not SUBSCRIPTION.matches(os.path.join(FOO, "image.png"))
+    assert not SUBSCRIPTION.matches(os.path.join("projects", "bar", "main.py"))
+    assert not SUBSCRIPTION.matches(os.path.join(FOO, "build", "main.py"))
+    assert not SUBSCRIPTION.matches(os.path.join(FOO, "debug.log"))
+    # the directories above the root hold it
+    assert SUBSCRIPTION.matches("projects", is_dir=True)
+    assert SUBSCRIPTION.matches(os.path.join(FOO, "src"), is_dir=True)
+    assert not SUBSCRIPTION.matches(os.path.join(FOO, "build"), is_dir=True)
+    assert not SUBSCRIPTION.matches(os.path.join("projects", "bar"), is_dir=True)
+    assert Subscription.from_json(None).is_everything()
+    assert Subscription.from_json(SUBSCRIPTION.to_json()) == SUBSCRIPTION
+
+
+def test_delta_is_restricted_to_the_subscription():
+    inside = os.path.join(FOO, "main.py")
+    outside = os.path.join("projects", "bar", "main.py")
+    delta = ManifestDelta(3, 7, {inside: "1", outside: "2"}, [os.path.join(FOO, "old.py"), "projects", "other"],
+                          ["projects", os.path.join("projects", "bar")],
+                          [[os.path.join(FOO, "a.py"), inside], [outside, os.path.join(FOO, "b.py")]])
+
+    part = delta.restricted_to(SUBSCRIPTION)
+
+    assert (part.base_version, part.version) == (3, 7)
+    assert part.files == {inside: "1"}
+    assert part.removed == [os.path.join(FOO, "old.py"), "projects"]
+    assert part.directories == ["projects"]
+    assert part.moved == [[os.path.join(FOO, "a.py"), inside]]
+    assert ManifestDelta(3, 7, {outside: "2"}).restricted_to(SUBSCRIPTION).is_empty()
+
+
+def test_manifest_is_encoded_for_a_subscription(tmp_path):
+    for relative_path in [os.path.join(FOO, "main.py"), os.path.join("projects", "bar", "main.py")]:
+        os.makedirs(os.path.join(tmp_path, os.path.dirname(relative_path)), exist_ok=True)
+        with open(os.path.join(tmp_path, relative_path), "wb") as new_file:
+            new_file.write(relative_path.encode())
+    index = ManifestIndex(str(tmp_path))
+    index.refresh()
+
+    manifest = EncodedManifest(index.to_bytes(SUBSCRIPTION))
+
+    assert list(manifest.file_to_hash()) == [os.path.join(FOO, "main.py")]
+    assert sorted(manifest.directories()) == ["projects", FOO]
+    assert EncodedManifest(index.to_bytes()).file_count == 2
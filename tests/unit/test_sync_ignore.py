@@ -0,0 +1,57 @@
+import os
+
+from shared_folder_opu.manifest import ManifestIndex
+from shared_folder_opu.sync_ignore import IgnoreRules, SyncIgnore, SYNC_IGNORE_NAME
+
+
+def write_file(path, content: bytes):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as new_file:
+        new_file.write(content)
+
+
+def test_rules_follow_gitignore():
+    rules = IgnoreRules(["# editors", "*.swp", "", "build/", "/top.txt", "docs/**/*.tmp", "src/*.o"])
+
+    assert rules.matches(".a.swp")
+    assert rules.matches(os.path.join("deep", "dir", ".a.swp"))
+    assert rules.matches(os.path.join("sub", "build"), is_dir=True)
+    assert not rules.matches(os.path.join("sub", "build"))
+    assert rules.matches("top.txt")
+    assert not rules.matches(os.path.join("sub", "top.txt"))
+    assert rules.matches(os.path.join("docs", "a.tmp"))
+    assert rules.matches(os.path.join("docs", "x", "y", "a.tmp"))
+    assert rules.matches(os.path.join("src", "a.o"))
+    assert not rules.matches(os.path.join("src", "lib", "a.o"))
+
+
+def test_the_last_matching_rule_decides():
+    rules = IgnoreRules(["*.log", "!keep.log", "tmp/", "!tmp/"])
+
+    assert rules.matches("debug.log")
+    assert not rules.matches(os.path.join("sub", "keep.log"))
+    assert not rules.matches("tmp", is_dir=True)
+
+
+def test_ignore_file_is_reloaded_and_covers_parents(tmp_path):
+    ignore = SyncIgnore(str(tmp_path), check_interval=0)
+    assert not ignore.is_ignored(os.path.join(".git", "HEAD"))
+
+    write_file(os.path.join(tmp_path, SYNC_IGNORE_NAME), b".git/\n__pycache__\n")
+
+    assert ignore.is_ignored(os.path.join(".git", "HEAD"))
+    assert ignore.is_ignored(os.path.join("pkg", "__pycache__", "a.pyc"))
+    assert not ignore.is_ignored(os.path.join("pkg", "a.py"))
+
+
+def test_ignored_paths_are_not_indexed(tmp_path):
+    write_file(os.path.join(tmp_path, SYNC_IGNORE_NAME), b"node_modules/\n*~\n")
+    write_file(os.path.join(tmp_path, "a"), b"a")
+    write_file(os.path.join(tmp_path, "a~"), b"backup")
+    write_file(os.path.join(tmp_path, "web", "node_modules", "lib", "b"), b"b")
+
+    index = ManifestIndex(str(tmp_path))
+    index.refresh()
+
+    assert set(index.files) == {SYNC_IGNORE_NAME, "a"}
+    assert index.directories == {"web"}
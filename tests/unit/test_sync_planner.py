@@ -0,0 +1,29 @@
+import time
+
+from shared_folder_opu.sync_planner import plan_sync
+
+
+def test_plan_orders_and_collapses_actions():
+    local_files = {"same": "1", "changed": "1", "redundant": "1", "old/a": "1", "old/sub/b": "1", "now_dir": "1"}
+    local_directories = {"old", "old/sub", "now_file"}
+    remote_files = {"same": "1", "changed": "2", "new/c": "3", "now_file": "4"}
+    remote_directories = {"new", "new/deep", "now_dir"}
+
+    plan = plan_sync(local_files, local_directories, remote_files, remote_directories)
+
+    assert plan.deletes == ["now_dir", "redundant"]
+    assert plan.rmtrees == ["now_file", "old"]
+    assert plan.mkdirs == ["new", "new/deep", "now_dir"]
+    assert plan.fetches == {"new/c": "3", "now_file": "4"}
+    assert plan.updates == {"changed": "2"}
+
+
+def test_plan_of_equal_folders_is_empty():
+    files = {f"dir{index % 100}/file{index}": str(index) for index in range(100000)}
+    directories = {f"dir{index}" for index in range(100)}
+
+    start = time.process_time()
+    plan = plan_sync(files, directories, dict(files), set(directories))
+
+    assert plan.is_empty()
+    assert time.process_time() - start < 1
@@ -0,0 +1,53 @@
+import asyncio
+import os
+import threading
+import time
+
+import pytest
+
+from shared_folder_opu.worker_pool import WorkerPool
+
+
+@pytest.mark.asyncio
+async def test_jobs_on_the_same_path_keep_their_order():
+    workers = WorkerPool(4)
+    order = []
+
+    def job(name: str, delay: float):
+        time.sleep(delay)
+        order.append(name)
+
+    await asyncio.gather(workers.run(job, "slow", 0.1, path="a"), workers.run(job, "fast", 0, path="a"))
+
+    assert order == ["slow", "fast"]
+    assert workers.last_jobs == {}
+    workers.shutdown()
+
+
+@pytest.mark.asyncio
+async def test_jobs_on_different_paths_run_in_parallel():
+    workers = WorkerPool(2)
+    both_started = threading.Barrier(2, timeout=1)
+
+    # each job waits for the other one, so they finish only if they run at the same time
+    await asyncio.gather(workers.run(both_started.wait, path="a"), workers.run(both_started.wait, path="b"))
+    workers.shutdown()
+
+
+@pytest.mark.asyncio
+async def test_a_directory_job_is_ordered_with_the_jobs_on_its_contents():
+    workers = WorkerPool(4)
+    order = []
+
+    def job(name: str, delay: float):
+        time.sleep(delay)
+        order.append(name)
+
+    await asyncio.gather(workers.run(job, "write", 0.1, path=os.path.join("dir", "sub", "a")),
+                         workers.run(job, "move", 0, path=("dir", "moved")),
+                         workers.run(job, "write moved", 0, path=os.path.join("moved", "a")),
+                         workers.run(job, "other", 0.05, path="dir2"))
+
+    assert order == ["other", "write", "move", "write moved"]
+    assert workers.last_jobs == {}
+    workers.shutdown()